@@ -1,7 +1,19 @@
 import asyncio
-from typing import Dict, Set
-from datetime import datetime, timedelta
+import os
+import random
+import re
+import time
+import zlib
+from array import array
+from collections import OrderedDict
+from typing import Dict, Optional, Set, Tuple
 import logging
+from db import (
+    get_user_thread, save_user_thread, delete_user_threads, purge_expired_threads,
+    load_cached_answers, save_cached_answer, delete_cached_answers, purge_expired_answers,
+    release_expired_holds
+)
+from async_db import run_db
 
 logger = logging.getLogger(__name__)
 
@@ -29,53 +41,298 @@ class UserRequestLock:
 
 user_request_lock = UserRequestLock()
 
-class BalanceCache:
+BALANCE_HOLD_TTL = int(os.getenv('BALANCE_HOLD_TTL', '900'))
+HOLD_RECOVERY_INTERVAL = int(os.getenv('HOLD_RECOVERY_INTERVAL', '60'))
+
+async def recover_expired_holds(interval: int = HOLD_RECOVERY_INTERVAL):
+    while True:
+        try:
+            released = await run_db(release_expired_holds)
+            if released:
+                logger.warning(f"Повернуто прострочених резервів балансу: {released}")
+        except Exception as e:
+            logger.error(f"Помилка повернення прострочених резервів: {e}")
+        await asyncio.sleep(interval)
+
+THREAD_STORE_MAX_ENTRIES = int(os.getenv('THREAD_STORE_MAX_ENTRIES', '10000'))
+THREAD_IDLE_TTL = int(os.getenv('THREAD_IDLE_TTL', str(7 * 24 * 3600)))
+THREAD_TOUCH_INTERVAL = int(os.getenv('THREAD_TOUCH_INTERVAL', '3600'))
+
+class ThreadStore:
     
-    def __init__(self, ttl_seconds: int = 30):
-        self.cache: Dict[int, tuple[float, int]] = {}
-        self.ttl = ttl_seconds
+    def __init__(
+        self,
+        max_entries: int = THREAD_STORE_MAX_ENTRIES,
+        idle_ttl: int = THREAD_IDLE_TTL,
+        touch_interval: int = THREAD_TOUCH_INTERVAL
+    ):
+        self.max_entries = max_entries
+        self.idle_ttl = idle_ttl
+        self.touch_interval = touch_interval
+        self.entries: OrderedDict[Tuple[int, str], Tuple[str, float, float]] = OrderedDict()
+        self.user_services: Dict[int, Set[str]] = {}
     
-    def get(self, user_id: int) -> int | None:
-        if user_id in self.cache:
-            timestamp, balance = self.cache[user_id]
-            if (datetime.now().timestamp() - timestamp) < self.ttl:
-                return balance
-            else:
-                del self.cache[user_id]
-        return None
+    def _remember(self, user_id: int, service: str, thread_id: str, last_used: float, persisted: float):
+        key = (user_id, service)
+        self.entries[key] = (thread_id, last_used, persisted)
+        self.entries.move_to_end(key)
+        self.user_services.setdefault(user_id, set()).add(service)
+        while len(self.entries) > self.max_entries:
+            evicted, _ = self.entries.popitem(last=False)
+            self._forget_service(*evicted)
+    
+    def _forget_service(self, user_id: int, service: str):
+        services = self.user_services.get(user_id)
+        if services is not None:
+            services.discard(service)
+            if not services:
+                del self.user_services[user_id]
+    
+    async def get(self, user_id: int, service: str) -> Optional[str]:
+        key = (user_id, service)
+        now = time.time()
+        if key in self.entries:
+            thread_id, last_used, _ = self.entries[key]
+            if now - last_used <= self.idle_ttl:
+                self.entries.move_to_end(key)
+                return thread_id
+            del self.entries[key]
+            self._forget_service(user_id, service)
+            await run_db(delete_user_threads, user_id, service)
+            return None
+        
+        thread_id = await run_db(get_user_thread, user_id, service, self.idle_ttl)
+        if key in self.entries:
+            return self.entries[key][0]
+        if thread_id:
+            self._remember(user_id, service, thread_id, now, now - self.touch_interval)
+        return thread_id
     
-    def set(self, user_id: int, balance: int):
-        self.cache[user_id] = (datetime.now().timestamp(), balance)
+    async def set(self, user_id: int, service: str, thread_id: str):
+        now = time.time()
+        entry = self.entries.get((user_id, service))
+        if entry is not None and entry[0] == thread_id and now - entry[2] < self.touch_interval:
+            self._remember(user_id, service, thread_id, now, entry[2])
+            return
+        self._remember(user_id, service, thread_id, now, now)
+        await run_db(save_user_thread, user_id, service, thread_id)
     
-    def invalidate(self, user_id: int):
-        self.cache.pop(user_id, None)
+    async def clear(self, user_id: int, service: Optional[str] = None) -> list:
+        services = [service] if service else list(self.user_services.get(user_id, ()))
+        removed = []
+        for name in services:
+            entry = self.entries.pop((user_id, name), None)
+            if entry:
+                removed.append(entry[0])
+            self._forget_service(user_id, name)
+        await run_db(delete_user_threads, user_id, service)
+        return removed
     
-    def clear(self):
-        self.cache.clear()
+    async def purge_expired(self) -> int:
+        now = time.time()
+        expired = [key for key, (_, last_used, _) in self.entries.items() if now - last_used > self.idle_ttl]
+        for key in expired:
+            del self.entries[key]
+            self._forget_service(*key)
+        return await run_db(purge_expired_threads, self.idle_ttl)
+
+thread_store = ThreadStore()
+
+ANSWER_CACHE_ENABLED = os.getenv('ANSWER_CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+ANSWER_CACHE_THRESHOLD = float(os.getenv('ANSWER_CACHE_THRESHOLD', '0.9'))
+ANSWER_CACHE_TTL = int(os.getenv('ANSWER_CACHE_TTL', str(7 * 24 * 3600)))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv('ANSWER_CACHE_MAX_ENTRIES', '5000'))
+ANSWER_CACHE_MIN_WORDS = 4
+
+MINHASH_PERMUTATIONS = 64
+MINHASH_BANDS = 16
+MINHASH_ROWS = MINHASH_PERMUTATIONS // MINHASH_BANDS
+SHINGLE_SIZE = 4
+_MINHASH_PRIME = (1 << 61) - 1
+_MINHASH_MASK = (1 << 32) - 1
+_minhash_rng = random.Random(20240601)
+_MINHASH_COEFFICIENTS = [
+    (_minhash_rng.randrange(1, _MINHASH_PRIME), _minhash_rng.randrange(0, _MINHASH_PRIME))
+    for _ in range(MINHASH_PERMUTATIONS)
+]
+_NON_WORD_RE = re.compile(r'[^\w]+')
+_NUMBER_RE = re.compile(r'\d+')
+_FOLLOW_UP_LEADS = frozenset({'а', 'і', 'й', 'та', 'то'})
+_FOLLOW_UP_WORDS = frozenset({
+    'це', 'цей', 'ця', 'ці', 'цього', 'цієї', 'цих', 'цьому', 'цим', 'цією', 'цими',
+    'той', 'того', 'тієї', 'тих', 'такий', 'така', 'таке', 'такі', 'такого', 'такої',
+    'він', 'вона', 'воно', 'вони', 'його', 'її', 'їх', 'йому', 'їй', 'їм',
+    'ним', 'нею', 'ними', 'нього', 'неї', 'них', 'ньому', 'ній',
+    'там', 'тут', 'також', 'теж', 'ще', 'вище', 'попередній', 'попереднє', 'попереднього'
+})
 
-balance_cache = BalanceCache(ttl_seconds=30)
+def normalize_question(text: str) -> str:
+    return _NON_WORD_RE.sub(' ', text.lower()).strip()
 
-class BalanceDeductionTracker:
+def minhash_signature(normalized: str) -> Tuple[int, ...]:
+    padded = f" {normalized} "
+    if len(padded) <= SHINGLE_SIZE:
+        shingles = {padded}
+    else:
+        shingles = {padded[i:i + SHINGLE_SIZE] for i in range(len(padded) - SHINGLE_SIZE + 1)}
+    hashes = [zlib.crc32(shingle.encode('utf-8')) for shingle in shingles]
+    return tuple(
+        min(((a * h + b) % _MINHASH_PRIME) & _MINHASH_MASK for h in hashes)
+        for a, b in _MINHASH_COEFFICIENTS
+    )
+
+class _CachedAnswer:
+    __slots__ = ('service', 'key', 'answer', 'signature', 'numbers', 'created_at')
     
-    def __init__(self):
-        self.pending_deductions: Dict[int, str] = {}
-        self.completed_deductions: Set[str] = set()
+    def __init__(self, service: str, key: str, answer: str, signature: Tuple[int, ...], created_at: float):
+        self.service = service
+        self.key = key
+        self.answer = answer
+        self.signature = signature
+        self.numbers = frozenset(_NUMBER_RE.findall(key))
+        self.created_at = created_at
+
+class AnswerCache:
     
-    def start_deduction(self, user_id: int, request_id: str) -> bool:
-        if user_id in self.pending_deductions:
-            return False
-        self.pending_deductions[user_id] = request_id
-        return True
+    def __init__(
+        self,
+        threshold: float = ANSWER_CACHE_THRESHOLD,
+        ttl_seconds: int = ANSWER_CACHE_TTL,
+        max_entries: int = ANSWER_CACHE_MAX_ENTRIES
+    ):
+        self.threshold = threshold
+        self.ttl = ttl_seconds
+        self.max_entries = max_entries
+        self.entries: OrderedDict[int, _CachedAnswer] = OrderedDict()
+        self.exact: Dict[Tuple[str, str], int] = {}
+        self.buckets: Dict[Tuple[str, int, Tuple[int, ...]], Set[int]] = {}
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._loaded = False
+        self._load_lock = asyncio.Lock()
+    
+    def _bands(self, signature: Tuple[int, ...]):
+        for band in range(MINHASH_BANDS):
+            yield band, signature[band * MINHASH_ROWS:(band + 1) * MINHASH_ROWS]
+    
+    def _index(self, entry_id: int, entry: _CachedAnswer):
+        self.entries[entry_id] = entry
+        self.exact[(entry.service, entry.key)] = entry_id
+        for band, rows in self._bands(entry.signature):
+            self.buckets.setdefault((entry.service, band, rows), set()).add(entry_id)
+    
+    def _unindex(self, entry_id: int) -> Optional[_CachedAnswer]:
+        entry = self.entries.pop(entry_id, None)
+        if entry is None:
+            return None
+        if self.exact.get((entry.service, entry.key)) == entry_id:
+            del self.exact[(entry.service, entry.key)]
+        for band, rows in self._bands(entry.signature):
+            bucket = self.buckets.get((entry.service, band, rows))
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self.buckets[(entry.service, band, rows)]
+        return entry
+    
+    async def _ensure_loaded(self):
+        if self._loaded:
+            return
+        async with self._load_lock:
+            if self._loaded:
+                return
+            await run_db(purge_expired_answers, self.ttl)
+            rows = await run_db(load_cached_answers, self.ttl, self.max_entries)
+            for row in reversed(rows):
+                signature = tuple(array('Q', row[4]))
+                self._index(row[0], _CachedAnswer(row[1], row[2], row[3], signature, row[5]))
+            self._loaded = True
+        logger.info(f"Завантажено {len(self.entries)} відповідей у кеш")
+    
+    async def _evict(self):
+        evicted = []
+        while len(self.entries) > self.max_entries:
+            entry_id = next(iter(self.entries))
+            self._unindex(entry_id)
+            evicted.append(entry_id)
+        if evicted:
+            self.evictions += len(evicted)
+            await run_db(delete_cached_answers, evicted)
+    
+    def is_cacheable(self, normalized: str) -> bool:
+        words = normalized.split()
+        return (
+            len(words) >= ANSWER_CACHE_MIN_WORDS
+            and words[0] not in _FOLLOW_UP_LEADS
+            and _FOLLOW_UP_WORDS.isdisjoint(words)
+        )
+    
+    async def get(self, service: str, question: str) -> Optional[str]:
+        await self._ensure_loaded()
+        normalized = normalize_question(question)
+        if not self.is_cacheable(normalized):
+            return None
+        now = time.time()
+        
+        entry_id = self.exact.get((service, normalized))
+        if entry_id is None:
+            signature = minhash_signature(normalized)
+            numbers = frozenset(_NUMBER_RE.findall(normalized))
+            candidates = set()
+            for band, rows in self._bands(signature):
+                candidates.update(self.buckets.get((service, band, rows), ()))
+            best_score = 0.0
+            for candidate_id in candidates:
+                candidate = self.entries[candidate_id]
+                if candidate.numbers != numbers:
+                    continue
+                score = sum(1 for x, y in zip(signature, candidate.signature) if x == y) / MINHASH_PERMUTATIONS
+                if score > best_score:
+                    best_score, entry_id = score, candidate_id
+            if entry_id is not None and best_score < self.threshold:
+                entry_id = None
+        
+        if entry_id is not None:
+            entry = self.entries[entry_id]
+            if now - entry.created_at <= self.ttl:
+                self.entries.move_to_end(entry_id)
+                self.hits += 1
+                if entry.key != normalized:
+                    self.near_hits += 1
+                return entry.answer
+            self._unindex(entry_id)
+            await run_db(delete_cached_answers, [entry_id])
+        
+        self.misses += 1
+        return None
     
-    def complete_deduction(self, user_id: int, request_id: str):
-        if user_id in self.pending_deductions:
-            completed_id = self.pending_deductions.pop(user_id)
-            self.completed_deductions.add(completed_id)
-            if len(self.completed_deductions) > 1000:
-                self.completed_deductions = set(list(self.completed_deductions)[-1000:])
+    async def put(self, service: str, question: str, answer: str):
+        await self._ensure_loaded()
+        normalized = normalize_question(question)
+        if not self.is_cacheable(normalized):
+            return
+        signature = minhash_signature(normalized)
+        now = time.time()
+        entry_id = await run_db(save_cached_answer, service, normalized, answer, array('Q', signature).tobytes(), now)
+        if entry_id is None:
+            return
+        self._unindex(entry_id)
+        self._index(entry_id, _CachedAnswer(service, normalized, answer, signature, now))
+        await self._evict()
     
-    def cancel_deduction(self, user_id: int):
-        self.pending_deductions.pop(user_id, None)
+    def get_stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'near_hits': self.near_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': round(self.hits / lookups, 3) if lookups else 0.0,
+            'threshold': self.threshold
+        }
 
-deduction_tracker = BalanceDeductionTracker()
+answer_cache = AnswerCache()
 
@@ -0,0 +1,143 @@
+import asyncio
+import functools
+import logging
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, Optional, Tuple
+
+import db
+
+logger = logging.getLogger(__name__)
+
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '4'))
+ACTIVITY_FLUSH_INTERVAL = float(os.getenv('ACTIVITY_FLUSH_INTERVAL', '5'))
+KNOWN_USERS_MAX_ENTRIES = int(os.getenv('KNOWN_USERS_MAX_ENTRIES', '50000'))
+
+_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix='db')
+
+async def run_db(fn: Callable, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(fn, *args, **kwargs))
+
+def _wrap(fn: Callable) -> Callable:
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        return await run_db(fn, *args, **kwargs)
+    return wrapper
+
+def shutdown():
+    _executor.shutdown(wait=True)
+
+class UserActivityBuffer:
+    
+    def __init__(self, flush_interval: float = ACTIVITY_FLUSH_INTERVAL, max_known: int = KNOWN_USERS_MAX_ENTRIES):
+        self.flush_interval = flush_interval
+        self.max_known = max_known
+        self.known_users: OrderedDict[int, None] = OrderedDict()
+        self.pending: Dict[int, Tuple] = {}
+        self.touches = 0
+        self.inserts = 0
+        self.flushes = 0
+        self.rows_flushed = 0
+        self._task: Optional[asyncio.Task] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+    
+    async def resolve(self, user) -> Tuple:
+        self.touches += 1
+        if user.id in self.known_users:
+            self.known_users.move_to_end(user.id)
+            row = await run_db(db.get_user_full_info, user.id)
+            if row is not None:
+                self._record(user)
+                return row, False
+            self.known_users.pop(user.id, None)
+        
+        row, is_new = await run_db(db.upsert_user, user)
+        self.known_users[user.id] = None
+        self.known_users.move_to_end(user.id)
+        while len(self.known_users) > self.max_known:
+            self.known_users.popitem(last=False)
+        if is_new:
+            self.inserts += 1
+        return row, is_new
+    
+    def _record(self, user):
+        self.pending[user.id] = (
+            user.username,
+            user.first_name,
+            user.last_name,
+            datetime.now().isoformat(),
+            user.id
+        )
+    
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Не вдалося записати активність користувачів: {e}")
+    
+    async def flush(self) -> int:
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            if not self.pending:
+                return 0
+            batch, self.pending = self.pending, {}
+            try:
+                written = await run_db(db.update_users_activity, list(batch.values()))
+            except Exception:
+                for telegram_id, row in batch.items():
+                    self.pending.setdefault(telegram_id, row)
+                raise
+            self.flushes += 1
+            self.rows_flushed += written
+            return written
+    
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+    
+    def get_stats(self) -> Dict:
+        return {
+            'pending': len(self.pending),
+            'known_users': len(self.known_users),
+            'touches': self.touches,
+            'inserts': self.inserts,
+            'flushes': self.flushes,
+            'rows_flushed': self.rows_flushed
+        }
+
+activity_buffer = UserActivityBuffer()
+
+get_balance = _wrap(db.get_balance)
+set_balance = _wrap(db.set_balance)
+add_balance = _wrap(db.add_balance)
+get_processed_txn_ids = _wrap(db.get_processed_txn_ids)
+record_payments = _wrap(db.record_payments)
+get_payment_cursor = _wrap(db.get_payment_cursor)
+set_payment_cursor = _wrap(db.set_payment_cursor)
+subtract_balance = _wrap(db.subtract_balance)
+reserve_balance = _wrap(db.reserve_balance)
+commit_hold = _wrap(db.commit_hold)
+release_hold = _wrap(db.release_hold)
+block_user = _wrap(db.block_user)
+unblock_user = _wrap(db.unblock_user)
+get_users_keyset_page = _wrap(db.get_users_keyset_page)
+get_total_users = _wrap(db.get_total_users)
+find_user_by_username = _wrap(db.find_user_by_username)
+find_user_by_id = _wrap(db.find_user_by_id)
+find_users_by_identifiers = _wrap(db.find_users_by_identifiers)
+search_users = _wrap(db.search_users)
+get_user_full_info = _wrap(db.get_user_full_info)
+get_balance_history = _wrap(db.get_balance_history)
@@ -0,0 +1,83 @@
+"""Latency of operator full-text user search (first three pages) on a synthetic user table.
+
+    python benchmarks/bench_user_search.py [--users 1000000] [--db /tmp/search_bench.db]
+
+The database is generated once and reused on later runs.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+
+FIRST_NAMES = [
+    'Іван', 'Петро', 'Олександр', 'Андрій', 'Микола', 'Сергій', 'Василь', 'Дмитро', 'Юрій', 'Олег',
+    'Тарас', 'Богдан', 'Віктор', 'Роман', 'Ігор', 'Олена', 'Наталія', 'Ірина', 'Оксана', 'Тетяна',
+    'Ivan', 'Petro', 'Oleksandr', 'Andrii', 'Mykola', 'Serhii', 'Vasyl', 'Dmytro', 'Yurii', 'Oleh'
+]
+LAST_NAMES = [
+    'Петренко', 'Шевченко', 'Коваленко', 'Бондаренко', 'Ткаченко', 'Кравченко', 'Олійник', 'Шевчук',
+    'Коваль', 'Поліщук', 'Бойко', 'Ткачук', 'Марченко', 'Лисенко', 'Руденко', 'Савченко', 'Мельник',
+    'Петрук', 'Клименко', 'Павленко', 'Кузьменко', 'Іваненко', 'Пономаренко', 'Левченко', 'Гончаренко'
+]
+QUERIES = ['петренко', 'шевч', 'ivan петренко', 'олександр коваленко', 'user_123456', 'іван', 'і', 'ab', 'zzz_none']
+
+def build(path, users):
+    db.DB_PATH = path
+    db.init_db()
+    conn = db.get_connection()
+    if conn.execute('SELECT COUNT(*) FROM users').fetchone()[0] >= users:
+        return
+    rng = random.Random(17)
+    rows = (
+        (
+            100_000_000 + i,
+            f'user_{i}' if rng.random() < 0.7 else None,
+            rng.choice(FIRST_NAMES),
+            rng.choice(LAST_NAMES) if rng.random() < 0.9 else None,
+            '2024-01-01T00:00:00'
+        )
+        for i in range(users)
+    )
+    conn.executemany(
+        'INSERT INTO users (telegram_id, username, first_name, last_name, last_active) VALUES (?, ?, ?, ?, ?)',
+        rows
+    )
+    conn.commit()
+    conn.execute('ANALYZE')
+
+def measure(query, repeat):
+    timings = []
+    for _ in range(repeat):
+        after = None
+        for _ in range(3):
+            started = time.perf_counter()
+            users, has_more, truncated = db.search_users(query, 10, after)
+            timings.append((time.perf_counter() - started) * 1000)
+            if not has_more:
+                break
+            after = (users[-1][5], users[-1][4])
+    return statistics.median(timings), max(timings), truncated
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=1_000_000)
+    parser.add_argument('--db', default='/tmp/search_bench.db')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    build(args.db, args.users)
+    print(f'{args.users} users ready in {time.perf_counter() - started:.1f}s ({args.db})')
+    print(f"{'query':<24}{'median ms':>12}{'max ms':>10}  truncated")
+    for query in QUERIES:
+        median, worst, truncated = measure(query, args.repeat)
+        print(f'{query:<24}{median:>12.1f}{worst:>10.1f}  {truncated}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""Updates/sec and p95 handling latency of long polling vs webhook mode against a local fake Telegram server.
+
+    python benchmarks/bench_webhook_vs_polling.py [--updates 2000] [--users 200] [--rate 1000] [--work-ms 5] [--rtt-ms 50]
+
+The fake server injects updates at --rate per second from --users users. In polling mode it answers
+getUpdates after --rtt-ms; in webhook mode it pushes each update to the bot's aiohttp endpoint over up to
+WEBHOOK_MAX_CONNECTIONS connections after half of --rtt-ms and retries after a 503. Latency runs from
+injection until the handler finishes its --work-ms of simulated work.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aiohttp
+from aiogram import Bot, Dispatcher, Router
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import Message
+from aiohttp import web
+
+import webhook_server
+
+TOKEN = '42:BENCHMARK'
+API_PORT = 18081
+WEBHOOK_PORT = 18082
+BOT_INFO = {'id': 42, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+
+class FakeTelegram:
+
+    def __init__(self, rtt: float):
+        self.rtt = rtt
+        self.pending = []
+        self.arrived = asyncio.Event()
+        self.injected = {}
+        self.webhook = None
+        self.deliveries = asyncio.Queue()
+        self.retries = 0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        return app
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        params = dict(await request.post())
+        if method == 'getUpdates':
+            result = await self.get_updates(int(params.get('offset', 0)), float(params.get('timeout', 0)))
+        elif method == 'setWebhook':
+            self.webhook = (params['url'], params.get('secret_token', ''))
+            result = True
+        elif method == 'deleteWebhook':
+            self.webhook = None
+            result = True
+        elif method == 'getMe':
+            result = BOT_INFO
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def get_updates(self, offset: int, timeout: float):
+        self.pending = [update for update in self.pending if update['update_id'] >= offset]
+        if not self.pending:
+            self.arrived.clear()
+            try:
+                await asyncio.wait_for(self.arrived.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        await asyncio.sleep(self.rtt)
+        return self.pending[:100]
+
+    def inject(self, update_id: int, user_id: int):
+        update = {
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': {'id': user_id, 'is_bot': False, 'first_name': 'User'},
+                'text': f'питання {update_id}'
+            }
+        }
+        self.injected[update_id] = time.perf_counter()
+        if self.webhook:
+            self.deliveries.put_nowait(update)
+        else:
+            self.pending.append(update)
+            self.arrived.set()
+
+    async def deliver(self, session: aiohttp.ClientSession):
+        while True:
+            update = await self.deliveries.get()
+            await asyncio.sleep(self.rtt / 2)
+            url, secret = self.webhook
+            while True:
+                async with session.post(url, json=update, headers={'X-Telegram-Bot-Api-Secret-Token': secret}) as response:
+                    if response.status != 503:
+                        break
+                self.retries += 1
+                await asyncio.sleep(self.rtt)
+
+def build_dispatcher(work: float, handled: dict) -> Dispatcher:
+    router = Router()
+
+    @router.message()
+    async def answer(message: Message):
+        await asyncio.sleep(work)
+        handled[message.message_id] = time.perf_counter()
+
+    dp = Dispatcher()
+    dp.include_router(router)
+    return dp
+
+async def run(mode: str, args) -> dict:
+    telegram = FakeTelegram(args.rtt_ms / 1000)
+    api = web.AppRunner(telegram.app())
+    await api.setup()
+    await web.TCPSite(api, '127.0.0.1', API_PORT).start()
+
+    handled = {}
+    dp = build_dispatcher(args.work_ms / 1000, handled)
+    bot = Bot(TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(f'http://127.0.0.1:{API_PORT}')))
+    session = aiohttp.ClientSession()
+    workers = []
+    if mode == 'polling':
+        bot_task = asyncio.create_task(dp.start_polling(bot, polling_timeout=10, handle_signals=False, close_bot_session=False))
+    else:
+        webhook_server.WEBHOOK_URL = f'http://127.0.0.1:{WEBHOOK_PORT}'
+        webhook_server.WEBHOOK_HOST = '127.0.0.1'
+        webhook_server.WEBHOOK_PORT = WEBHOOK_PORT
+        bot_task = asyncio.create_task(webhook_server.run_webhook(dp, bot))
+        while telegram.webhook is None:
+            await asyncio.sleep(0.01)
+        workers = [asyncio.create_task(telegram.deliver(session)) for _ in range(webhook_server.WEBHOOK_MAX_CONNECTIONS)]
+    await asyncio.sleep(0.2)
+
+    started = time.perf_counter()
+    for update_id in range(1, args.updates + 1):
+        telegram.inject(update_id, 1000 + update_id % args.users)
+        await asyncio.sleep(max(0, started + update_id / args.rate - time.perf_counter()))
+    while len(handled) < args.updates:
+        await asyncio.sleep(0.01)
+    elapsed = max(handled.values()) - started
+
+    if mode == 'polling':
+        await dp.stop_polling()
+    bot_task.cancel()
+    for worker in workers:
+        worker.cancel()
+    await asyncio.gather(bot_task, *workers, return_exceptions=True)
+    await session.close()
+    await bot.session.close()
+    await api.cleanup()
+
+    latencies = sorted((handled[update_id] - telegram.injected[update_id]) * 1000 for update_id in handled)
+    return {
+        'updates/s': args.updates / elapsed,
+        'median ms': statistics.median(latencies),
+        'p95 ms': latencies[int(len(latencies) * 0.95) - 1],
+        'retries': telegram.retries
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--rate', type=float, default=1000)
+    parser.add_argument('--work-ms', type=float, default=5)
+    parser.add_argument('--rtt-ms', type=float, default=50)
+    args = parser.parse_args()
+
+    print(f'{args.updates} updates from {args.users} users at {args.rate:.0f}/s, work {args.work_ms} ms, RTT {args.rtt_ms} ms')
+    print(f"{'mode':<10}{'updates/s':>12}{'median ms':>12}{'p95 ms':>10}{'retries':>10}")
+    for mode in ('polling', 'webhook'):
+        result = asyncio.run(run(mode, args))
+        print(f"{mode:<10}{result['updates/s']:>12.0f}{result['median ms']:>12.1f}{result['p95 ms']:>10.1f}{result['retries']:>10}")
+
+if __name__ == '__main__':
+    main()
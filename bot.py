@@ -1,21 +1,29 @@
 import logging
 import asyncio
 import os
-from aiogram import Bot, Dispatcher, types
+from aiogram import Dispatcher, types
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.filters import Command
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
+from aiogram.methods import SendMessage
 from dotenv import load_dotenv
-from db import init_db, add_or_update_user, get_user_full_info, subtract_balance
+from db import init_db, load_blocked_ids
+from async_db import reserve_balance, commit_hold, release_hold, activity_buffer, shutdown as shutdown_db
+from user_context import UserContext, UserContextMiddleware, BlockedUserMiddleware, reconcile_blocked_ids
 from operator_menu import operator_menu, OPERATOR_ID, operator_router, get_operator_inline_menu
 from monobank_payments import start_payment_checker
-from openai_service import get_service_response, clear_user_thread, validate_message
+from openai_service import get_service_response, clear_user_thread, validate_message, run_multiplexer
+from resources import resources
+from request_scheduler import request_scheduler
 from rate_limiter import message_rate_limiter, service_rate_limiter
+from send_queue import send_queue, PRIORITY_GROUP, PRIORITY_PROGRESS
+from webhook_server import BOT_MODE, run_webhook
 from additional_improvements import (
     user_request_lock, 
-    balance_cache, 
-    deduction_tracker
+    thread_store,
+    recover_expired_holds,
+    BALANCE_HOLD_TTL
 )
 from ux_improvements import (
     format_balance_message,
@@ -23,9 +31,10 @@ from ux_improvements import (
     format_user_stats,
     format_payment_instructions,
     get_quick_actions_keyboard,
-    get_help_tips
+    get_help_tips,
+    format_queue_position,
+    ProgressiveMessage
 )
-import uuid
 
 load_dotenv()
 
@@ -41,13 +50,16 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-bot = Bot(token=API_TOKEN)
+bot = resources.bot
 dp = Dispatcher()
+dp.update.outer_middleware(BlockedUserMiddleware(OPERATOR_ID))
+dp.update.outer_middleware(UserContextMiddleware(OPERATOR_ID))
 dp.include_router(operator_router)
 
 try:
     init_db()
-    logger.info("База даних ініціалізована успішно")
+    blocked_count = load_blocked_ids()
+    logger.info(f"База даних ініціалізована успішно, заблокованих користувачів: {blocked_count}")
 except Exception as e:
     logger.error(f"Помилка ініціалізації БД: {e}")
     raise
@@ -89,16 +101,7 @@ info_menu = ReplyKeyboardMarkup(
 )
 
 async def notify_group(text: str):
-    try:
-        await bot.send_message(GROUP_CHAT_ID, text)
-    except Exception as e:
-        logger.error(f"Не вдалося надіслати повідомлення у групу: {e}")
-
-def is_user_blocked(user_id):
-    if not isinstance(user_id, int) or user_id <= 0:
-        return False
-    user = get_user_full_info(user_id)
-    return user and user[10] == 1
+    send_queue.enqueue(SendMessage(chat_id=GROUP_CHAT_ID, text=text), priority=PRIORITY_GROUP)
 
 async def check_rate_limit(user_id: int, limiter) -> tuple[bool, str]:
     is_allowed, wait_time = limiter.is_allowed(user_id)
@@ -107,7 +110,7 @@ async def check_rate_limit(user_id: int, limiter) -> tuple[bool, str]:
     return True, ""
 
 @dp.message(Command("start"))
-async def send_welcome(message: types.Message, state: FSMContext):
+async def send_welcome(message: types.Message, state: FSMContext, user_ctx: UserContext):
     is_allowed, error_msg = await check_rate_limit(message.from_user.id, message_rate_limiter)
     if not is_allowed:
         await message.answer(error_msg)
@@ -115,9 +118,8 @@ async def send_welcome(message: types.Message, state: FSMContext):
     
     await state.clear()
     try:
-        is_new = add_or_update_user(message.from_user)
         name = message.from_user.first_name or "користувач"
-        if is_new:
+        if user_ctx.is_new:
             user = message.from_user
             from datetime import datetime
             reg_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
@@ -135,11 +137,7 @@ async def send_welcome(message: types.Message, state: FSMContext):
                 reply_markup=get_operator_inline_menu()
             )
         else:
-            if is_user_blocked(message.from_user.id):
-                await message.answer("🚫 Ваш акаунт заблоковано оператором. Зверніться до оператора для розблокування.")
-                return
-            from db import get_balance
-            balance = get_balance(message.from_user.id)
+            balance = user_ctx.balance
             
             await message.answer(
                 f"Вітаю, {name}! 👋\n\n"
@@ -158,19 +156,13 @@ async def send_welcome(message: types.Message, state: FSMContext):
         await message.answer("❌ Помилка при обробці запиту. Спробуйте пізніше.")
 
 @dp.message(lambda m: m.text == "🏠 Меню")
-async def back_to_main(message: types.Message, state: FSMContext):
+async def back_to_main(message: types.Message, state: FSMContext, user_ctx: UserContext):
     await state.clear()
-    add_or_update_user(message.from_user)
     if message.from_user.id == OPERATOR_ID:
         await message.answer("Меню оператора:", reply_markup=get_operator_inline_menu())
     else:
-        if is_user_blocked(message.from_user.id):
-            await message.answer("🚫 Ваш акаунт заблоковано оператором. Зверніться до оператора для розблокування.")
-            return
-        from db import get_balance
-        balance = get_balance(message.from_user.id)
         await message.answer(
-            f"🏠 <b>Головне меню</b>\n\n{format_balance_message(balance)}",
+            f"🏠 <b>Головне меню</b>\n\n{format_balance_message(user_ctx.balance)}",
             reply_markup=main_menu,
             parse_mode="HTML"
         )
@@ -178,10 +170,6 @@ async def back_to_main(message: types.Message, state: FSMContext):
 @dp.message(lambda m: m.text == "🏢 Служби")
 async def choose_service(message: types.Message, state: FSMContext):
     await state.clear()
-    add_or_update_user(message.from_user)
-    if is_user_blocked(message.from_user.id):
-        await message.answer("🚫 Ваш акаунт заблоковано оператором. Зверніться до оператора для розблокування.")
-        return
     await message.answer(
         "Оберіть службу:\n\n"
         "⛽️ <b>ПММ</b> - питання щодо палива та мастильних матеріалів\n"
@@ -192,14 +180,8 @@ async def choose_service(message: types.Message, state: FSMContext):
     )
 
 @dp.message(lambda m: m.text in ["⛽️ ПММ", "👕 Речова", "🍲 Продовольча"])
-async def service_selected(message: types.Message, state: FSMContext):
-    add_or_update_user(message.from_user)
-    if is_user_blocked(message.from_user.id):
-        await message.answer("🚫 Ваш акаунт заблоковано оператором. Зверніться до оператора для розблокування.")
-        return
-    
-    user = get_user_full_info(message.from_user.id)
-    if user[6] <= 0:
+async def service_selected(message: types.Message, state: FSMContext, user_ctx: UserContext):
+    if user_ctx.balance <= 0:
         await message.answer(
             "❌ У вас недостатньо запитів для використання служби.\n"
             "Будь ласка, поповніть баланс через меню '💳 Поповнити'",
@@ -208,10 +190,10 @@ async def service_selected(message: types.Message, state: FSMContext):
         return
     
     await state.set_state(ServiceStates.waiting_for_question)
-    await state.update_data(service=message.text, balance=user[6])
+    await state.update_data(service=message.text, balance=user_ctx.balance)
     
     await message.answer(
-        format_service_info(message.text, user[6]),
+        format_service_info(message.text, user_ctx.balance),
         reply_markup=exit_menu,
         parse_mode="HTML"
     )
@@ -223,10 +205,8 @@ async def service_selected(message: types.Message, state: FSMContext):
     )
 
 @dp.message(ServiceStates.waiting_for_question)
-async def handle_question(message: types.Message, state: FSMContext):
+async def handle_question(message: types.Message, state: FSMContext, user_ctx: UserContext):
     user_id = message.from_user.id
-    request_id = str(uuid.uuid4())
-    
     try:
         if not await user_request_lock.acquire(user_id):
             await message.answer(
@@ -243,7 +223,7 @@ async def handle_question(message: types.Message, state: FSMContext):
             if message.text == "🏠 Меню":
                 await state.clear()
                 await clear_user_thread(user_id)
-                await back_to_main(message, state)
+                await back_to_main(message, state, user_ctx)
                 return
 
             if not message.text:
@@ -258,25 +238,8 @@ async def handle_question(message: types.Message, state: FSMContext):
             data = await state.get_data()
             service = data.get('service')
 
-            cached_balance = balance_cache.get(user_id)
-            if cached_balance is not None:
-                balance = cached_balance
-            else:
-                user = get_user_full_info(user_id)
-                if not user or user[6] <= 0:
-                    await message.answer(
-                        "❌ У вас закінчились запити. Будь ласка, поповніть баланс.",
-                        reply_markup=InlineKeyboardMarkup(
-                            inline_keyboard=[[
-                                InlineKeyboardButton(text="💳 Поповнити баланс", callback_data="top_up_balance")
-                            ]]
-                        )
-                    )
-                    return
-                balance = user[6]
-                balance_cache.set(user_id, balance)
-
-            if balance <= 0:
+            hold = await reserve_balance(user_id, 1, BALANCE_HOLD_TTL)
+            if hold is None:
                 await message.answer(
                     "❌ У вас закінчились запити. Будь ласка, поповніть баланс.",
                     reply_markup=InlineKeyboardMarkup(
@@ -286,67 +249,73 @@ async def handle_question(message: types.Message, state: FSMContext):
                     )
                 )
                 return
-
-            if not deduction_tracker.start_deduction(user_id, request_id):
-                await message.answer("⏳ Ваш попередній запит ще обробляється. Будь ласка, зачекайте.")
-                return
-
-            processing_msg = await message.answer(
-                f"⏳ <b>Обробляю ваш запит...</b>\n\n"
-                f"📋 Служба: {service}\n"
-                f"⏱ Це може зайняти 10-30 секунд\n"
-                f"💡 Будь ласка, зачекайте...",
-                parse_mode="HTML"
-            )
-
-            response = await get_service_response(service, message.text, user_id)
+            hold_id, new_balance = hold
 
             try:
-                await processing_msg.delete()
-            except Exception:
-                pass
+                processing_msg = await send_queue.send(message.answer(
+                    f"⏳ <b>Обробляю ваш запит...</b>\n\n"
+                    f"📋 Служба: {service}\n"
+                    f"⏱ Це може зайняти 10-30 секунд\n"
+                    f"💡 Будь ласка, зачекайте...",
+                    parse_mode="HTML"
+                ))
+
+                progress = ProgressiveMessage(
+                    processing_msg,
+                    header=f"📋 Відповідь від служби {service}:\n\n"
+                )
 
-            max_response_length = 4000
-            if len(response) > max_response_length:
-                response = response[:max_response_length] + "\n\n... (відповідь обрізано)"
-            
-            final_response = (
-                f"📋 <b>Відповідь від служби {service}:</b>\n\n"
-                f"{response.strip()}\n\n"
-                f"💬 <i>Якщо бажаєте продовжити — напишіть нове питання</i>\n"
-                f"🏠 <i>Або поверніться в меню</i>"
-            )
-            
-            if len(final_response) > 4000:
-                chunks = [final_response[i:i+4000] for i in range(0, len(final_response), 4000)]
-                for i, chunk in enumerate(chunks):
-                    if i == 0:
-                        await message.answer(chunk, parse_mode="HTML")
-                    else:
-                        await message.answer(chunk, parse_mode="HTML")
-            else:
-                await message.answer(final_response, parse_mode="HTML")
+                async def show_queue_position(position: int, eta: int):
+                    await send_queue.send(
+                        processing_msg.edit_text(format_queue_position(service, position, eta), parse_mode="HTML"),
+                        priority=PRIORITY_PROGRESS,
+                        max_retries=0
+                    )
+
+                response = await get_service_response(
+                    service, message.text, user_id,
+                    on_progress=progress.update,
+                    on_queue=show_queue_position
+                )
 
-            if not response.startswith("❌"):
                 try:
-                    subtract_balance(user_id, 1)
-                    new_balance = balance - 1
-                    balance_cache.set(user_id, new_balance)
-                    deduction_tracker.complete_deduction(user_id, request_id)
-                    await state.update_data(balance=new_balance)
-                    
-                    await message.answer(
-                        format_balance_message(new_balance),
-                        parse_mode="HTML"
-                    )
-                except ValueError as e:
-                    logger.warning(f"Не вдалося списати баланс для {user_id}: {e}")
-                    deduction_tracker.cancel_deduction(user_id)
-                    await message.answer(
-                        "❌ Не вдалося списати баланс. Можливо, баланс змінився. Перевірте баланс."
-                    )
+                    await processing_msg.delete()
+                except Exception:
+                    pass
+
+                max_response_length = 4000
+                if len(response) > max_response_length:
+                    response = response[:max_response_length] + "\n\n... (відповідь обрізано)"
+                
+                final_response = (
+                    f"📋 <b>Відповідь від служби {service}:</b>\n\n"
+                    f"{response.strip()}\n\n"
+                    f"💬 <i>Якщо бажаєте продовжити — напишіть нове питання</i>\n"
+                    f"🏠 <i>Або поверніться в меню</i>"
+                )
+                
+                if len(final_response) > 4000:
+                    chunks = [final_response[i:i+4000] for i in range(0, len(final_response), 4000)]
+                    for i, chunk in enumerate(chunks):
+                        if i == 0:
+                            await send_queue.send(message.answer(chunk, parse_mode="HTML"))
+                        else:
+                            await send_queue.send(message.answer(chunk, parse_mode="HTML"))
+                else:
+                    await send_queue.send(message.answer(final_response, parse_mode="HTML"))
+            except BaseException:
+                await release_hold(hold_id)
+                raise
+
+            if response.startswith("❌"):
+                await release_hold(hold_id)
             else:
-                deduction_tracker.cancel_deduction(user_id)
+                await commit_hold(hold_id)
+                await state.update_data(balance=new_balance)
+                await send_queue.send(message.answer(
+                    format_balance_message(new_balance),
+                    parse_mode="HTML"
+                ))
         
         finally:
             user_request_lock.release(user_id)
@@ -362,13 +331,13 @@ async def handle_question(message: types.Message, state: FSMContext):
             f"Помилка: {e}"
         )
         await notify_group(error_text)
-        await message.answer(
+        await send_queue.send(message.answer(
             "❌ Помилка при обробці запиту. Спробуйте пізніше.",
             reply_markup=ReplyKeyboardMarkup(
                 keyboard=[[KeyboardButton(text="🏠 Меню")]],
                 resize_keyboard=True
             )
-        )
+        ))
 
 @dp.message(lambda m: m.text == "💳 Поповнити")
 async def top_up(message: types.Message):
@@ -378,10 +347,6 @@ async def top_up(message: types.Message):
         return
     
     try:
-        add_or_update_user(message.from_user)
-        if is_user_blocked(message.from_user.id):
-            await message.answer("🚫 Ваш акаунт заблоковано оператором. Зверніться до оператора для розблокування.")
-            return
         user_id = message.from_user.id
         username = message.from_user.username
         identifier = f"@{username}" if username else str(user_id)
@@ -397,30 +362,17 @@ async def top_up(message: types.Message):
         await message.answer("❌ Помилка при обробці запиту. Спробуйте пізніше.")
 
 @dp.message(lambda m: m.text == "💰 Баланс")
-async def check_balance(message: types.Message):
+async def check_balance(message: types.Message, user_ctx: UserContext):
     is_allowed, error_msg = await check_rate_limit(message.from_user.id, message_rate_limiter)
     if not is_allowed:
         await message.answer(error_msg)
         return
     
     try:
-        add_or_update_user(message.from_user)
-        if is_user_blocked(message.from_user.id):
-            await message.answer("🚫 Ваш акаунт заблоковано оператором. Зверніться до оператора для розблокування.")
-            return
-        
-        cached_balance = balance_cache.get(message.from_user.id)
-        if cached_balance is not None:
-            balance = cached_balance
-        else:
-            from db import get_balance
-            balance = get_balance(message.from_user.id)
-            balance_cache.set(message.from_user.id, balance)
-        
-        user = get_user_full_info(message.from_user.id)
+        balance = user_ctx.balance
         name = message.from_user.first_name or "Користувач"
         username = message.from_user.username or "немає"
-        join_date = user[5] if user and user[5] else "Невідомо"
+        join_date = user_ctx.join_date or "Невідомо"
         
         await message.answer(
             format_balance_message(balance, name),
@@ -440,10 +392,6 @@ async def check_balance(message: types.Message):
 
 @dp.message(lambda m: m.text == "ℹ️ Про бота")
 async def about_bot(message: types.Message):
-    add_or_update_user(message.from_user)
-    if is_user_blocked(message.from_user.id):
-        await message.answer("🚫 Ваш акаунт заблоковано оператором. Зверніться до оператора для розблокування.")
-        return
     await message.answer(
         "📌 Що таке 'Тиловий Асистент'?\n"
         "'Тиловий Асистент' — це чат-бот для військовослужбовців, які працюють у сфері тилового забезпечення.\n"
@@ -541,10 +489,6 @@ async def cancel_command(message: types.Message, state: FSMContext):
 
 @dp.message(lambda m: m.text == "👨‍💼 Оператор")
 async def contact_operator(message: types.Message):
-    add_or_update_user(message.from_user)
-    if is_user_blocked(message.from_user.id):
-        await message.answer("🚫 Ваш акаунт заблоковано оператором. Зверніться до оператора для розблокування.")
-        return
     await message.answer(
         "👨‍💼 <b>Звʼязатись з оператором</b>\n\n"
         "📧 Telegram: @TylBotOperator\n\n"
@@ -561,25 +505,15 @@ async def contact_operator(message: types.Message):
     )
 
 @dp.message(lambda m: m.text == "📊 Статистика")
-async def show_statistics(message: types.Message):
+async def show_statistics(message: types.Message, user_ctx: UserContext):
     is_allowed, error_msg = await check_rate_limit(message.from_user.id, message_rate_limiter)
     if not is_allowed:
         await message.answer(error_msg)
         return
     
     try:
-        add_or_update_user(message.from_user)
-        if is_user_blocked(message.from_user.id):
-            await message.answer("🚫 Ваш акаунт заблоковано оператором. Зверніться до оператора для розблокування.")
-            return
-        
-        user = get_user_full_info(message.from_user.id)
-        if not user:
-            await message.answer("❌ Помилка отримання статистики. Спробуйте пізніше.")
-            return
-        
         await message.answer(
-            format_user_stats(user),
+            format_user_stats(user_ctx),
             parse_mode="HTML"
         )
     except Exception as e:
@@ -600,8 +534,31 @@ async def top_up_balance_callback(callback: types.CallbackQuery):
     )
 
 async def main():
-    asyncio.create_task(start_payment_checker())
-    await dp.start_polling(bot)
+    purged = await thread_store.purge_expired()
+    if purged:
+        logger.info(f"Видалено {purged} застарілих тредів")
+    send_queue.start(bot)
+    activity_buffer.start()
+    background_tasks = [
+        asyncio.create_task(reconcile_blocked_ids()),
+        asyncio.create_task(recover_expired_holds()),
+        asyncio.create_task(start_payment_checker())
+    ]
+    try:
+        if BOT_MODE == 'webhook':
+            await run_webhook(dp, bot)
+        else:
+            await dp.start_polling(bot)
+    finally:
+        for task in background_tasks:
+            task.cancel()
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+        await run_multiplexer.close()
+        await request_scheduler.close()
+        await send_queue.close()
+        await resources.close()
+        await activity_buffer.close()
+        shutdown_db()
 
 if __name__ == '__main__':
     asyncio.run(main()) 
\ No newline at end of file
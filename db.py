@@ -1,5 +1,7 @@
+import re
 import sqlite3
 import threading
+import time
 from datetime import datetime
 from contextlib import contextmanager
 import logging
@@ -7,10 +9,23 @@ import logging
 logger = logging.getLogger(__name__)
 
 _local = threading.local()
+_blocked_ids = set()
+_blocked_lock = threading.Lock()
 
 DB_PATH = 'users.db'
 DB_TIMEOUT = 10.0
 
+LEDGER_BONUS = 'bonus'
+LEDGER_OPENING = 'opening'
+LEDGER_TOPUP = 'topup'
+LEDGER_DEBIT = 'debit'
+LEDGER_REFUND = 'refund'
+LEDGER_ADJUST = 'adjust'
+_MAX_ROWID = 2 ** 63 - 1
+
+PAYMENT_CREDITED = 'credited'
+PAYMENT_UNMATCHED = 'unmatched'
+
 def get_connection():
     if not hasattr(_local, 'connection') or _local.connection is None:
         _local.connection = sqlite3.connect(
@@ -66,18 +81,193 @@ def init_db():
                 CREATE INDEX IF NOT EXISTS idx_telegram_id ON users(telegram_id)
             ''')
             c.execute('''
-                CREATE INDEX IF NOT EXISTS idx_username ON users(username)
+                DROP INDEX IF EXISTS idx_username
+            ''')
+            c.execute('''
+                DROP INDEX IF EXISTS idx_users_username_nocase
+            ''')
+            c.execute('''
+                CREATE INDEX IF NOT EXISTS idx_users_username_active ON users(username COLLATE NOCASE, last_active, telegram_id)
+            ''')
+            c.execute('''
+                CREATE INDEX IF NOT EXISTS idx_users_blocked ON users(telegram_id) WHERE is_blocked=1
             ''')
             try:
                 c.execute('ALTER TABLE users ADD COLUMN used_requests INTEGER DEFAULT 0')
             except sqlite3.OperationalError:
                 pass
+            c.execute('''
+                UPDATE users SET last_active = COALESCE(join_date, '') WHERE last_active IS NULL
+            ''')
+            c.execute('''
+                CREATE INDEX IF NOT EXISTS idx_users_last_active ON users(last_active, id)
+            ''')
+            c.execute('''
+                CREATE INDEX IF NOT EXISTS idx_users_balance ON users(balance, id)
+            ''')
+            c.execute('''
+                CREATE INDEX IF NOT EXISTS idx_users_used_requests ON users(used_requests, id)
+            ''')
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS counters (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL
+                )
+            ''')
+            c.execute('''
+                INSERT OR IGNORE INTO counters (name, value) SELECT 'users', COUNT(*) FROM users
+            ''')
+            c.execute('''
+                CREATE TRIGGER IF NOT EXISTS trg_users_count_insert AFTER INSERT ON users
+                BEGIN
+                    UPDATE counters SET value = value + 1 WHERE name = 'users';
+                END
+            ''')
+            c.execute('''
+                CREATE TRIGGER IF NOT EXISTS trg_users_count_delete AFTER DELETE ON users
+                BEGIN
+                    UPDATE counters SET value = value - 1 WHERE name = 'users';
+                END
+            ''')
+            c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='users_fts'")
+            fts_exists = c.fetchone() is not None
+            c.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+                    username, first_name, last_name,
+                    content='users', content_rowid='id',
+                    tokenize='unicode61 remove_diacritics 2'
+                )
+            ''')
+            c.execute('''
+                CREATE TRIGGER IF NOT EXISTS trg_users_fts_insert AFTER INSERT ON users
+                BEGIN
+                    INSERT INTO users_fts(rowid, username, first_name, last_name)
+                    VALUES (new.id, new.username, new.first_name, new.last_name);
+                END
+            ''')
+            c.execute('''
+                CREATE TRIGGER IF NOT EXISTS trg_users_fts_delete AFTER DELETE ON users
+                BEGIN
+                    INSERT INTO users_fts(users_fts, rowid, username, first_name, last_name)
+                    VALUES ('delete', old.id, old.username, old.first_name, old.last_name);
+                END
+            ''')
+            c.execute('''
+                CREATE TRIGGER IF NOT EXISTS trg_users_fts_update AFTER UPDATE OF username, first_name, last_name ON users
+                WHEN old.username IS NOT new.username
+                    OR old.first_name IS NOT new.first_name
+                    OR old.last_name IS NOT new.last_name
+                BEGIN
+                    INSERT INTO users_fts(users_fts, rowid, username, first_name, last_name)
+                    VALUES ('delete', old.id, old.username, old.first_name, old.last_name);
+                    INSERT INTO users_fts(rowid, username, first_name, last_name)
+                    VALUES (new.id, new.username, new.first_name, new.last_name);
+                END
+            ''')
+            if not fts_exists:
+                c.execute("INSERT INTO users_fts(users_fts) VALUES ('rebuild')")
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS balance_holds (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    telegram_id BIGINT NOT NULL,
+                    amount INTEGER NOT NULL,
+                    created_at INTEGER NOT NULL,
+                    expires_at INTEGER NOT NULL
+                )
+            ''')
+            c.execute('''
+                CREATE INDEX IF NOT EXISTS idx_balance_holds_expires_at ON balance_holds(expires_at)
+            ''')
+            c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='balance_ledger'")
+            ledger_exists = c.fetchone() is not None
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS balance_ledger (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    telegram_id BIGINT NOT NULL,
+                    delta INTEGER NOT NULL,
+                    balance_after INTEGER NOT NULL,
+                    kind TEXT NOT NULL,
+                    reference TEXT,
+                    created_at INTEGER NOT NULL
+                )
+            ''')
+            c.execute('''
+                CREATE INDEX IF NOT EXISTS idx_balance_ledger_user ON balance_ledger(telegram_id, id)
+            ''')
+            c.execute('''
+                CREATE TRIGGER IF NOT EXISTS trg_balance_ledger_readonly BEFORE UPDATE ON balance_ledger
+                BEGIN
+                    SELECT RAISE(ABORT, 'balance_ledger is append-only');
+                END
+            ''')
+            c.execute('''
+                CREATE TRIGGER IF NOT EXISTS trg_balance_ledger_nodelete BEFORE DELETE ON balance_ledger
+                BEGIN
+                    SELECT RAISE(ABORT, 'balance_ledger is append-only');
+                END
+            ''')
+            c.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_users_ledger_bonus AFTER INSERT ON users
+                WHEN new.balance <> 0
+                BEGIN
+                    INSERT INTO balance_ledger (telegram_id, delta, balance_after, kind, created_at)
+                    VALUES (new.telegram_id, new.balance, new.balance, '{LEDGER_BONUS}', CAST(strftime('%s', 'now') AS INTEGER));
+                END
+            ''')
+            if not ledger_exists:
+                c.execute('''
+                    INSERT INTO balance_ledger (telegram_id, delta, balance_after, kind, created_at)
+                    SELECT telegram_id, balance, balance, ?, ? FROM users WHERE balance <> 0 ORDER BY id
+                ''', (LEDGER_OPENING, int(time.time())))
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS payment_cursors (
+                    account TEXT PRIMARY KEY,
+                    last_time INTEGER NOT NULL
+                )
+            ''')
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS processed_transactions (
+                    txn_id TEXT PRIMARY KEY,
+                    account TEXT NOT NULL,
+                    txn_time INTEGER NOT NULL,
+                    amount INTEGER NOT NULL,
+                    telegram_id BIGINT,
+                    status TEXT NOT NULL,
+                    processed_at INTEGER NOT NULL
+                )
+            ''')
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS user_threads (
+                    telegram_id BIGINT NOT NULL,
+                    service TEXT NOT NULL,
+                    thread_id TEXT NOT NULL,
+                    last_used INTEGER NOT NULL,
+                    PRIMARY KEY (telegram_id, service)
+                )
+            ''')
+            c.execute('''
+                CREATE INDEX IF NOT EXISTS idx_user_threads_last_used ON user_threads(last_used)
+            ''')
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS answer_cache (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    service TEXT NOT NULL,
+                    question_key TEXT NOT NULL,
+                    answer TEXT NOT NULL,
+                    signature BLOB NOT NULL,
+                    created_at INTEGER NOT NULL,
+                    UNIQUE (service, question_key)
+                )
+            ''')
+            c.execute('''
+                CREATE INDEX IF NOT EXISTS idx_answer_cache_created_at ON answer_cache(created_at)
+            ''')
         logger.info("База даних ініціалізована успішно")
     except Exception as e:
         logger.error(f"Помилка ініціалізації БД: {e}")
         raise
 
-def add_or_update_user(user):
+def upsert_user(user):
     if not user or not hasattr(user, 'id'):
         raise ValueError("Невірний об'єкт користувача")
     
@@ -85,45 +275,48 @@ def add_or_update_user(user):
         with db_transaction() as conn:
             c = conn.cursor()
             now = datetime.now().isoformat()
-            c.execute('SELECT telegram_id FROM users WHERE telegram_id=?', (user.id,))
-            exists = c.fetchone()
-            if not exists:
-                c.execute('''
-                    INSERT INTO users (telegram_id, username, first_name, last_name, join_date, last_active, balance)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    user.id,
-                    user.username,
-                    user.first_name,
-                    user.last_name,
-                    now,
-                    now,
-                    5
-                ))
-                return True
-            else:
-                c.execute('''
-                    UPDATE users SET
-                        username=?,
-                        first_name=?,
-                        last_name=?,
-                        last_active=?
-                    WHERE telegram_id=?
-                ''', (
-                    user.username,
-                    user.first_name,
-                    user.last_name,
-                    now,
-                    user.id
-                ))
-                return False
-    except sqlite3.IntegrityError as e:
-        logger.error(f"Помилка цілісності БД при додаванні користувача {user.id}: {e}")
-        raise
+            c.execute('''
+                INSERT INTO users (telegram_id, username, first_name, last_name, join_date, last_active, balance)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(telegram_id) DO UPDATE SET
+                    username=excluded.username,
+                    first_name=excluded.first_name,
+                    last_name=excluded.last_name,
+                    last_active=excluded.last_active
+                RETURNING *
+            ''', (
+                user.id,
+                user.username,
+                user.first_name,
+                user.last_name,
+                now,
+                now,
+                5
+            ))
+            row = c.fetchone()
+            return row, row['join_date'] == now
     except Exception as e:
         logger.error(f"Помилка при додаванні/оновленні користувача {user.id}: {e}")
         raise
 
+def update_users_activity(rows):
+    if not rows:
+        return 0
+    try:
+        with db_transaction() as conn:
+            conn.executemany('''
+                UPDATE users SET
+                    username=?,
+                    first_name=?,
+                    last_name=?,
+                    last_active=?
+                WHERE telegram_id=?
+            ''', rows)
+        return len(rows)
+    except Exception as e:
+        logger.error(f"Помилка пакетного оновлення активності користувачів: {e}")
+        raise
+
 def get_balance(telegram_id):
     try:
         conn = get_connection()
@@ -135,81 +328,250 @@ def get_balance(telegram_id):
         logger.error(f"Помилка отримання балансу для {telegram_id}: {e}")
         return 0
 
-def set_balance(telegram_id, new_balance):
+def _append_ledger(c, telegram_id, delta, balance_after, kind, reference=None):
+    c.execute('''
+        INSERT INTO balance_ledger (telegram_id, delta, balance_after, kind, reference, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (telegram_id, delta, balance_after, kind, reference, int(time.time())))
+
+def set_balance(telegram_id, new_balance, reference=None):
     if not isinstance(new_balance, int) or new_balance < 0:
         raise ValueError("Баланс повинен бути невід'ємним цілим числом")
     
     try:
         with db_transaction() as conn:
             c = conn.cursor()
+            c.execute('''
+                INSERT INTO balance_ledger (telegram_id, delta, balance_after, kind, reference, created_at)
+                SELECT telegram_id, ? - balance, ?, ?, ?, ? FROM users WHERE telegram_id=? AND balance <> ?
+            ''', (new_balance, new_balance, LEDGER_ADJUST, reference, int(time.time()), telegram_id, new_balance))
             c.execute('UPDATE users SET balance=? WHERE telegram_id=?', (new_balance, telegram_id))
     except Exception as e:
         logger.error(f"Помилка встановлення балансу для {telegram_id}: {e}")
         raise
 
-def add_balance(telegram_id, amount):
+def add_balance(telegram_id, amount, kind=LEDGER_TOPUP, reference=None):
     if not isinstance(amount, (int, float)) or amount <= 0:
         raise ValueError("Сума повинна бути додатним числом")
     
     try:
         with db_transaction() as conn:
             c = conn.cursor()
-            c.execute('''
-                UPDATE users 
-                SET balance = balance + ?, 
-                    last_payment_date=?, 
-                    total_payments = total_payments + ? 
-                WHERE telegram_id=?
-            ''', (int(amount), datetime.now().isoformat(), int(amount), telegram_id))
-            _invalidate_balance_cache(telegram_id)
+            return _credit_balance(c, telegram_id, int(amount), kind, reference)
     except Exception as e:
         logger.error(f"Помилка додавання балансу для {telegram_id}: {e}")
         raise
 
-def _invalidate_balance_cache(telegram_id):
+def _credit_balance(c, telegram_id, amount, kind, reference):
+    c.execute('''
+        UPDATE users 
+        SET balance = balance + ?, 
+            last_payment_date=?, 
+            total_payments = total_payments + ? 
+        WHERE telegram_id=?
+        RETURNING balance
+    ''', (amount, datetime.now().isoformat(), amount, telegram_id))
+    row = c.fetchone()
+    if row is None:
+        return None
+    _append_ledger(c, telegram_id, amount, row[0], kind, reference)
+    return row[0]
+
+def get_payment_cursor(account):
+    try:
+        conn = get_connection()
+        c = conn.cursor()
+        c.execute('SELECT last_time FROM payment_cursors WHERE account=?', (account,))
+        row = c.fetchone()
+        return row[0] if row else None
+    except Exception as e:
+        logger.error(f"Помилка отримання курсора виписки {account}: {e}")
+        raise
+
+def set_payment_cursor(account, last_time):
     try:
-        from additional_improvements import balance_cache
-        balance_cache.invalidate(telegram_id)
-    except ImportError:
-        pass
+        with db_transaction() as conn:
+            c = conn.cursor()
+            c.execute('''
+                INSERT INTO payment_cursors (account, last_time) VALUES (?, ?)
+                ON CONFLICT(account) DO UPDATE SET last_time=MAX(last_time, excluded.last_time)
+            ''', (account, int(last_time)))
+    except Exception as e:
+        logger.error(f"Помилка збереження курсора виписки {account}: {e}")
+        raise
+
+def get_processed_txn_ids(txn_ids):
+    if not txn_ids:
+        return set()
+    try:
+        conn = get_connection()
+        c = conn.cursor()
+        txn_ids = list(txn_ids)
+        c.execute(
+            f'SELECT txn_id FROM processed_transactions WHERE txn_id IN ({",".join("?" * len(txn_ids))})',
+            txn_ids
+        )
+        return {row[0] for row in c.fetchall()}
+    except Exception as e:
+        logger.error(f"Помилка перевірки оброблених транзакцій: {e}")
+        raise
 
-def subtract_balance(telegram_id, amount):
+def record_payments(credits, unmatched):
+    now = int(time.time())
+    credited = []
+    recorded = []
+    try:
+        with db_transaction() as conn:
+            c = conn.cursor()
+            for txn_id, account, txn_time, amount in unmatched:
+                c.execute('''
+                    INSERT INTO processed_transactions (txn_id, account, txn_time, amount, status, processed_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(txn_id) DO NOTHING
+                ''', (txn_id, account, int(txn_time), int(amount), PAYMENT_UNMATCHED, now))
+                if c.rowcount == 1:
+                    recorded.append(txn_id)
+            for txn_id, account, txn_time, amount, telegram_id, credit in credits:
+                c.execute('''
+                    INSERT INTO processed_transactions (txn_id, account, txn_time, amount, telegram_id, status, processed_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(txn_id) DO NOTHING
+                ''', (txn_id, account, int(txn_time), int(amount), telegram_id, PAYMENT_CREDITED, now))
+                if c.rowcount == 0:
+                    continue
+                balance = _credit_balance(c, telegram_id, int(credit), LEDGER_TOPUP, f"monobank:{txn_id}")
+                if balance is None:
+                    logger.warning(f"Користувач {telegram_id} не знайдений, платіж {txn_id} записано як незарахований")
+                    c.execute('UPDATE processed_transactions SET status=? WHERE txn_id=?', (PAYMENT_UNMATCHED, txn_id))
+                    recorded.append(txn_id)
+                    continue
+                credited.append((txn_id, telegram_id, balance))
+        return credited, recorded
+    except Exception as e:
+        logger.error(f"Помилка зарахування пакета платежів: {e}")
+        raise
+
+def subtract_balance(telegram_id, amount, kind=LEDGER_ADJUST, reference=None):
     if not isinstance(amount, (int, float)) or amount <= 0:
         raise ValueError("Сума повинна бути додатним числом")
     
     try:
         with db_transaction() as conn:
             c = conn.cursor()
-            c.execute('SELECT balance FROM users WHERE telegram_id=?', (telegram_id,))
-            row = c.fetchone()
-            if not row:
-                raise ValueError(f"Користувач {telegram_id} не знайдений")
-            
-            current_balance = row[0]
-            if current_balance < amount:
-                logger.warning(f"Недостатньо балансу для {telegram_id}: {current_balance} < {amount}")
-                raise ValueError(f"Недостатньо балансу: {current_balance} < {amount}")
-            
             c.execute('''
                 UPDATE users 
                 SET balance = balance - ?, 
                     used_requests = used_requests + ? 
                 WHERE telegram_id=? AND balance >= ?
+                RETURNING balance
             ''', (int(amount), int(amount), telegram_id, int(amount)))
-            
+            row = c.fetchone()
+            if row is None:
+                c.execute('SELECT balance FROM users WHERE telegram_id=?', (telegram_id,))
+                current = c.fetchone()
+                if current is None:
+                    raise ValueError(f"Користувач {telegram_id} не знайдений")
+                logger.warning(f"Недостатньо балансу для {telegram_id}: {current[0]} < {amount}")
+                raise ValueError(f"Недостатньо балансу: {current[0]} < {amount}")
+            _append_ledger(c, telegram_id, -int(amount), row[0], kind, reference)
+            return row[0]
+    except Exception as e:
+        logger.error(f"Помилка віднімання балансу для {telegram_id}: {e}")
+        raise
+
+def reserve_balance(telegram_id, amount, ttl_seconds):
+    if not isinstance(amount, int) or amount <= 0:
+        raise ValueError("Сума повинна бути додатним цілим числом")
+    
+    now = int(time.time())
+    try:
+        with db_transaction() as conn:
+            c = conn.cursor()
+            c.execute('''
+                UPDATE users
+                SET balance = balance - ?,
+                    used_requests = used_requests + ?
+                WHERE telegram_id=? AND balance >= ?
+                RETURNING balance
+            ''', (amount, amount, telegram_id, amount))
+            row = c.fetchone()
+            if row is None:
+                return None
+            c.execute('''
+                INSERT INTO balance_holds (telegram_id, amount, created_at, expires_at)
+                VALUES (?, ?, ?, ?)
+                RETURNING id
+            ''', (telegram_id, amount, now, now + ttl_seconds))
+            hold_id = c.fetchone()[0]
+            _append_ledger(c, telegram_id, -amount, row[0], LEDGER_DEBIT, f"hold:{hold_id}")
+            return hold_id, row[0]
+    except Exception as e:
+        logger.error(f"Помилка резервування балансу для {telegram_id}: {e}")
+        raise
+
+def commit_hold(hold_id):
+    try:
+        with db_transaction() as conn:
+            c = conn.cursor()
+            c.execute('DELETE FROM balance_holds WHERE id=?', (hold_id,))
             if c.rowcount == 0:
-                raise ValueError(f"Не вдалося списати баланс для {telegram_id}")
-            
+                logger.warning(f"Резерв {hold_id} вже повернуто, списання не зафіксовано")
+                return False
             return True
     except Exception as e:
-        logger.error(f"Помилка віднімання балансу для {telegram_id}: {e}")
+        logger.error(f"Помилка фіксації резерву {hold_id}: {e}")
         raise
 
+def _refund_hold(c, hold_id, telegram_id, amount):
+    c.execute('''
+        UPDATE users
+        SET balance = balance + ?,
+            used_requests = MAX(used_requests - ?, 0)
+        WHERE telegram_id=?
+        RETURNING balance
+    ''', (amount, amount, telegram_id))
+    row = c.fetchone()
+    if row is None:
+        return None
+    _append_ledger(c, telegram_id, amount, row[0], LEDGER_REFUND, f"hold:{hold_id}")
+    return row[0]
+
+def release_hold(hold_id):
+    try:
+        with db_transaction() as conn:
+            c = conn.cursor()
+            c.execute('DELETE FROM balance_holds WHERE id=? RETURNING telegram_id, amount', (hold_id,))
+            row = c.fetchone()
+            if row is None:
+                return None
+            return _refund_hold(c, hold_id, row[0], row[1])
+    except Exception as e:
+        logger.error(f"Помилка повернення резерву {hold_id}: {e}")
+        raise
+
+def release_expired_holds():
+    try:
+        with db_transaction() as conn:
+            c = conn.cursor()
+            c.execute(
+                'DELETE FROM balance_holds WHERE expires_at<? RETURNING id, telegram_id, amount',
+                (int(time.time()),)
+            )
+            rows = c.fetchall()
+            for hold_id, telegram_id, amount in rows:
+                _refund_hold(c, hold_id, telegram_id, amount)
+            return len(rows)
+    except Exception as e:
+        logger.error(f"Помилка повернення прострочених резервів: {e}")
+        return 0
+
 def block_user(telegram_id):
     try:
         with db_transaction() as conn:
             c = conn.cursor()
             c.execute('UPDATE users SET is_blocked=1 WHERE telegram_id=?', (telegram_id,))
+        with _blocked_lock:
+            _blocked_ids.add(telegram_id)
     except Exception as e:
         logger.error(f"Помилка блокування користувача {telegram_id}: {e}")
         raise
@@ -219,39 +581,89 @@ def unblock_user(telegram_id):
         with db_transaction() as conn:
             c = conn.cursor()
             c.execute('UPDATE users SET is_blocked=0 WHERE telegram_id=?', (telegram_id,))
+        with _blocked_lock:
+            _blocked_ids.discard(telegram_id)
     except Exception as e:
         logger.error(f"Помилка розблокування користувача {telegram_id}: {e}")
         raise
 
-def get_users_page(page=1, per_page=10):
-    if page < 1:
-        page = 1
+def load_blocked_ids():
+    global _blocked_ids
+    with _blocked_lock:
+        try:
+            conn = get_connection()
+            c = conn.cursor()
+            c.execute('SELECT telegram_id FROM users WHERE is_blocked=1')
+            blocked = {row[0] for row in c.fetchall()}
+        except Exception as e:
+            logger.error(f"Помилка завантаження заблокованих користувачів: {e}")
+            raise
+        changed = len(blocked ^ _blocked_ids)
+        _blocked_ids = blocked
+    return changed
+
+def is_blocked_id(telegram_id):
+    return telegram_id in _blocked_ids
+
+USER_SORTS = {
+    'j': ('id', 'ASC'),
+    'a': ('last_active', 'DESC'),
+    'b': ('balance', 'DESC'),
+    'u': ('used_requests', 'DESC')
+}
+
+def get_users_keyset_page(sort='j', direction='@', anchor_id=0, per_page=10):
+    if sort not in USER_SORTS:
+        sort = 'j'
     if per_page < 1 or per_page > 100:
         per_page = 10
     
+    key, order = USER_SORTS[sort]
+    backwards = direction == '<'
+    descending = (order == 'DESC') != backwards
+    columns = 'id' if key == 'id' else f'{key}, id'
+    params = []
+    where = ''
+    if anchor_id:
+        operator = '<' if descending else '>'
+        if direction == '@':
+            operator += '='
+        where = f'WHERE ({columns}) {operator} (SELECT {columns} FROM users WHERE id = ?)'
+        params.append(anchor_id)
+    sort_order = 'DESC' if descending else 'ASC'
+    order_by = f'id {sort_order}' if key == 'id' else f'{key} {sort_order}, id {sort_order}'
+    params.append(per_page + 1)
+    
     try:
         conn = get_connection()
         c = conn.cursor()
-        offset = (page - 1) * per_page
-        c.execute('''
-            SELECT telegram_id, username, first_name, last_name 
-            FROM users 
-            ORDER BY id 
-            LIMIT ? OFFSET ?
-        ''', (per_page, offset))
+        c.execute(f'''
+            SELECT telegram_id, username, first_name, last_name, id
+            FROM users
+            {where}
+            ORDER BY {order_by}
+            LIMIT ?
+        ''', params)
         users = c.fetchall()
-        return users
+        has_more = len(users) > per_page
+        users = users[:per_page]
+        if backwards:
+            users.reverse()
+        return users, has_more
     except Exception as e:
         logger.error(f"Помилка отримання сторінки користувачів: {e}")
-        return []
+        return [], False
 
 def get_total_users():
     try:
         conn = get_connection()
         c = conn.cursor()
-        c.execute('SELECT COUNT(*) FROM users')
-        count = c.fetchone()[0]
-        return count
+        c.execute("SELECT value FROM counters WHERE name = 'users'")
+        row = c.fetchone()
+        if row is None:
+            c.execute('SELECT COUNT(*) FROM users')
+            row = c.fetchone()
+        return row[0]
     except Exception as e:
         logger.error(f"Помилка підрахунку користувачів: {e}")
         return 0
@@ -263,13 +675,92 @@ def find_user_by_username(username):
     try:
         conn = get_connection()
         c = conn.cursor()
-        c.execute('SELECT telegram_id, username, first_name, last_name FROM users WHERE username=?', (username,))
+        c.execute('''
+            SELECT telegram_id, username, first_name, last_name FROM users
+            WHERE username=? COLLATE NOCASE
+            ORDER BY last_active DESC
+            LIMIT 1
+        ''', (username,))
         user = c.fetchone()
         return user
     except Exception as e:
         logger.error(f"Помилка пошуку користувача за username {username}: {e}")
         return None
 
+_SEARCH_TOKEN_RE = re.compile(r'\w+')
+SEARCH_MAX_TOKENS = 5
+SEARCH_MIN_PREFIX = 3
+SEARCH_MAX_CANDIDATES = 2000
+
+def build_search_query(text):
+    tokens = _SEARCH_TOKEN_RE.findall(text or '')[:SEARCH_MAX_TOKENS]
+    return ' '.join(f'"{token}"*' if len(token) >= SEARCH_MIN_PREFIX else f'"{token}"' for token in tokens)
+
+def search_users(text, limit=10, after=None):
+    match = build_search_query(text)
+    if not match:
+        return [], False, False
+    
+    where = ''
+    params = [match, SEARCH_MAX_CANDIDATES]
+    if after:
+        where = 'WHERE (matches.score, u.id) > (?, ?)'
+        params.extend(after)
+    params.append(limit + 1)
+    try:
+        conn = get_connection()
+        c = conn.cursor()
+        c.execute(f'''
+            SELECT u.telegram_id, u.username, u.first_name, u.last_name, u.id, matches.score
+            FROM (
+                SELECT rowid, bm25(users_fts, 2.0, 1.0, 1.0) AS score
+                FROM users_fts
+                WHERE users_fts MATCH ?
+                LIMIT ?
+            ) AS matches
+            JOIN users u ON u.id = matches.rowid
+            {where}
+            ORDER BY matches.score, u.id
+            LIMIT ?
+        ''', params)
+        users = c.fetchall()
+        c.execute('''
+            SELECT COUNT(*) FROM (SELECT 1 FROM users_fts WHERE users_fts MATCH ? LIMIT ?)
+        ''', (match, SEARCH_MAX_CANDIDATES + 1))
+        truncated = c.fetchone()[0] > SEARCH_MAX_CANDIDATES
+        return users[:limit], len(users) > limit, truncated
+    except Exception as e:
+        logger.error(f"Помилка повнотекстового пошуку користувачів '{text}': {e}")
+        return [], False, False
+
+def find_users_by_identifiers(usernames, telegram_ids):
+    usernames = list(usernames)
+    telegram_ids = list(telegram_ids)
+    by_username = {}
+    by_id = {}
+    if not usernames and not telegram_ids:
+        return by_username, by_id
+    
+    try:
+        conn = get_connection()
+        c = conn.cursor()
+        c.execute(f'''
+            SELECT telegram_id, username, last_active FROM users
+            WHERE username COLLATE NOCASE IN ({",".join("?" * len(usernames))})
+            UNION ALL
+            SELECT telegram_id, username, last_active FROM users
+            WHERE telegram_id IN ({",".join("?" * len(telegram_ids))})
+            ORDER BY last_active DESC
+        ''', usernames + telegram_ids)
+        for user in c.fetchall():
+            by_id.setdefault(user[0], user)
+            if user[1] is not None:
+                by_username.setdefault(user[1].lower(), user)
+        return by_username, by_id
+    except Exception as e:
+        logger.error(f"Помилка пакетного пошуку користувачів: {e}")
+        raise
+
 def find_user_by_id(telegram_id):
     if not isinstance(telegram_id, int) or telegram_id <= 0:
         return None
@@ -297,3 +788,124 @@ def get_user_full_info(telegram_id):
     except Exception as e:
         logger.error(f"Помилка отримання інформації про користувача {telegram_id}: {e}")
         return None
+
+def get_balance_history(telegram_id, before_id=0, limit=10):
+    try:
+        conn = get_connection()
+        c = conn.cursor()
+        c.execute('''
+            SELECT id, delta, balance_after, kind, reference, created_at
+            FROM balance_ledger
+            WHERE telegram_id=? AND id<?
+            ORDER BY id DESC
+            LIMIT ?
+        ''', (telegram_id, before_id or _MAX_ROWID, limit + 1))
+        rows = c.fetchall()
+        return rows[:limit], len(rows) > limit
+    except Exception as e:
+        logger.error(f"Помилка отримання історії балансу для {telegram_id}: {e}")
+        return [], False
+
+def get_user_thread(telegram_id, service, max_idle_seconds):
+    try:
+        conn = get_connection()
+        c = conn.cursor()
+        c.execute(
+            'SELECT thread_id FROM user_threads WHERE telegram_id=? AND service=? AND last_used>=?',
+            (telegram_id, service, int(time.time() - max_idle_seconds))
+        )
+        row = c.fetchone()
+        return row[0] if row else None
+    except Exception as e:
+        logger.error(f"Помилка отримання треду для {telegram_id}: {e}")
+        return None
+
+def save_user_thread(telegram_id, service, thread_id):
+    try:
+        with db_transaction() as conn:
+            c = conn.cursor()
+            c.execute('''
+                INSERT INTO user_threads (telegram_id, service, thread_id, last_used)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(telegram_id, service) DO UPDATE SET
+                    thread_id=excluded.thread_id,
+                    last_used=excluded.last_used
+            ''', (telegram_id, service, thread_id, int(time.time())))
+    except Exception as e:
+        logger.error(f"Помилка збереження треду для {telegram_id}: {e}")
+
+def delete_user_threads(telegram_id, service=None):
+    try:
+        with db_transaction() as conn:
+            c = conn.cursor()
+            if service is None:
+                c.execute('DELETE FROM user_threads WHERE telegram_id=?', (telegram_id,))
+            else:
+                c.execute('DELETE FROM user_threads WHERE telegram_id=? AND service=?', (telegram_id, service))
+    except Exception as e:
+        logger.error(f"Помилка видалення тредів для {telegram_id}: {e}")
+
+def purge_expired_threads(max_idle_seconds):
+    try:
+        with db_transaction() as conn:
+            c = conn.cursor()
+            c.execute('DELETE FROM user_threads WHERE last_used<?', (int(time.time() - max_idle_seconds),))
+            return c.rowcount
+    except Exception as e:
+        logger.error(f"Помилка очищення застарілих тредів: {e}")
+        return 0
+
+def load_cached_answers(max_age_seconds, limit):
+    try:
+        conn = get_connection()
+        c = conn.cursor()
+        c.execute('''
+            SELECT id, service, question_key, answer, signature, created_at
+            FROM answer_cache
+            WHERE created_at>=?
+            ORDER BY created_at DESC
+            LIMIT ?
+        ''', (int(time.time() - max_age_seconds), limit))
+        return c.fetchall()
+    except Exception as e:
+        logger.error(f"Помилка завантаження кешу відповідей: {e}")
+        return []
+
+def save_cached_answer(service, question_key, answer, signature, created_at):
+    try:
+        with db_transaction() as conn:
+            c = conn.cursor()
+            c.execute('''
+                INSERT INTO answer_cache (service, question_key, answer, signature, created_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(service, question_key) DO UPDATE SET
+                    answer=excluded.answer,
+                    signature=excluded.signature,
+                    created_at=excluded.created_at
+                RETURNING id
+            ''', (service, question_key, answer, signature, int(created_at)))
+            return c.fetchone()[0]
+    except Exception as e:
+        logger.error(f"Помилка збереження відповіді в кеш: {e}")
+        return None
+
+def delete_cached_answers(answer_ids):
+    if not answer_ids:
+        return
+    try:
+        with db_transaction() as conn:
+            c = conn.cursor()
+            c.executemany('DELETE FROM answer_cache WHERE id=?', [(answer_id,) for answer_id in answer_ids])
+    except Exception as e:
+        logger.error(f"Помилка видалення відповідей з кешу: {e}")
+
+def purge_expired_answers(max_age_seconds):
+    try:
+        with db_transaction() as conn:
+            c = conn.cursor()
+            c.execute('DELETE FROM answer_cache WHERE created_at<?', (int(time.time() - max_age_seconds),))
+            return c.rowcount
+    except Exception as e:
+        logger.error(f"Помилка очищення кешу відповідей: {e}")
+        return 0
+
@@ -2,11 +2,16 @@ import os
 import asyncio
 import logging
 import ssl
-from datetime import datetime, timedelta
-import aiohttp
+import time
+from aiohttp import web
 from dotenv import load_dotenv
-from db import add_balance, find_user_by_username, find_user_by_id, get_balance
-from aiogram import Bot
+from async_db import (
+    get_processed_txn_ids, record_payments, get_payment_cursor, set_payment_cursor,
+    find_users_by_identifiers
+)
+from aiogram.methods import SendMessage
+from send_queue import send_queue, PRIORITY_GROUP, PRIORITY_NOTIFY
+from resources import resources
 import re
 
 load_dotenv()
@@ -15,50 +20,60 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 MONOBANK_API_TOKEN = os.getenv('MONOBANK_API_TOKEN')
+MONOBANK_API_URL = 'https://api.monobank.ua'
 CHECK_INTERVAL = int(os.getenv('MONOBANK_CHECK_INTERVAL', '60'))
 CARD_NUMBER = os.getenv('MONOBANK_CARD_NUMBER', '4441114419905094')
 GROUP_CHAT_ID = int(os.getenv('GROUP_CHAT_ID', '-4647978421'))
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+MONOBANK_ACCOUNT = os.getenv('MONOBANK_ACCOUNT', '0')
+STATEMENT_OVERLAP = int(os.getenv('MONOBANK_STATEMENT_OVERLAP', '300'))
+STATEMENT_MAX_WINDOW = 31 * 24 * 3600 + 3600
+STATEMENT_PAGE_SIZE = 500
+STATEMENT_MIN_INTERVAL = 60
+MONOBANK_WEBHOOK_URL = os.getenv('MONOBANK_WEBHOOK_URL', '')
+MONOBANK_WEBHOOK_PATH = os.getenv('MONOBANK_WEBHOOK_PATH', '/monobank/webhook')
+MONOBANK_WEBHOOK_SECRET = os.getenv('MONOBANK_WEBHOOK_SECRET', '')
+MONOBANK_WEBHOOK_HOST = os.getenv('MONOBANK_WEBHOOK_HOST', '0.0.0.0')
+MONOBANK_WEBHOOK_PORT = int(os.getenv('MONOBANK_WEBHOOK_PORT', '8081'))
+RECONCILE_INTERVAL = int(os.getenv('MONOBANK_RECONCILE_INTERVAL', '900'))
 
-if not TELEGRAM_BOT_TOKEN:
-    logger.error("TELEGRAM_BOT_TOKEN не встановлено")
-    bot = None
-else:
-    bot = Bot(token=TELEGRAM_BOT_TOKEN)
+_last_statement_request = float('-inf')
+_statement_hint = asyncio.Event()
 
 ssl_context = ssl.create_default_context()
 ssl_context.check_hostname = False
 ssl_context.verify_mode = ssl.CERT_NONE
 
-async def get_monobank_transactions():
+async def get_monobank_transactions(from_time, to_time):
+    global _last_statement_request
     if not MONOBANK_API_TOKEN:
         logger.error("MONOBANK_API_TOKEN не встановлено")
-        return []
+        return None
 
     headers = {
         'X-Token': MONOBANK_API_TOKEN,
         'Content-Type': 'application/json'
     }
     
-    now = int(datetime.now().timestamp())
-    from_time = now - 60
+    delay = _last_statement_request + STATEMENT_MIN_INTERVAL - time.monotonic()
+    if delay > 0:
+        await asyncio.sleep(delay)
+    _last_statement_request = time.monotonic()
     
-    url = f'https://api.monobank.ua/personal/statement/0/{from_time}/{now}'
+    url = f'{MONOBANK_API_URL}/personal/statement/{MONOBANK_ACCOUNT}/{int(from_time)}/{int(to_time)}'
     
-    connector = aiohttp.TCPConnector(ssl=ssl_context)
-    async with aiohttp.ClientSession(connector=connector) as session:
-        try:
-            async with session.get(url, headers=headers) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    return data
-                else:
-                    error_text = await response.text()
-                    logger.error(f"Помилка отримання транзакцій: {response.status} - {error_text}")
-                    return []
-        except Exception as e:
-            logger.error(f"Помилка запиту до Monobank API: {e}")
-            return []
+    try:
+        async with resources.http.get(url, headers=headers, ssl=ssl_context) as response:
+            if response.status == 200:
+                data = await response.json()
+                return data
+            else:
+                error_text = await response.text()
+                logger.error(f"Помилка отримання транзакцій: {response.status} - {error_text}")
+                return None
+    except Exception as e:
+        logger.error(f"Помилка запиту до Monobank API: {e}")
+        return None
 
 def extract_user_identifier(comment):
     if not comment:
@@ -79,10 +94,7 @@ def extract_user_identifier(comment):
         return None, None
 
 async def notify_group(text: str):
-    try:
-        await bot.send_message(GROUP_CHAT_ID, text)
-    except Exception as e:
-        logging.error(f"Не вдалося надіслати повідомлення у групу: {e}")
+    send_queue.enqueue(SendMessage(chat_id=GROUP_CHAT_ID, text=text), priority=PRIORITY_GROUP)
 
 def is_valid_username(username):
     return bool(re.fullmatch(r'[A-Za-z0-9_]{5,32}', username))
@@ -90,96 +102,230 @@ def is_valid_username(username):
 def is_valid_user_id(user_id):
     return isinstance(user_id, int) and len(str(user_id)) >= 6
 
-async def notify_user_balance(user_id, amount):
-    try:
-        balance = get_balance(user_id)
-        text = (
-            f"Дякуємо! Ваш рахунок поповнено на {int(amount)} грн.\n"
-            f"Поточний баланс: {balance} запитів.\n"
-            f"Приємного користування!"
-        )
-        await bot.send_message(user_id, text)
-    except Exception as e:
-        logging.error(f"Не вдалося надіслати повідомлення користувачу {user_id}: {e}")
+def balance_notification(user_id, amount, balance):
+    text = (
+        f"Дякуємо! Ваш рахунок поповнено на {int(amount)} грн.\n"
+        f"Поточний баланс: {balance} запитів.\n"
+        f"Приємного користування!"
+    )
+    return SendMessage(chat_id=user_id, text=text)
+
+def format_payment_info(transaction):
+    comment = transaction.get('comment', '').strip()
+    sender = transaction.get('sender', '') or transaction.get('counterEdrpou', '') or transaction.get('description', '')
+    return (
+        f"💸 Новий платіж Monobank\n"
+        f"Сума: {transaction.get('amount', 0) / 100} грн\n"
+        f"Час: {transaction.get('time', '')}\n"
+        f"ID транзакції: {transaction.get('id', '')}\n"
+        f"Від кого: {sender}\n"
+        f"Опис: {transaction.get('description', '')}\n"
+        f"Коментар: {comment if comment else '-'}"
+    )
+
+def classify_payment(transaction):
+    comment = transaction.get('comment', '').strip()
+    if not comment:
+        return None, None, "❗️ Платіж без коментаря!\n"
+    identifier_type, identifier = extract_user_identifier(comment)
+    if identifier_type == 'username' and not is_valid_username(identifier):
+        return None, None, "❗️ Платіж з невалідним username!\n"
+    if identifier_type == 'id' and not is_valid_user_id(identifier):
+        return None, None, "❗️ Платіж з невалідним ID!\n"
+    if not (identifier_type and identifier):
+        logger.warning(f"Не вдалося визначити користувача для коментаря: {comment}")
+        return None, None, ''
+    return identifier_type, identifier, None
 
 async def process_transactions(transactions):
+    incoming = {}
     for transaction in transactions:
-        if transaction.get('amount', 0) > 0:
-            comment = transaction.get('comment', '').strip()
-            sender = transaction.get('sender', '') or transaction.get('counterEdrpou', '') or transaction.get('description', '')
-            amount = transaction.get('amount', 0) / 100
-            time_str = transaction.get('time', '')
-            description = transaction.get('description', '')
-            txn_id = transaction.get('id', '')
-            info_text = (
-                f"💸 Новий платіж Monobank\n"
-                f"Сума: {amount} грн\n"
-                f"Час: {time_str}\n"
-                f"ID транзакції: {txn_id}\n"
-                f"Від кого: {sender}\n"
-                f"Опис: {description}\n"
-                f"Коментар: {comment if comment else '-'}"
-            )
-            if not comment:
-                asyncio.create_task(notify_group(f"❗️ Платіж без коментаря!\n" + info_text))
-                continue
-            identifier_type, identifier = extract_user_identifier(comment)
-            if identifier_type == 'username' and not is_valid_username(identifier):
-                asyncio.create_task(notify_group(f"❗️ Платіж з невалідним username!\n" + info_text))
-                continue
-            if identifier_type == 'id' and not is_valid_user_id(identifier):
-                asyncio.create_task(notify_group(f"❗️ Платіж з невалідним ID!\n" + info_text))
-                continue
-            if identifier_type and identifier:
-                user = None
-                if identifier_type == 'username':
-                    user = find_user_by_username(identifier)
-                elif identifier_type == 'id':
-                    user = find_user_by_id(identifier)
-                
-                if user:
-                    amount = transaction.get('amount', 0) / 100
-                    if amount > 0:
-                        logger.info(f"Поповнення балансу користувача {identifier} на {amount} грн")
-                        add_balance(user[0], int(amount))
-                        asyncio.create_task(notify_user_balance(user[0], amount))
-                    else:
-                        logger.warning(f"Сума платежу менше або дорівнює 0 для користувача {identifier}")
-                else:
-                    logger.warning(f"Користувач {identifier} не знайдений в базі даних")
-                    asyncio.create_task(notify_group(f"❗️ Платіж з неіснуючим коментарем!\n" + info_text))
+        txn_id = transaction.get('id')
+        if txn_id and transaction.get('amount', 0) > 0:
+            incoming.setdefault(txn_id, transaction)
+    if not incoming:
+        return
+    for txn_id in await get_processed_txn_ids(incoming.keys()):
+        del incoming[txn_id]
+    if not incoming:
+        return
+
+    parsed = [(transaction, *classify_payment(transaction)) for transaction in incoming.values()]
+    usernames = {identifier for _, kind, identifier, _ in parsed if kind == 'username'}
+    telegram_ids = {identifier for _, kind, identifier, _ in parsed if kind == 'id'}
+    by_username, by_id = await find_users_by_identifiers(usernames, telegram_ids)
+
+    credits = []
+    unmatched = []
+    alerts = {}
+    for transaction, kind, identifier, reason in parsed:
+        txn_id = transaction['id']
+        amount = transaction['amount'] / 100
+        if reason is None:
+            user = by_username.get(identifier.lower()) if kind == 'username' else by_id.get(identifier)
+            if not user:
+                logger.warning(f"Користувач {identifier} не знайдений в базі даних")
+                reason = "❗️ Платіж з неіснуючим коментарем!\n"
+            elif int(amount) <= 0:
+                logger.warning(f"Сума платежу менше 1 грн для користувача {identifier}")
+                reason = "❗️ Платіж менше 1 грн!\n"
             else:
-                logger.warning(f"Не вдалося визначити користувача для коментаря: {comment}")
+                credits.append((txn_id, MONOBANK_ACCOUNT, transaction.get('time', 0), transaction['amount'], user[0], int(amount)))
+                alerts[txn_id] = "❗️ Платіж для видаленого користувача!\n" + format_payment_info(transaction)
+                continue
+        unmatched.append((txn_id, MONOBANK_ACCOUNT, transaction.get('time', 0), transaction['amount']))
+        if reason:
+            alerts[txn_id] = reason + format_payment_info(transaction)
+
+    credited, recorded = await record_payments(credits, unmatched)
+
+    for txn_id in recorded:
+        if txn_id in alerts:
+            await notify_group(alerts[txn_id])
+    for txn_id, user_id, balance in credited:
+        amount = incoming[txn_id]['amount'] / 100
+        logger.info(f"Поповнення балансу користувача {user_id} на {amount} грн")
+        send_queue.enqueue(balance_notification(user_id, amount, balance), priority=PRIORITY_NOTIFY)
+
+async def process_transaction(transaction):
+    await process_transactions([transaction])
 
-async def check_payments():
-    logger.info("Запущено перевірку платежів Monobank")
-    last_check_time = datetime.now() - timedelta(minutes=1)
+async def ingest_window(from_time, to_time):
+    upper = to_time
+    while True:
+        transactions = await get_monobank_transactions(from_time, upper)
+        if transactions is None:
+            return False
+        if transactions:
+            await process_transactions(transactions)
+        if len(transactions) < STATEMENT_PAGE_SIZE:
+            return True
+        oldest = min(t.get('time', upper) for t in transactions)
+        upper = oldest if oldest < upper else upper - 1
+
+async def sync_statement():
+    now = int(time.time())
+    cursor = await get_payment_cursor(MONOBANK_ACCOUNT)
+    if cursor is None:
+        from_time = now - CHECK_INTERVAL
+    else:
+        from_time = cursor - STATEMENT_OVERLAP
+    while from_time < now:
+        to_time = min(from_time + STATEMENT_MAX_WINDOW, now)
+        if to_time < now:
+            logger.info(f"Наздоганяємо виписку Monobank: {from_time}–{to_time}")
+        if not await ingest_window(from_time, to_time):
+            return False
+        await set_payment_cursor(MONOBANK_ACCOUNT, to_time)
+        from_time = to_time
+    return True
+
+async def check_payments(interval=CHECK_INTERVAL):
+    logger.info(f"Запущено перевірку платежів Monobank кожні {interval} с")
     
     while True:
+        _statement_hint.clear()
         try:
-            transactions = await get_monobank_transactions()
-            if transactions:
-                new_transactions = [
-                    t for t in transactions 
-                    if datetime.fromtimestamp(t.get('time', 0)) > last_check_time
-                ]
-                
-                if new_transactions:
-                    await process_transactions(new_transactions)
-            
-            last_check_time = datetime.now()
-            await asyncio.sleep(CHECK_INTERVAL)
-            
+            await sync_statement()
         except Exception as e:
             logger.error(f"Помилка при перевірці платежів: {e}")
-            await asyncio.sleep(CHECK_INTERVAL)
+        try:
+            await asyncio.wait_for(_statement_hint.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+
+def _webhook_path():
+    if not MONOBANK_WEBHOOK_SECRET:
+        raise ValueError("MONOBANK_WEBHOOK_SECRET не встановлено, вебхук Monobank не буде запущено")
+    return f"{MONOBANK_WEBHOOK_PATH.rstrip('/')}/{MONOBANK_WEBHOOK_SECRET}"
+
+def create_monobank_app(path=None):
+    path = path or _webhook_path()
+    
+    async def verify(request: web.Request) -> web.Response:
+        return web.Response(text='OK')
+    
+    async def handle_statement_item(request: web.Request) -> web.Response:
+        try:
+            payload = await request.json()
+        except Exception as e:
+            logger.warning(f"Некоректний вебхук Monobank: {e}")
+            return web.Response(status=400, text='Bad Request')
+        if not isinstance(payload, dict):
+            logger.warning(f"Некоректний вебхук Monobank: очікувався обʼєкт, отримано {type(payload).__name__}")
+            return web.Response(status=400, text='Bad Request')
+        if payload.get('type') != 'StatementItem':
+            return web.Response(text='OK')
+        data = payload.get('data') or {}
+        account = data.get('account')
+        if MONOBANK_ACCOUNT != '0' and account != MONOBANK_ACCOUNT:
+            return web.Response(text='OK')
+        transaction = data.get('statementItem')
+        if isinstance(transaction, dict) and transaction.get('amount', 0) > 0:
+            logger.info(f"Вебхук Monobank повідомив про платіж {transaction.get('id')}, звіряємо з випискою")
+            _statement_hint.set()
+        return web.Response(text='OK')
+    
+    app = web.Application()
+    app.router.add_get(path, verify)
+    app.router.add_post(path, handle_statement_item)
+    return app
+
+async def register_monobank_webhook(url):
+    headers = {'X-Token': MONOBANK_API_TOKEN}
+    async with resources.http.post(
+        f'{MONOBANK_API_URL}/personal/webhook',
+        headers=headers,
+        json={'webHookUrl': url},
+        ssl=ssl_context
+    ) as response:
+        if response.status != 200:
+            error_text = await response.text()
+            raise RuntimeError(f"Monobank не прийняв вебхук: {response.status} - {error_text}")
+
+async def run_monobank_webhook():
+    runner = web.AppRunner(create_monobank_app())
+    await runner.setup()
+    site = web.TCPSite(runner, MONOBANK_WEBHOOK_HOST, MONOBANK_WEBHOOK_PORT)
+    await site.start()
+    logger.info(f"Вебхук Monobank запущено на {MONOBANK_WEBHOOK_HOST}:{MONOBANK_WEBHOOK_PORT}")
+    return runner
 
 async def start_payment_checker():
     if not MONOBANK_API_TOKEN:
         logger.error("MONOBANK_API_TOKEN не знайдено в .env файлі")
         return
     
-    await check_payments()
+    if not MONOBANK_WEBHOOK_URL:
+        await check_payments()
+        return
+    if not MONOBANK_WEBHOOK_SECRET:
+        logger.error("MONOBANK_WEBHOOK_SECRET не встановлено, вебхук Monobank вимкнено, лишаємо опитування виписки")
+        await check_payments()
+        return
+    
+    runner = await run_monobank_webhook()
+    interval = RECONCILE_INTERVAL
+    try:
+        await register_monobank_webhook(MONOBANK_WEBHOOK_URL.rstrip('/') + _webhook_path())
+    except Exception as e:
+        logger.error(f"Не вдалося зареєструвати вебхук Monobank, лишаємо часте опитування: {e}")
+        interval = CHECK_INTERVAL
+    try:
+        await check_payments(interval)
+    finally:
+        await runner.cleanup()
+
+async def run_standalone():
+    if not TELEGRAM_BOT_TOKEN:
+        logger.error("TELEGRAM_BOT_TOKEN не встановлено")
+        return
+    send_queue.start(resources.bot)
+    try:
+        await start_payment_checker()
+    finally:
+        await send_queue.close()
+        await resources.close()
 
 if __name__ == "__main__":
-    asyncio.run(start_payment_checker()) 
\ No newline at end of file
+    asyncio.run(run_standalone()) 
\ No newline at end of file
@@ -1,11 +1,20 @@
 import os
 import logging
 import asyncio
-from openai import OpenAI
-from openai import RateLimitError, APIError
+import httpx
+from openai import AsyncOpenAI
+from openai import RateLimitError, APIError, APIStatusError, APIConnectionError
 from dotenv import load_dotenv
+from additional_improvements import (
+    thread_store, answer_cache, normalize_question, ANSWER_CACHE_ENABLED, THREAD_STORE_MAX_ENTRIES
+)
+from request_scheduler import request_scheduler, QueueCallback
+from quota_governor import quota_governor
+from resources import resources
 import re
-from typing import Optional, Tuple
+import heapq
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Dict, Optional, Set, Tuple
 from functools import lru_cache
 import time
 
@@ -20,14 +29,43 @@ FOOD_ASSISTANT_ID = os.getenv('FOOD_ASSISTANT_ID')
 SUPPLY_ASSISTANT_ID = os.getenv('SUPPLY_ASSISTANT_ID')
 
 MAX_RETRIES = 3
-RETRY_DELAY = 2
 MAX_MESSAGE_LENGTH = 4000
 
+OPENAI_MAX_CONNECTIONS = int(os.getenv('OPENAI_MAX_CONNECTIONS', '100'))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('OPENAI_MAX_KEEPALIVE_CONNECTIONS', '20'))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv('OPENAI_KEEPALIVE_EXPIRY', '30'))
+OPENAI_REQUEST_TIMEOUT = float(os.getenv('OPENAI_REQUEST_TIMEOUT', '60'))
+OPENAI_STREAMING = os.getenv('OPENAI_STREAMING', 'true').lower() in ('1', 'true', 'yes')
+STREAM_MAX_WAIT_TIME = 90
+RUN_MAX_WAIT_TIME = 60
+RUN_POLL_MAX_RATE = float(os.getenv('OPENAI_RUN_POLL_MAX_RATE', '5'))
+RUN_POLL_MIN_INTERVAL = 1.0
+RUN_POLL_MAX_INTERVAL = 8.0
+RUN_POLL_MAX_ERRORS = 5
+PENDING_EXCHANGES_PER_THREAD = 5
+
+def create_http_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY
+        ),
+        timeout=httpx.Timeout(OPENAI_REQUEST_TIMEOUT, connect=10.0),
+        follow_redirects=True,
+        event_hooks={
+            'request': [quota_governor.on_request],
+            'response': [quota_governor.on_response]
+        }
+    )
+
+def create_openai_client() -> AsyncOpenAI:
+    return AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=create_http_client(), max_retries=0)
+
 if not OPENAI_API_KEY:
     logger.error("OPENAI_API_KEY не встановлено")
-    client = None
 else:
-    client = OpenAI(api_key=OPENAI_API_KEY)
+    resources.set_openai_factory(create_openai_client)
 
 SERVICE_ASSISTANTS = {
     "⛽️ ПММ": PMM_ASSISTANT_ID,
@@ -35,7 +73,22 @@ SERVICE_ASSISTANTS = {
     "👕 Речова": SUPPLY_ASSISTANT_ID
 }
 
-user_threads: dict[int, str] = {}
+_SUSPICIOUS_RE = re.compile(r'<script|javascript:|onerror=|onload=', re.IGNORECASE)
+
+_CIRCLED_NUMBERS = {chr(ord('①') + i): f'{i + 1}.' for i in range(10)}
+_CITATION_RE = re.compile(r'\[(?:\d+(?::\d+)?†?(?:source|джерело)?\.?|(?:\d+:)?\d*[①-⑩])\]|【.*?】|[①-⑩]')
+_CLEANUP_RE = re.compile(
+    r'[\[【①-⑩*]'
+    r'(?:(?<=\[)(?:\d+(?::\d+)?†?(?:source|джерело)?\.?|(?:\d+:)?\d*[①-⑩])\]'
+    r'|(?<=【).*?】'
+    r'|(?<=[①-⑩])'
+    r'|(?<=\*)\*(?P<bold>.*?)\*\*)'
+)
+_LINE_START_RE = re.compile(r'(\n(?=[\s\-\d•])\s*(?:(?:-|\d+\.)\s*)*)(?=([•\d])?)')
+_LIST_MARKER_RE = re.compile(r'(-|\d+\.)')
+_UNDERLINE_RE = re.compile(r'__(.*?)__')
+_SPACES_RE = re.compile(r'  +')
+_BLANK_LINES_RE = re.compile(r'\n{3,}')
 
 def validate_message(message: str) -> Tuple[bool, Optional[str]]:
     if not message or not isinstance(message, str):
@@ -47,151 +100,574 @@ def validate_message(message: str) -> Tuple[bool, Optional[str]]:
     if len(message) > MAX_MESSAGE_LENGTH:
         return False, f"Повідомлення занадто довге (максимум {MAX_MESSAGE_LENGTH} символів)"
     
-    suspicious_patterns = [
-        r'<script',
-        r'javascript:',
-        r'onerror=',
-        r'onload=',
-    ]
-    for pattern in suspicious_patterns:
-        if re.search(pattern, message, re.IGNORECASE):
-            return False, "Повідомлення містить недозволені символи"
+    if ('<' in message or ':' in message or '=' in message) and _SUSPICIOUS_RE.search(message):
+        return False, "Повідомлення містить недозволені символи"
     
     return True, None
 
+def _replace_circled(match: re.Match) -> str:
+    return _CIRCLED_NUMBERS.get(match.group(), '')
+
+def _cleanup(match: re.Match) -> str:
+    if match.lastgroup == 'bold':
+        return f"*{_CITATION_RE.sub(_replace_circled, match.group('bold'))}*"
+    return _replace_circled(match)
+
+def _starts_list(char: str) -> bool:
+    return char == '•' or char.isdecimal()
+
+def _line_start_marks(gaps: list, marks: list, is_marker: Callable[[str], bool]) -> list:
+    matched = []
+    for i, mark in enumerate(marks):
+        if matched and matched[-1]:
+            line_start = gaps[i].endswith('\n')
+        else:
+            line_start = '\n' in gaps[i]
+        matched.append(line_start and is_marker(mark))
+    return matched
+
+@lru_cache(maxsize=1024)
+def _format_line_start(block: str, list_start: Optional[str]) -> str:
+    parts = _LIST_MARKER_RE.split(block)
+    gaps, marks = parts[0::2], parts[1::2]
+    if marks:
+        bullets = _line_start_marks(gaps, marks, lambda mark: mark == '-')
+        for i, bullet in enumerate(bullets):
+            if bullet:
+                if not (i and bullets[i - 1]):
+                    gaps[i] = gaps[i][:gaps[i].index('\n') + 1]
+                marks[i] = '•'
+                gaps[i + 1] = ' '
+        numbers = _line_start_marks(gaps, marks, lambda mark: mark[-1] == '.')
+        for i, number in enumerate(numbers):
+            if number:
+                gaps[i + 1] += ' '
+    result = []
+    for i, gap in enumerate(gaps):
+        if gap.endswith('\n') and (_starts_list(marks[i][0]) if i < len(marks) else list_start is not None):
+            gap += '\n'
+        if '  ' in gap:
+            gap = _SPACES_RE.sub(' ', gap)
+        if '\n\n\n' in gap:
+            gap = _BLANK_LINES_RE.sub('\n\n', gap)
+        result.append(gap)
+        if i < len(marks):
+            result.append(marks[i])
+    return ''.join(result)
+
+def _format_line(match: re.Match) -> str:
+    return _format_line_start(*match.groups())
+
 def format_markdown(text: str) -> str:
     if not text:
         return ""
     
-    circled_numbers = {
-        '①': '1.', '②': '2.', '③': '3.', '④': '4.', '⑤': '5.', 
-        '⑥': '6.', '⑦': '7.', '⑧': '8.', '⑨': '9.', '⑩': '10.'
-    }
-    for k, v in circled_numbers.items():
-        text = text.replace(k, v)
-
-    text = re.sub(r'\[\d+(:\d+)?[†]?(source|джерело)?\.?\]', '', text)
-    text = re.sub(r'\[\d+\]', '', text)
-    text = re.sub(r'【.*?】', '', text)
-
-    text = re.sub(r'\*\*(.*?)\*\*', r'*\1*', text)
-    text = re.sub(r'__(.*?)__', r'_\1_', text)
-    text = re.sub(r'^\s*-\s*', '• ', text, flags=re.MULTILINE)
-    text = re.sub(r'^\s*\d+\.\s*', lambda m: f"{m.group(0)} ", text, flags=re.MULTILINE)
-    text = re.sub(r'\n([•\d])', r'\n\n\1', text)
-    text = re.sub(r' +', ' ', text)
-    text = re.sub(r'\n{3,}', '\n\n', text)
-    text = text.strip()
-    return text
+    text = _CLEANUP_RE.sub(_cleanup, text)
+    if '__' in text:
+        text = _UNDERLINE_RE.sub(r'_\1_', text)
+    text = _LINE_START_RE.sub(_format_line, '\n' + text)
+    if '  ' in text:
+        text = _SPACES_RE.sub(' ', text)
+    return text.strip()
 
-async def get_service_response(
-    service_name: str, 
-    user_message: str, 
-    user_id: int,
-    retry_count: int = 0
+class _PendingRun:
+    __slots__ = ('thread_id', 'run_id', 'started', 'future', 'errors')
+    
+    def __init__(self, thread_id: str, run_id: str, started: float, future: asyncio.Future):
+        self.thread_id = thread_id
+        self.run_id = run_id
+        self.started = started
+        self.future = future
+        self.errors = 0
+
+class RunMultiplexer:
+    
+    TERMINAL_STATUSES = ('completed', 'failed', 'cancelled', 'expired', 'incomplete', 'requires_action')
+    
+    def __init__(
+        self,
+        max_poll_rate: float = RUN_POLL_MAX_RATE,
+        min_interval: float = RUN_POLL_MIN_INTERVAL,
+        max_interval: float = RUN_POLL_MAX_INTERVAL
+    ):
+        self.max_poll_rate = max_poll_rate
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.pending: Dict[str, _PendingRun] = {}
+        self.durations: deque = deque(maxlen=200)
+        self.polls_total = 0
+        self.poll_times: deque = deque()
+        self._schedule: list = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._polls: Set[asyncio.Task] = set()
+    
+    def _next_interval(self, age: float) -> float:
+        if len(self.durations) >= 5:
+            ordered = sorted(self.durations)
+            early = ordered[len(ordered) // 4]
+            if age < early:
+                return max(self.min_interval, early - age)
+        return min(self.max_interval, max(self.min_interval, age * 0.25))
+    
+    def _schedule_poll(self, pending: _PendingRun, now: float):
+        delay = self._next_interval(now - pending.started)
+        heapq.heappush(self._schedule, (now + delay, pending.run_id))
+        if self._wakeup:
+            self._wakeup.set()
+    
+    async def wait(self, thread_id: str, run_id: str, timeout: float = RUN_MAX_WAIT_TIME):
+        loop = asyncio.get_running_loop()
+        pending = _PendingRun(thread_id, run_id, loop.time(), loop.create_future())
+        pending.future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.pending[run_id] = pending
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        self._schedule_poll(pending, pending.started)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        try:
+            return await asyncio.wait_for(asyncio.shield(pending.future), timeout=timeout)
+        finally:
+            self.pending.pop(run_id, None)
+            if not pending.future.done():
+                pending.future.cancel()
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        min_gap = 1.0 / self.max_poll_rate
+        while self.pending:
+            while self._schedule and self._schedule[0][1] not in self.pending:
+                heapq.heappop(self._schedule)
+            if not self._schedule:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.max_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            due_at, run_id = self._schedule[0]
+            now = loop.time()
+            if due_at > now:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=due_at - now)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            heapq.heappop(self._schedule)
+            pending = self.pending.get(run_id)
+            if pending and not pending.future.done():
+                task = asyncio.create_task(self._poll(pending))
+                self._polls.add(task)
+                task.add_done_callback(self._polls.discard)
+                await asyncio.sleep(min_gap)
+    
+    async def _poll(self, pending: _PendingRun):
+        loop = asyncio.get_running_loop()
+        self.polls_total += 1
+        self.poll_times.append(time.monotonic())
+        try:
+            run = await resources.openai.beta.threads.runs.retrieve(
+                thread_id=pending.thread_id,
+                run_id=pending.run_id
+            )
+        except Exception as e:
+            pending.errors += 1
+            logger.warning(f"Помилка опитування запуску {pending.run_id} ({pending.errors}): {e}")
+            if pending.errors >= RUN_POLL_MAX_ERRORS:
+                if not pending.future.done():
+                    pending.future.set_exception(e)
+                return
+            self._schedule_poll(pending, loop.time())
+            return
+        
+        if run.status in self.TERMINAL_STATUSES:
+            self.durations.append(loop.time() - pending.started)
+            if not pending.future.done():
+                pending.future.set_result(run)
+            return
+        self._schedule_poll(pending, loop.time())
+    
+    async def close(self):
+        tasks = list(self._polls)
+        if self._task is not None:
+            tasks.append(self._task)
+            self._task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for pending in self.pending.values():
+            if not pending.future.done():
+                pending.future.cancel()
+    
+    def get_stats(self) -> Dict:
+        now = time.monotonic()
+        while self.poll_times and now - self.poll_times[0] > 60:
+            self.poll_times.popleft()
+        ordered = sorted(self.durations)
+        return {
+            'pending_runs': len(self.pending),
+            'polls_total': self.polls_total,
+            'poll_rate': round(len(self.poll_times) / 60, 2),
+            'max_poll_rate': self.max_poll_rate,
+            'median_completion': round(ordered[len(ordered) // 2], 1) if ordered else None
+        }
+
+run_multiplexer = RunMultiplexer()
+
+async def _call_with_retries(fn: Callable[[], Awaitable], user_id: int):
+    attempt = 0
+    while True:
+        try:
+            return await fn()
+        except RateLimitError:
+            if attempt >= MAX_RETRIES:
+                raise
+            logger.warning(f"Rate limit досягнуто для користувача {user_id}, спроба {attempt + 1}")
+        except APIStatusError as e:
+            if attempt >= MAX_RETRIES or e.status_code < 500:
+                raise
+            logger.warning(f"Помилка сервера OpenAI {e.status_code} для користувача {user_id}, спроба {attempt + 1}")
+        except APIConnectionError as e:
+            if attempt >= MAX_RETRIES:
+                raise
+            logger.warning(f"Помилка зʼєднання з OpenAI для користувача {user_id}, спроба {attempt + 1}: {e}")
+        await asyncio.sleep(quota_governor.retry_delay(attempt))
+        attempt += 1
+
+async def _cancel_run(thread_id: str, run_id: str):
+    try:
+        await resources.openai.beta.threads.runs.cancel(run_id=run_id, thread_id=thread_id)
+    except Exception as e:
+        logger.warning(f"Не вдалося скасувати запуск {run_id} для треду {thread_id}: {e}")
+
+async def _wait_run_polling(thread_id: str, assistant_id: str, user_id: int) -> str:
+    run = await _call_with_retries(
+        lambda: resources.openai.beta.threads.runs.create(
+            thread_id=thread_id,
+            assistant_id=assistant_id
+        ),
+        user_id
+    )
+    logger.info(f"Запущено асистента {assistant_id} для треду {thread_id}")
+    
+    try:
+        run_status = await run_multiplexer.wait(thread_id, run.id)
+    except asyncio.TimeoutError:
+        logger.error(f"Таймаут очікування відповіді для треду {thread_id}")
+        await _cancel_run(thread_id, run.id)
+        return "❌ Помилка: час очікування відповіді перевищено. Спробуйте пізніше."
+    
+    if run_status.status == 'completed':
+        logger.info(f"Асистент завершив роботу для треду {thread_id}")
+    else:
+        error_msg = getattr(run_status, 'last_error', None) or getattr(run_status, 'incomplete_details', None)
+        logger.error(f"Помилка виконання: {run_status.status}, деталі: {error_msg}")
+        if run_status.status == 'requires_action':
+            await _cancel_run(thread_id, run.id)
+        return "❌ Помилка при отриманні відповіді від асистента."
+    
+    messages = await _call_with_retries(
+        lambda: resources.openai.beta.threads.messages.list(
+            thread_id=thread_id,
+            order="desc",
+            limit=1
+        ),
+        user_id
+    )
+    
+    if messages.data and messages.data[0].role == 'assistant':
+        response = messages.data[0].content[0].text.value
+        logger.info(f"Отримано відповідь від асистента для треду {thread_id}")
+        return format_markdown(response)
+    
+    logger.error(f"Не знайдено відповіді асистента в треді {thread_id}")
+    return "❌ Не вдалося отримати відповідь від асистента."
+
+async def _consume_run_stream(
+    thread_id: str,
+    assistant_id: str,
+    on_progress: Callable[[str], Awaitable[None]],
+    user_id: int
 ) -> str:
-    if not client:
-        logger.error("OpenAI клієнт не ініціалізований")
-        return "❌ Помилка: сервіс тимчасово недоступний."
+    stream = await _call_with_retries(
+        lambda: resources.openai.beta.threads.runs.create(
+            thread_id=thread_id,
+            assistant_id=assistant_id,
+            stream=True
+        ),
+        user_id
+    )
+    logger.info(f"Запущено потокову відповідь асистента {assistant_id} для треду {thread_id}")
     
-    is_valid, error_msg = validate_message(user_message)
-    if not is_valid:
-        logger.warning(f"Невалідне повідомлення від користувача {user_id}: {error_msg}")
-        return f"❌ {error_msg}"
+    response = ""
+    async with stream:
+        async for event in stream:
+            if event.event == 'thread.message.delta':
+                for block in event.data.delta.content or []:
+                    if block.type == 'text' and block.text and block.text.value:
+                        response += block.text.value
+                try:
+                    await on_progress(response)
+                except Exception as e:
+                    logger.warning(f"Помилка оновлення прогресу для треду {thread_id}: {e}")
+            elif event.event in (
+                'thread.run.failed', 'thread.run.cancelled', 'thread.run.expired',
+                'thread.run.incomplete', 'thread.run.requires_action'
+            ):
+                error_msg = getattr(event.data, 'last_error', None) or getattr(event.data, 'incomplete_details', None)
+                logger.error(f"Помилка виконання: {event.event}, деталі: {error_msg}")
+                if event.event == 'thread.run.requires_action':
+                    await _cancel_run(thread_id, event.data.id)
+                return "❌ Помилка при отриманні відповіді від асистента."
+            elif event.event == 'error':
+                logger.error(f"Помилка потоку для треду {thread_id}: {event.data}")
+                return "❌ Помилка при отриманні відповіді від асистента."
+    
+    if not response:
+        logger.error(f"Не знайдено відповіді асистента в треді {thread_id}")
+        return "❌ Не вдалося отримати відповідь від асистента."
     
+    logger.info(f"Отримано потокову відповідь від асистента для треду {thread_id}")
+    return format_markdown(response)
+
+async def _request_service_response(
+    service_name: str,
+    assistant_id: str,
+    user_message: str,
+    user_id: int,
+    on_progress: Optional[Callable[[str], Awaitable[None]]] = None
+) -> str:
     try:
-        assistant_id = SERVICE_ASSISTANTS.get(service_name)
-        if not assistant_id:
-            logger.error(f"Не знайдено ID асистента для служби: {service_name}")
-            return "❌ Помилка: не знайдено відповідного асистента для цієї служби."
-
-        thread_id = None
-        if user_id in user_threads:
-            thread_id = user_threads[user_id]
+        thread_id = await thread_store.get(user_id, service_name)
+        if thread_id:
             logger.info(f"Використовуємо існуючий тред {thread_id} для користувача {user_id}")
         else:
-            thread = client.beta.threads.create()
+            thread = await _call_with_retries(lambda: resources.openai.beta.threads.create(), user_id)
             thread_id = thread.id
-            user_threads[user_id] = thread_id
             logger.info(f"Створено новий тред {thread_id} для користувача {user_id}")
+        await thread_store.set(user_id, service_name, thread_id)
+        await _seed_exchanges(thread_id, service_name, user_id)
         
-        message = client.beta.threads.messages.create(
-            thread_id=thread_id,
-            role="user",
-            content=user_message
+        message = await _call_with_retries(
+            lambda: resources.openai.beta.threads.messages.create(
+                thread_id=thread_id,
+                role="user",
+                content=user_message
+            ),
+            user_id
         )
         logger.info(f"Додано повідомлення користувача до треду {thread_id}")
         
-        run = client.beta.threads.runs.create(
-            thread_id=thread_id,
-            assistant_id=assistant_id
-        )
-        logger.info(f"Запущено асистента {assistant_id} для треду {thread_id}")
-        
-        max_wait_time = 60
-        start_time = time.time()
-        
-        while True:
-            if time.time() - start_time > max_wait_time:
-                logger.error(f"Таймаут очікування відповіді для треду {thread_id}")
+        if on_progress and OPENAI_STREAMING:
+            try:
+                return await asyncio.wait_for(
+                    _consume_run_stream(thread_id, assistant_id, on_progress, user_id),
+                    timeout=STREAM_MAX_WAIT_TIME
+                )
+            except asyncio.TimeoutError:
+                logger.error(f"Таймаут потокової відповіді для треду {thread_id}")
                 return "❌ Помилка: час очікування відповіді перевищено. Спробуйте пізніше."
-            
-            run_status = client.beta.threads.runs.retrieve(
-                thread_id=thread_id,
-                run_id=run.id
-            )
-            
-            if run_status.status == 'completed':
-                logger.info(f"Асистент завершив роботу для треду {thread_id}")
-                break
-            elif run_status.status in ['failed', 'cancelled', 'expired']:
-                error_msg = getattr(run_status, 'last_error', None)
-                logger.error(f"Помилка виконання: {run_status.status}, деталі: {error_msg}")
-                return "❌ Помилка при отриманні відповіді від асистента."
-            
-            await asyncio.sleep(1)
-        
-        messages = client.beta.threads.messages.list(
-            thread_id=thread_id,
-            order="desc",
-            limit=1
-        )
         
-        if messages.data and messages.data[0].role == 'assistant':
-            response = messages.data[0].content[0].text.value
-            logger.info(f"Отримано відповідь від асистента для треду {thread_id}")
-            
-            formatted_response = format_markdown(response)
-            return formatted_response
-        
-        logger.error(f"Не знайдено відповіді асистента в треді {thread_id}")
-        return "❌ Не вдалося отримати відповідь від асистента."
+        return await _wait_run_polling(thread_id, assistant_id, user_id)
         
     except RateLimitError as e:
-        logger.warning(f"Rate limit досягнуто для користувача {user_id}, спроба {retry_count + 1}")
-        if retry_count < MAX_RETRIES:
-            wait_time = RETRY_DELAY * (2 ** retry_count)
-            await asyncio.sleep(wait_time)
-            return await get_service_response(service_name, user_message, user_id, retry_count + 1)
+        logger.warning(f"Rate limit досягнуто для користувача {user_id}, спроби вичерпано")
         return "❌ Перевищено ліміт запитів. Спробуйте через кілька хвилин."
     
     except APIError as e:
         logger.error(f"Помилка OpenAI API для користувача {user_id}: {e}")
-        if retry_count < MAX_RETRIES and e.status_code and e.status_code >= 500:
-            wait_time = RETRY_DELAY * (2 ** retry_count)
-            await asyncio.sleep(wait_time)
-            return await get_service_response(service_name, user_message, user_id, retry_count + 1)
         return "❌ Помилка при обробці запиту. Спробуйте пізніше або зверніться до оператора."
     
     except Exception as e:
         logger.error(f"Неочікувана помилка при роботі з OpenAI API для користувача {user_id}: {e}", exc_info=True)
         return "❌ Помилка при обробці запиту. Спробуйте пізніше або зверніться до оператора."
 
-def clear_user_thread(user_id: int):
-    if user_id in user_threads:
-        thread_id = user_threads[user_id]
+class _Flight:
+    __slots__ = ('future', 'listeners')
+    
+    def __init__(self, future: asyncio.Future):
+        self.future = future
+        self.listeners: list = []
+    
+    async def broadcast(self, text: str):
+        results = await asyncio.gather(
+            *(listener(text) for listener in list(self.listeners)),
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                logger.warning(f"Помилка оновлення прогресу: {result}")
+
+class SingleFlight:
+    
+    def __init__(self):
+        self.flights: Dict[Tuple[str, str], _Flight] = {}
+        self.leaders = 0
+        self.coalesced = 0
+    
+    async def do(
+        self,
+        key: Tuple[str, str],
+        fn: Callable[[Callable[[str], Awaitable[None]]], Awaitable[str]],
+        on_progress: Optional[Callable[[str], Awaitable[None]]] = None
+    ) -> str:
+        while key in self.flights:
+            flight = self.flights[key]
+            self.coalesced += 1
+            if on_progress:
+                flight.listeners.append(on_progress)
+            try:
+                return await asyncio.shield(flight.future)
+            except asyncio.CancelledError:
+                if not flight.future.cancelled():
+                    raise
+                logger.info(f"Запит-лідер скасовано, повторюємо запит для {key[0]}")
+            finally:
+                if on_progress in flight.listeners:
+                    flight.listeners.remove(on_progress)
+        
+        flight = _Flight(asyncio.get_running_loop().create_future())
+        flight.future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        if on_progress:
+            flight.listeners.append(on_progress)
+        self.flights[key] = flight
+        self.leaders += 1
+        try:
+            result = await fn(flight.broadcast)
+            flight.future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            flight.future.cancel()
+            raise
+        except Exception as e:
+            flight.future.set_exception(e)
+            raise
+        finally:
+            del self.flights[key]
+    
+    def get_stats(self) -> Dict:
+        return {
+            'in_flight': len(self.flights),
+            'leaders': self.leaders,
+            'coalesced': self.coalesced
+        }
+
+single_flight = SingleFlight()
+
+async def get_service_response(
+    service_name: str, 
+    user_message: str, 
+    user_id: int,
+    on_progress: Optional[Callable[[str], Awaitable[None]]] = None,
+    on_queue: Optional[QueueCallback] = None
+) -> str:
+    if resources.openai is None:
+        logger.error("OpenAI клієнт не ініціалізований")
+        return "❌ Помилка: сервіс тимчасово недоступний."
+    
+    is_valid, error_msg = validate_message(user_message)
+    if not is_valid:
+        logger.warning(f"Невалідне повідомлення від користувача {user_id}: {error_msg}")
+        return f"❌ {error_msg}"
+    
+    assistant_id = SERVICE_ASSISTANTS.get(service_name)
+    if not assistant_id:
+        logger.error(f"Не знайдено ID асистента для служби: {service_name}")
+        return "❌ Помилка: не знайдено відповідного асистента для цієї служби."
+
+    normalized = normalize_question(user_message)
+    if not answer_cache.is_cacheable(normalized):
+        return await _run_scheduled(service_name, assistant_id, user_message, user_id, on_progress, on_queue)
+
+    if ANSWER_CACHE_ENABLED:
+        cached_answer = await answer_cache.get(service_name, user_message)
+        if cached_answer:
+            logger.info(f"Відповідь для користувача {user_id} взято з кешу ({service_name})")
+            _defer_exchange(service_name, user_id, user_message, cached_answer)
+            return cached_answer
+
+    led = False
+
+    async def request(broadcast: Callable[[str], Awaitable[None]]) -> str:
+        nonlocal led
+        led = True
+        response = await _run_scheduled(
+            service_name, assistant_id, user_message, user_id,
+            broadcast if on_progress else None, on_queue
+        )
+        if ANSWER_CACHE_ENABLED and not response.startswith("❌"):
+            await answer_cache.put(service_name, user_message, response)
+        return response
+
+    try:
+        response = await single_flight.do((service_name, normalized), request, on_progress)
+    except Exception as e:
+        logger.error(f"Неочікувана помилка при роботі з OpenAI API для користувача {user_id}: {e}", exc_info=True)
+        return "❌ Помилка при обробці запиту. Спробуйте пізніше або зверніться до оператора."
+    if not led and not response.startswith("❌"):
+        _defer_exchange(service_name, user_id, user_message, response)
+    return response
+
+async def _run_scheduled(
+    service_name: str,
+    assistant_id: str,
+    user_message: str,
+    user_id: int,
+    on_progress: Optional[Callable[[str], Awaitable[None]]],
+    on_queue: Optional[QueueCallback]
+) -> str:
+    try:
+        return await request_scheduler.run(
+            service_name,
+            user_id,
+            lambda: _request_service_response(
+                service_name, assistant_id, user_message, user_id,
+                on_progress=on_progress
+            ),
+            on_queue
+        )
+    except Exception as e:
+        logger.error(f"Неочікувана помилка при роботі з OpenAI API для користувача {user_id}: {e}", exc_info=True)
+        return "❌ Помилка при обробці запиту. Спробуйте пізніше або зверніться до оператора."
+
+_pending_exchanges: OrderedDict[Tuple[int, str], list] = OrderedDict()
+
+def _defer_exchange(service_name: str, user_id: int, question: str, answer: str):
+    key = (user_id, service_name)
+    exchanges = _pending_exchanges.pop(key, [])
+    exchanges.append((question, answer))
+    _pending_exchanges[key] = exchanges[-PENDING_EXCHANGES_PER_THREAD:]
+    while len(_pending_exchanges) > THREAD_STORE_MAX_ENTRIES:
+        _pending_exchanges.popitem(last=False)
+
+async def _seed_exchanges(thread_id: str, service_name: str, user_id: int):
+    exchanges = _pending_exchanges.pop((user_id, service_name), None)
+    if not exchanges:
+        return
+    try:
+        for question, answer in exchanges:
+            for role, content in (('user', question), ('assistant', answer)):
+                await _call_with_retries(
+                    lambda: resources.openai.beta.threads.messages.create(
+                        thread_id=thread_id,
+                        role=role,
+                        content=content
+                    ),
+                    user_id
+                )
+        logger.info(f"Спільні відповіді ({len(exchanges)}) записано в тред {thread_id} користувача {user_id}")
+    except Exception as e:
+        logger.warning(f"Не вдалося записати спільні відповіді у тред користувача {user_id}: {e}")
+
+async def clear_user_thread(user_id: int, service_name: Optional[str] = None):
+    for key in [key for key in _pending_exchanges if key[0] == user_id and service_name in (None, key[1])]:
+        del _pending_exchanges[key]
+    for thread_id in await thread_store.clear(user_id, service_name):
         logger.info(f"Видалено тред {thread_id} для користувача {user_id}")
-        del user_threads[user_id]
 
-def get_thread_id(user_id: int) -> Optional[str]:
-    return user_threads.get(user_id)
+async def get_thread_id(user_id: int, service_name: str) -> Optional[str]:
+    return await thread_store.get(user_id, service_name)
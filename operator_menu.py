@@ -1,27 +1,63 @@
+import re
+from datetime import datetime
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram import Router, F
 from aiogram.filters import Command
 from aiogram import types
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
-from db import get_users_page, get_total_users, get_user_full_info, find_user_by_username, find_user_by_id, add_balance, subtract_balance, block_user, unblock_user, get_balance
-from aiogram import Bot
-from os import getenv
+from db import LEDGER_ADJUST, SEARCH_MAX_CANDIDATES
+from async_db import get_balance_history, activity_buffer, get_users_keyset_page, get_total_users, get_user_full_info, find_user_by_username, find_user_by_id, search_users, add_balance, subtract_balance, block_user, unblock_user, get_balance
+from aiogram.methods import SendMessage
+from send_queue import send_queue, PRIORITY_NOTIFY
+from openai_service import run_multiplexer, single_flight
+from additional_improvements import answer_cache
+from request_scheduler import request_scheduler
+from quota_governor import quota_governor
+import webhook_server
+from resources import resources
 
 OPERATOR_ID = 8133761847
 operator_router = Router()
 
-def get_profile_keyboard(user_id, page, is_blocked):
+USERS_PER_PAGE = 10
+SEARCH_PAGE_SIZE = 10
+HISTORY_PAGE_SIZE = 10
+LIST_TOKEN_PATTERN = r'[jabu]\d+[<>@]\d+'
+DEFAULT_LIST_TOKEN = 'j1@0'
+SORT_LABELS = {
+    'j': '📅 Приєднання',
+    'a': '🕒 Активність',
+    'b': '💰 Баланс',
+    'u': '📈 Запити'
+}
+LEDGER_KIND_LABELS = {
+    'bonus': '🎁 Стартовий бонус',
+    'opening': '📂 Початковий залишок',
+    'topup': '💳 Поповнення',
+    'debit': '📤 Запит',
+    'refund': '↩️ Повернення',
+    'adjust': '🛠 Коригування оператором'
+}
+
+def parse_list_token(token):
+    match = re.fullmatch(r'([jabu])(\d+)([<>@])(\d+)', token)
+    if not match:
+        return 'j', 1, '@', 0
+    return match.group(1), int(match.group(2)), match.group(3), int(match.group(4))
+
+def get_profile_keyboard(user_id, list_token, is_blocked):
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="💳 Поповнити", callback_data=f"op_add_{user_id}_{page}"),
-         InlineKeyboardButton(text="➖ Списати", callback_data=f"op_sub_{user_id}_{page}")],
-        [InlineKeyboardButton(text="🚫 Заблокувати" if not is_blocked else "✅ Розблокувати", callback_data=f"op_block_{user_id}_{page}")],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data=f"op_users_{page}"),
+        [InlineKeyboardButton(text="💳 Поповнити", callback_data=f"op_add_{user_id}_{list_token}"),
+         InlineKeyboardButton(text="➖ Списати", callback_data=f"op_sub_{user_id}_{list_token}")],
+        [InlineKeyboardButton(text="🚫 Заблокувати" if not is_blocked else "✅ Розблокувати", callback_data=f"op_block_{user_id}_{list_token}"),
+         InlineKeyboardButton(text="📜 Історія балансу", callback_data=f"op_hist_{user_id}_0_{list_token}")],
+        [InlineKeyboardButton(text="⬅️ Назад", callback_data=f"op_users_{list_token}"),
          InlineKeyboardButton(text="🏠 Меню", callback_data="op_menu")]
     ])
 
-async def show_user_profile(message_or_callback, user_id, page):
-    user = get_user_full_info(user_id)
+async def show_user_profile(message_or_callback, user_id, list_token):
+    user = await get_user_full_info(user_id)
     if not user:
         await message_or_callback.answer("Користувача не знайдено")
         return
@@ -37,12 +73,20 @@ async def show_user_profile(message_or_callback, user_id, page):
     text += f"Останнє поповнення: {user[7] if user[7] else '—'}\n"
     text += f"Остання активність: {user[9] if user[9] else '—'}\n"
     text += f"Статус: {'🚫 Заблокований' if user[10] else '✅ Активний'}\n"
-    keyboard = get_profile_keyboard(user[1], page, user[10])
+    keyboard = get_profile_keyboard(user[1], list_token, user[10])
     if isinstance(message_or_callback, types.Message):
         await message_or_callback.answer(text, reply_markup=keyboard, parse_mode="HTML")
     else:
         await message_or_callback.message.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
 
+def format_ledger_entry(entry):
+    created = datetime.fromtimestamp(entry[5]).strftime('%d.%m.%Y %H:%M')
+    label = LEDGER_KIND_LABELS.get(entry[3], entry[3])
+    line = f"{created} {label}: <b>{entry[1]:+d}</b> → {entry[2]}"
+    if entry[4]:
+        line += f" <code>{entry[4]}</code>"
+    return line
+
 class SearchUser(StatesGroup):
     waiting_for_query = State()
 
@@ -50,25 +94,59 @@ class ChangeBalance(StatesGroup):
     waiting_for_amount = State()
     action = State()
     user_id = State()
-    page = State()
+    list_token = State()
 
 def get_operator_inline_menu():
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="👥 Список користувачів", callback_data="op_users_1")],
+        [InlineKeyboardButton(text="👥 Список користувачів", callback_data=f"op_users_{DEFAULT_LIST_TOKEN}")],
         [InlineKeyboardButton(text="🔎 Пошук користувача", callback_data="op_search")],
         [InlineKeyboardButton(text="ℹ️ Інфо для оператора", callback_data="op_info")]
     ])
 
-def get_users_list_keyboard(page, total_pages, users):
-    keyboard = []
+def get_users_list_keyboard(sort, page, users, has_prev, has_next):
+    keyboard = [[
+        InlineKeyboardButton(
+            text=f"• {label}" if code == sort else label,
+            callback_data=f"op_users_{code}1@0"
+        )
+        for code, label in SORT_LABELS.items()
+    ]]
+    list_token = f"{sort}{page}@{users[0][4]}" if users else DEFAULT_LIST_TOKEN
     for user in users:
         label = user[1] if user[1] else user[2] or str(user[0])  # username або first_name або id
-        keyboard.append([InlineKeyboardButton(text=label, callback_data=f"op_profile_{user[0]}_{page}")])
+        keyboard.append([InlineKeyboardButton(text=label, callback_data=f"op_profile_{user[0]}_{list_token}")])
+    nav_buttons = []
+    if has_prev:
+        nav_buttons.append(InlineKeyboardButton(text="⬅️ Попередня", callback_data=f"op_users_{sort}{page-1}<{users[0][4]}"))
+    if has_next:
+        nav_buttons.append(InlineKeyboardButton(text="➡️ Наступна", callback_data=f"op_users_{sort}{page+1}>{users[-1][4]}"))
+    if nav_buttons:
+        keyboard.append(nav_buttons)
+    keyboard.append([InlineKeyboardButton(text="🏠 Меню", callback_data="op_menu")])
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+def search_cursor(users):
+    return [users[-1][5], users[-1][4]] if users else None
+
+def search_truncated_note(truncated):
+    if not truncated:
+        return ""
+    return (
+        f"\n\n⚠️ Збігів більше ніж {SEARCH_MAX_CANDIDATES}, показано найкращі з перших {SEARCH_MAX_CANDIDATES}. "
+        f"Уточніть запит, щоб знайти інших."
+    )
+
+def get_search_results_keyboard(users, page, has_more):
+    keyboard = []
+    for user in users:
+        name = " ".join(part for part in (user[2], user[3]) if part)
+        label = f"{name} (@{user[1]})" if user[1] and name else name or user[1] or str(user[0])
+        keyboard.append([InlineKeyboardButton(text=label, callback_data=f"op_profile_{user[0]}_{DEFAULT_LIST_TOKEN}")])
     nav_buttons = []
     if page > 1:
-        nav_buttons.append(InlineKeyboardButton(text="⬅️ Попередня", callback_data=f"op_users_{page-1}"))
-    if page < total_pages:
-        nav_buttons.append(InlineKeyboardButton(text="➡️ Наступна", callback_data=f"op_users_{page+1}"))
+        nav_buttons.append(InlineKeyboardButton(text="⬅️ Попередня", callback_data=f"op_search_page_{page-1}"))
+    if has_more:
+        nav_buttons.append(InlineKeyboardButton(text="➡️ Наступна", callback_data=f"op_search_page_{page+1}"))
     if nav_buttons:
         keyboard.append(nav_buttons)
     keyboard.append([InlineKeyboardButton(text="🏠 Меню", callback_data="op_menu")])
@@ -95,7 +173,7 @@ async def operator_menu(message: types.Message, state: FSMContext):
 @operator_router.callback_query(F.data == "op_search")
 async def operator_user_search_start(callback: types.CallbackQuery, state: FSMContext):
     await callback.message.edit_text(
-        "Введіть username (без @) або Telegram ID користувача:",
+        "Введіть username, ім'я, прізвище або Telegram ID користувача:",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🏠 Меню", callback_data="op_menu")]])
     )
     await state.set_state(SearchUser.waiting_for_query)
@@ -110,50 +188,77 @@ async def operator_user_search_query(message: types.Message, state: FSMContext):
         query = query[1:]
     
     if query.isdigit():
-        user = find_user_by_id(int(query))
+        user = await find_user_by_id(int(query))
     else:
-        user = find_user_by_username(query)
+        user = await find_user_by_username(query)
+    
+    if not user and not query.isdigit():
+        users, has_more, truncated = await search_users(query, SEARCH_PAGE_SIZE)
+        if users:
+            await state.update_data(search_query=query, search_cursors=[None, search_cursor(users)])
+            await message.answer(
+                f"🔎 Результати пошуку «{query}»:" + search_truncated_note(truncated),
+                reply_markup=get_search_results_keyboard(users, 1, has_more)
+            )
+            return
     
     if not user:
         await message.answer("Користувача не знайдено. Спробуйте ще раз або поверніться в меню.",
                              reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🏠 Меню", callback_data="op_menu")]]))
         return
     await state.clear()
-    await show_user_profile(message, user[0], page=1)
+    await show_user_profile(message, user[0], DEFAULT_LIST_TOKEN)
 
-@operator_router.callback_query(F.data.regexp(r"^op_add_\d+_\d+$"))
+@operator_router.callback_query(F.data.regexp(r"^op_search_page_\d+$"))
+async def operator_user_search_page(callback: types.CallbackQuery, state: FSMContext):
+    page = int(callback.data.split('_')[-1])
+    data = await state.get_data()
+    query = data.get('search_query')
+    cursors = data.get('search_cursors') or []
+    if not query or page < 1 or page > len(cursors):
+        await callback.answer("Пошук застарів. Почніть новий пошук.", show_alert=True)
+        return
+    users, has_more, truncated = await search_users(query, SEARCH_PAGE_SIZE, cursors[page - 1])
+    await state.update_data(search_cursors=cursors[:page] + [search_cursor(users)])
+    await callback.message.edit_text(
+        f"🔎 Результати пошуку «{query}» (сторінка {page}):" + search_truncated_note(truncated),
+        reply_markup=get_search_results_keyboard(users, page, has_more)
+    )
+    await callback.answer()
+
+@operator_router.callback_query(F.data.regexp(rf"^op_add_\d+_{LIST_TOKEN_PATTERN}$"))
 async def operator_add_balance(callback: types.CallbackQuery, state: FSMContext):
     parts = callback.data.split('_')
     user_id = int(parts[2])
-    page = int(parts[3])
-    user = get_user_full_info(user_id)
+    list_token = parts[3]
+    user = await get_user_full_info(user_id)
     if user[10]:
         await callback.answer("Користувач заблокований. Спочатку розблокуйте акаунт.", show_alert=True)
-        await show_user_profile(callback, user_id, page)
+        await show_user_profile(callback, user_id, list_token)
         return
     await state.set_state(ChangeBalance.waiting_for_amount)
-    await state.update_data(action='add', user_id=user_id, page=page)
+    await state.update_data(action='add', user_id=user_id, list_token=list_token)
     await callback.message.edit_text(
         "Введіть суму для поповнення рахунку:",
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="⬅️ Назад", callback_data=f"op_profile_{user_id}_{page}"), InlineKeyboardButton(text="🏠 Меню", callback_data="op_menu")]])
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="⬅️ Назад", callback_data=f"op_profile_{user_id}_{list_token}"), InlineKeyboardButton(text="🏠 Меню", callback_data="op_menu")]])
     )
     await callback.answer()
 
-@operator_router.callback_query(F.data.regexp(r"^op_sub_\d+_\d+$"))
+@operator_router.callback_query(F.data.regexp(rf"^op_sub_\d+_{LIST_TOKEN_PATTERN}$"))
 async def operator_sub_balance(callback: types.CallbackQuery, state: FSMContext):
     parts = callback.data.split('_')
     user_id = int(parts[2])
-    page = int(parts[3])
-    user = get_user_full_info(user_id)
+    list_token = parts[3]
+    user = await get_user_full_info(user_id)
     if user[10]:
         await callback.answer("Користувач заблокований. Спочатку розблокуйте акаунт.", show_alert=True)
-        await show_user_profile(callback, user_id, page)
+        await show_user_profile(callback, user_id, list_token)
         return
     await state.set_state(ChangeBalance.waiting_for_amount)
-    await state.update_data(action='sub', user_id=user_id, page=page)
+    await state.update_data(action='sub', user_id=user_id, list_token=list_token)
     await callback.message.edit_text(
         "Введіть суму для списання з рахунку:",
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="⬅️ Назад", callback_data=f"op_profile_{user_id}_{page}"), InlineKeyboardButton(text="🏠 Меню", callback_data="op_menu")]])
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="⬅️ Назад", callback_data=f"op_profile_{user_id}_{list_token}"), InlineKeyboardButton(text="🏠 Меню", callback_data="op_menu")]])
     )
     await callback.answer()
 
@@ -162,7 +267,7 @@ async def operator_change_balance_amount(message: types.Message, state: FSMConte
     data = await state.get_data()
     action = data.get('action')
     user_id = data.get('user_id')
-    page = data.get('page')
+    list_token = data.get('list_token')
     try:
         amount = int(message.text.strip())
         if amount <= 0:
@@ -171,73 +276,103 @@ async def operator_change_balance_amount(message: types.Message, state: FSMConte
         await message.answer("Введіть коректну суму (ціле число більше 0)")
         return
     if action == 'add':
-        add_balance(user_id, amount)
-        try:
-            bot = Bot(token=getenv('TELEGRAM_BOT_TOKEN'))
-            balance = get_balance(user_id)
-            text = (
-                f"Дякуємо! Ваш рахунок поповнено на {amount} запитів.\n"
-                f"Поточний баланс: {balance} запитів.\n"
-                f"Приємного користування!"
-            )
-            await bot.send_message(user_id, text)
-        except Exception as e:
-            print(f"Не вдалося надіслати повідомлення користувачу: {e}")
+        await add_balance(user_id, amount, kind=LEDGER_ADJUST, reference=f"operator:{message.from_user.id}")
+        balance = await get_balance(user_id)
+        text = (
+            f"Дякуємо! Ваш рахунок поповнено на {amount} запитів.\n"
+            f"Поточний баланс: {balance} запитів.\n"
+            f"Приємного користування!"
+        )
+        send_queue.enqueue(SendMessage(chat_id=user_id, text=text), priority=PRIORITY_NOTIFY)
         await message.answer(f"✅ Баланс поповнено на {amount} запитів.")
     elif action == 'sub':
-        subtract_balance(user_id, amount)
+        await subtract_balance(user_id, amount, reference=f"operator:{message.from_user.id}")
         await message.answer(f"✅ З рахунку списано {amount} запитів.")
     await state.clear()
-    await show_user_profile(message, user_id, page)
+    await show_user_profile(message, user_id, list_token)
 
-@operator_router.callback_query(F.data.regexp(r"^op_block_\d+_\d+$"))
+@operator_router.callback_query(F.data.regexp(rf"^op_block_\d+_{LIST_TOKEN_PATTERN}$"))
 async def operator_block_user(callback: types.CallbackQuery):
     parts = callback.data.split('_')
     user_id = int(parts[2])
-    page = int(parts[3])
-    user = get_user_full_info(user_id)
-    bot = Bot(token=getenv('TELEGRAM_BOT_TOKEN'))
+    list_token = parts[3]
+    user = await get_user_full_info(user_id)
     operator_username = '@TylBotOperator'
     if user[10]:
-        unblock_user(user_id)
+        await unblock_user(user_id)
         await callback.answer("Користувача розблоковано")
-        try:
-            await bot.send_message(user_id, f"✅ Ваш акаунт у боті розблоковано оператором {operator_username}.")
-        except Exception:
-            pass
+        send_queue.enqueue(
+            SendMessage(chat_id=user_id, text=f"✅ Ваш акаунт у боті розблоковано оператором {operator_username}."),
+            priority=PRIORITY_NOTIFY
+        )
     else:
-        block_user(user_id)
+        await block_user(user_id)
         await callback.answer("Користувача заблоковано")
-        try:
-            await bot.send_message(
-                user_id,
-                f"🚫 Ваш акаунт у боті заблоковано оператором {operator_username}.\n\n"
+        send_queue.enqueue(
+            SendMessage(
+                chat_id=user_id,
+                text=f"🚫 Ваш акаунт у боті заблоковано оператором {operator_username}.\n\n"
                 "Причина: Порушення правил користування ботом або підозріла активність.\n"
                 "Якщо ви вважаєте це помилкою — зверніться до оператора для розблокування."
-            )
-        except Exception:
-            pass
-    await show_user_profile(callback, user_id, page)
+            ),
+            priority=PRIORITY_NOTIFY
+        )
+    await show_user_profile(callback, user_id, list_token)
 
-@operator_router.callback_query(F.data.regexp(r"^op_users_\d+$"))
+@operator_router.callback_query(F.data.regexp(rf"^op_users_{LIST_TOKEN_PATTERN}$"))
 async def operator_user_list(callback: types.CallbackQuery):
-    page = int(callback.data.split('_')[-1])
-    per_page = 10
-    total = get_total_users()
-    total_pages = (total + per_page - 1) // per_page
-    users = get_users_page(page, per_page)
+    sort, page, direction, anchor_id = parse_list_token(callback.data[len("op_users_"):])
+    total = await get_total_users()
+    total_pages = max(1, (total + USERS_PER_PAGE - 1) // USERS_PER_PAGE)
+    users, has_more = await get_users_keyset_page(sort, direction, anchor_id, USERS_PER_PAGE)
+    if not users and anchor_id:
+        page, direction = 1, '@'
+        users, has_more = await get_users_keyset_page(sort, direction, 0, USERS_PER_PAGE)
+    page = max(1, min(page, total_pages))
+    if direction == '<':
+        has_prev, has_next = has_more, True
+        if not has_more:
+            page = 1
+    else:
+        has_prev, has_next = page > 1, has_more
     await callback.message.edit_text(
-        f"Список користувачів (сторінка {page} з {total_pages}):",
-        reply_markup=get_users_list_keyboard(page, total_pages, users)
+        f"Список користувачів (сторінка {page} з {total_pages}, сортування: {SORT_LABELS[sort]}):",
+        reply_markup=get_users_list_keyboard(sort, page, users, has_prev, has_next)
     )
     await callback.answer()
 
-@operator_router.callback_query(F.data.regexp(r"^op_profile_\d+_\d+$"))
+@operator_router.callback_query(F.data.regexp(rf"^op_profile_\d+_{LIST_TOKEN_PATTERN}$"))
 async def operator_user_profile(callback: types.CallbackQuery):
     parts = callback.data.split('_')
     user_id = int(parts[2])
-    page = int(parts[3])
-    await show_user_profile(callback, user_id, page)
+    list_token = parts[3]
+    await show_user_profile(callback, user_id, list_token)
+    await callback.answer()
+
+@operator_router.callback_query(F.data.regexp(rf"^op_hist_\d+_\d+_{LIST_TOKEN_PATTERN}$"))
+async def operator_balance_history(callback: types.CallbackQuery):
+    parts = callback.data.split('_')
+    user_id = int(parts[2])
+    before_id = int(parts[3])
+    list_token = parts[4]
+    entries, has_more = await get_balance_history(user_id, before_id, HISTORY_PAGE_SIZE)
+    if entries:
+        text = f"📜 <b>Історія балансу</b> <code>{user_id}</code>\n\n" + "\n".join(
+            format_ledger_entry(entry) for entry in entries
+        )
+    else:
+        text = f"📜 <b>Історія балансу</b> <code>{user_id}</code>\n\nЗаписів немає."
+    nav_buttons = []
+    if before_id:
+        nav_buttons.append(InlineKeyboardButton(text="⏮ Найновіші", callback_data=f"op_hist_{user_id}_0_{list_token}"))
+    if has_more:
+        nav_buttons.append(InlineKeyboardButton(text="➡️ Старіші", callback_data=f"op_hist_{user_id}_{entries[-1][0]}_{list_token}"))
+    keyboard = [nav_buttons] if nav_buttons else []
+    keyboard.append([
+        InlineKeyboardButton(text="⬅️ Назад", callback_data=f"op_profile_{user_id}_{list_token}"),
+        InlineKeyboardButton(text="🏠 Меню", callback_data="op_menu")
+    ])
+    await callback.message.edit_text(text, reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard), parse_mode="HTML")
     await callback.answer()
 
 @operator_router.callback_query(F.data == "op_menu")
@@ -251,5 +386,71 @@ async def operator_menu_callback(callback: types.CallbackQuery, state: FSMContex
 
 @operator_router.callback_query(F.data == "op_info")
 async def operator_info(callback: types.CallbackQuery):
-    await callback.message.edit_text("Тут буде інформація для оператора (функціонал у розробці)", reply_markup=get_operator_inline_menu())
+    run_stats = run_multiplexer.get_stats()
+    cache_stats = answer_cache.get_stats()
+    flight_stats = single_flight.get_stats()
+    median = run_stats['median_completion']
+    text = (
+        "ℹ️ <b>Інфо для оператора</b>\n\n"
+        "🤖 <b>Запуски асистентів:</b>\n"
+        f"• В очікуванні: {run_stats['pending_runs']}\n"
+        f"• Частота опитувань (за хв): {run_stats['poll_rate']}/с (ліміт {run_stats['max_poll_rate']}/с)\n"
+        f"• Всього опитувань: {run_stats['polls_total']}\n"
+        f"• Медіана виконання: {f'{median} с' if median is not None else '—'}\n"
+        f"• Обʼєднано однакових запитів: {flight_stats['coalesced']}\n\n"
+        "🗂 <b>Кеш відповідей:</b>\n"
+        f"• Записів: {cache_stats['entries']}\n"
+        f"• Влучань: {cache_stats['hits']} (схожих: {cache_stats['near_hits']})\n"
+        f"• Промахів: {cache_stats['misses']}\n"
+        f"• Частка влучань: {cache_stats['hit_ratio'] * 100:.1f}%\n"
+        f"• Поріг схожості: {cache_stats['threshold']}\n"
+    )
+    quota_stats = quota_governor.get_stats()
+    remaining = quota_stats['remaining_requests']
+    if remaining is not None:
+        remaining = f"{remaining}/{quota_stats['limit_requests']}"
+    text += (
+        "\n📉 <b>Квота OpenAI:</b>\n"
+        f"• Залишок запитів: {remaining or '—'}\n"
+        f"• Відкладено запитів: {quota_stats['paced_requests']} ({quota_stats['paced_seconds']} с)\n"
+        f"• Відповідей 429: {quota_stats['rate_limited']}\n"
+    )
+    activity_stats = activity_buffer.get_stats()
+    text += (
+        "\n🗄 <b>Активність користувачів:</b>\n"
+        f"• Оновлень у буфері: {activity_stats['pending']}\n"
+        f"• Звернень: {activity_stats['touches']}, записано пакетами: {activity_stats['rows_flushed']} ({activity_stats['flushes']} транзакцій)\n"
+    )
+    send_stats = send_queue.get_stats()
+    text += (
+        "\n📨 <b>Черга надсилання Telegram:</b>\n"
+        f"• В черзі: {send_stats['queued']} (макс. {send_stats['max_depth']}), надсилається: {send_stats['in_flight']}\n"
+        f"• Надіслано: {send_stats['sent']}, повторів: {send_stats['retried']}, помилок: {send_stats['failed']}\n"
+        f"• Сер. очікування: {send_stats['avg_wait']} с\n"
+    )
+    resource_stats = resources.get_stats()
+    text += (
+        "\n🔌 <b>Зʼєднання:</b>\n"
+        f"• HTTP сесія: {'відкрита' if resource_stats['http_open'] else 'не створена'}, створено сесій: {resource_stats['http_sessions_created']}\n"
+        f"• OpenAI клієнт: {'активний' if resource_stats['openai'] else 'не створений'}\n"
+    )
+    if webhook_server.update_pipeline is not None:
+        update_stats = webhook_server.update_pipeline.get_stats()
+        p95 = update_stats['p95_latency']
+        text += (
+            "\n🌐 <b>Вебхук:</b>\n"
+            f"• В черзі: {update_stats['queued']}/{update_stats['capacity']} (макс. {update_stats['max_depth']}), користувачів в обробці: {update_stats['active_users']}\n"
+            f"• Оброблено: {update_stats['processed']}, відхилено: {update_stats['rejected']}, помилок: {update_stats['failed']}\n"
+            f"• p95 обробки: {f'{p95} с' if p95 is not None else '—'}\n"
+        )
+    queue_stats = request_scheduler.get_stats()
+    if queue_stats:
+        text += "\n🚦 <b>Черги служб:</b>\n"
+        for service, stats in queue_stats.items():
+            text += (
+                f"• {service}: активних {stats['active']}/{stats['concurrency']}, "
+                f"в черзі {stats['waiting']} (пріоритетних {stats['waiting_priority']}), "
+                f"сер. тривалість {stats['avg_duration']} с\n"
+            )
+    await callback.message.edit_text(text, reply_markup=get_operator_inline_menu(), parse_mode="HTML")
     await callback.answer() 
\ No newline at end of file
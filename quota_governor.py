@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import os
+import random
+import re
+import time
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+QUOTA_REQUEST_RESERVE = float(os.getenv('OPENAI_QUOTA_REQUEST_RESERVE', '0.1'))
+QUOTA_TOKEN_RESERVE = float(os.getenv('OPENAI_QUOTA_TOKEN_RESERVE', '0.05'))
+RETRY_BASE_DELAY = 2
+RETRY_MAX_DELAY = 30
+
+_DURATION_RE = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+_DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+def parse_reset(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_RE.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+class _Bucket:
+    __slots__ = ('name', 'limit', 'tokens', 'rate', 'updated')
+    
+    def __init__(self, name: str):
+        self.name = name
+        self.limit: Optional[float] = None
+        self.tokens = 0.0
+        self.rate = 0.0
+        self.updated = 0.0
+    
+    def refill(self, now: float):
+        if self.limit is None:
+            return
+        self.tokens = min(self.limit, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def observe(self, limit: Optional[str], remaining: Optional[str], reset: Optional[str], now: float):
+        try:
+            limit_value = float(limit) if limit else None
+            remaining_value = float(remaining) if remaining else None
+        except ValueError:
+            return
+        if limit_value is None or remaining_value is None:
+            return
+        reset_seconds = parse_reset(reset)
+        self.limit = limit_value
+        self.tokens = remaining_value
+        self.updated = now
+        if reset_seconds and reset_seconds > 0 and limit_value > remaining_value:
+            self.rate = (limit_value - remaining_value) / reset_seconds
+        else:
+            self.rate = limit_value / 60
+    
+    def wait_time(self, now: float, cost: float, reserve: float) -> float:
+        if self.limit is None:
+            return 0.0
+        self.refill(now)
+        floor = self.limit * reserve
+        if self.tokens - cost >= floor:
+            return 0.0
+        if self.rate <= 0:
+            return 1.0
+        return (floor + cost - self.tokens) / self.rate
+
+class QuotaGovernor:
+    
+    def __init__(
+        self,
+        request_reserve: float = QUOTA_REQUEST_RESERVE,
+        token_reserve: float = QUOTA_TOKEN_RESERVE
+    ):
+        self.request_reserve = request_reserve
+        self.token_reserve = token_reserve
+        self.requests = _Bucket('requests')
+        self.tokens = _Bucket('tokens')
+        self.blocked_until = 0.0
+        self.paced_requests = 0
+        self.paced_seconds = 0.0
+        self.rate_limited = 0
+        self._lock: Optional[asyncio.Lock] = None
+    
+    async def acquire(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            now = time.monotonic()
+            delay = max(
+                self.blocked_until - now,
+                self.requests.wait_time(now, 1, self.request_reserve),
+                self.tokens.wait_time(now, 0, self.token_reserve)
+            )
+            if delay > 0:
+                self.paced_requests += 1
+                self.paced_seconds += delay
+                logger.info(f"Квота OpenAI: запит відкладено на {delay:.2f} с")
+                await asyncio.sleep(delay)
+                now = time.monotonic()
+                self.requests.refill(now)
+                self.tokens.refill(now)
+            if self.requests.limit is not None:
+                self.requests.tokens -= 1
+    
+    def observe(self, headers):
+        now = time.monotonic()
+        self.requests.observe(
+            headers.get('x-ratelimit-limit-requests'),
+            headers.get('x-ratelimit-remaining-requests'),
+            headers.get('x-ratelimit-reset-requests'),
+            now
+        )
+        self.tokens.observe(
+            headers.get('x-ratelimit-limit-tokens'),
+            headers.get('x-ratelimit-remaining-tokens'),
+            headers.get('x-ratelimit-reset-tokens'),
+            now
+        )
+    
+    def on_rate_limited(self, headers=None):
+        self.rate_limited += 1
+        retry_after = None
+        if headers is not None:
+            retry_after = parse_reset(headers.get('retry-after-ms'))
+            if retry_after is not None:
+                retry_after /= 1000
+            else:
+                retry_after = parse_reset(headers.get('retry-after'))
+            self.observe(headers)
+        if retry_after:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + min(retry_after, RETRY_MAX_DELAY))
+    
+    def retry_delay(self, attempt: int) -> float:
+        base = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt))
+        jittered = base / 2 + random.uniform(0, base / 2)
+        return max(jittered, self.blocked_until - time.monotonic())
+    
+    async def on_request(self, request):
+        await self.acquire()
+    
+    async def on_response(self, response):
+        self.observe(response.headers)
+        if response.status_code == 429:
+            self.on_rate_limited(response.headers)
+    
+    def get_stats(self) -> Dict:
+        now = time.monotonic()
+        self.requests.refill(now)
+        self.tokens.refill(now)
+        return {
+            'remaining_requests': int(self.requests.tokens) if self.requests.limit is not None else None,
+            'limit_requests': int(self.requests.limit) if self.requests.limit is not None else None,
+            'remaining_tokens': int(self.tokens.tokens) if self.tokens.limit is not None else None,
+            'paced_requests': self.paced_requests,
+            'paced_seconds': round(self.paced_seconds, 1),
+            'rate_limited': self.rate_limited,
+            'blocked_for': round(max(0.0, self.blocked_until - now), 1)
+        }
+
+quota_governor = QuotaGovernor()
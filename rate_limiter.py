@@ -1,53 +1,63 @@
+import math
 import time
-from collections import defaultdict
 from typing import Dict, Tuple
 import logging
 
 logger = logging.getLogger(__name__)
 
+IDLE_SWEEP_INTERVAL = 60
+_EPSILON = 1e-9
+
+class _UserState:
+    __slots__ = ('tat',)
+
+    def __init__(self, tat: float):
+        self.tat = tat
+
 class RateLimiter:
-    
-    def __init__(self, max_requests: int = 10, window_seconds: int = 60):
+
+    def __init__(self, max_requests: int = 10, window_seconds: int = 60, sweep_interval: float = IDLE_SWEEP_INTERVAL):
         self.max_requests = max_requests
         self.window_seconds = window_seconds
-        self.requests: Dict[int, list] = defaultdict(list)
-        self._lock = {}
-    
+        self.interval = window_seconds / max_requests
+        self.sweep_interval = sweep_interval
+        self.users: Dict[int, _UserState] = {}
+        self._next_sweep = time.monotonic() + sweep_interval
+
     def is_allowed(self, user_id: int) -> Tuple[bool, int]:
-        current_time = time.time()
-        
-        if user_id in self.requests:
-            self.requests[user_id] = [
-                req_time for req_time in self.requests[user_id]
-                if current_time - req_time < self.window_seconds
-            ]
-        
-        if len(self.requests[user_id]) >= self.max_requests:
-            oldest_request = min(self.requests[user_id])
-            wait_time = int(self.window_seconds - (current_time - oldest_request)) + 1
-            return False, wait_time
-        
-        self.requests[user_id].append(current_time)
+        now = time.monotonic()
+        if now >= self._next_sweep:
+            self._evict_idle(now)
+
+        state = self.users.get(user_id)
+        tat = state.tat if state is not None and state.tat > now else now
+        new_tat = tat + self.interval
+        allow_at = new_tat - self.window_seconds
+        if allow_at - now > _EPSILON:
+            return False, int(allow_at - now) + 1
+
+        if state is None:
+            self.users[user_id] = _UserState(new_tat)
+        else:
+            state.tat = new_tat
         return True, 0
-    
+
+    def _evict_idle(self, now: float):
+        self._next_sweep = now + self.sweep_interval
+        idle = [user_id for user_id, state in self.users.items() if state.tat <= now]
+        for user_id in idle:
+            del self.users[user_id]
+        if idle:
+            logger.debug(f"Видалено {len(idle)} неактивних користувачів з лімітера")
+
     def reset(self, user_id: int):
-        if user_id in self.requests:
-            del self.requests[user_id]
-    
+        self.users.pop(user_id, None)
+
     def get_stats(self, user_id: int) -> Dict:
-        current_time = time.time()
-        if user_id in self.requests:
-            recent_requests = [
-                req_time for req_time in self.requests[user_id]
-                if current_time - req_time < self.window_seconds
-            ]
-            return {
-                'requests_count': len(recent_requests),
-                'max_requests': self.max_requests,
-                'window_seconds': self.window_seconds
-            }
+        state = self.users.get(user_id)
+        backlog = state.tat - time.monotonic() if state is not None else 0
         return {
-            'requests_count': 0,
+            'requests_count': min(self.max_requests, max(0, math.ceil(backlog / self.interval))),
             'max_requests': self.max_requests,
             'window_seconds': self.window_seconds
         }
@@ -55,5 +65,3 @@ class RateLimiter:
 message_rate_limiter = RateLimiter(max_requests=20, window_seconds=60)
 service_rate_limiter = RateLimiter(max_requests=10, window_seconds=60)
 payment_rate_limiter = RateLimiter(max_requests=5, window_seconds=300)
-
-
@@ -0,0 +1,207 @@
+import asyncio
+import logging
+import math
+import os
+import time
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Dict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+SERVICE_CONCURRENCY = int(os.getenv('OPENAI_SERVICE_CONCURRENCY', '4'))
+PRIORITY_WEIGHT = int(os.getenv('OPENAI_PRIORITY_WEIGHT', '3'))
+PRIORITY_USER_IDS: Set[int] = {
+    int(user_id) for user_id in os.getenv('OPENAI_PRIORITY_USERS', '').split(',') if user_id.strip().isdigit()
+}
+DEFAULT_RUN_DURATION = 20.0
+
+LANE_PRIORITY = 'priority'
+LANE_NORMAL = 'normal'
+
+QueueCallback = Callable[[int, int], Awaitable[None]]
+
+class _Ticket:
+    __slots__ = ('user_id', 'lane', 'future', 'on_queue', 'last_position')
+    
+    def __init__(self, user_id: int, lane: str, future: asyncio.Future, on_queue: Optional[QueueCallback]):
+        self.user_id = user_id
+        self.lane = lane
+        self.future = future
+        self.on_queue = on_queue
+        self.last_position = 0
+
+class _ServiceQueue:
+    
+    def __init__(self, name: str, concurrency: int):
+        self.name = name
+        self.concurrency = concurrency
+        self.active = 0
+        self.lanes: Dict[str, OrderedDict] = {
+            LANE_PRIORITY: OrderedDict(),
+            LANE_NORMAL: OrderedDict()
+        }
+        self.priority_streak = 0
+        self.avg_duration = DEFAULT_RUN_DURATION
+        self.admitted = 0
+        self.queued = 0
+    
+    def waiting(self, lane: str) -> int:
+        return sum(len(tickets) for tickets in self.lanes[lane].values())
+    
+    def enqueue(self, ticket: _Ticket):
+        self.lanes[ticket.lane].setdefault(ticket.user_id, deque()).append(ticket)
+    
+    def remove(self, ticket: _Ticket):
+        users = self.lanes[ticket.lane]
+        tickets = users.get(ticket.user_id)
+        if tickets and ticket in tickets:
+            tickets.remove(ticket)
+            if not tickets:
+                del users[ticket.user_id]
+    
+    def _pop_from(self, lane: str) -> Optional[_Ticket]:
+        users = self.lanes[lane]
+        if not users:
+            return None
+        user_id, tickets = next(iter(users.items()))
+        ticket = tickets.popleft()
+        del users[user_id]
+        if tickets:
+            users[user_id] = tickets
+        return ticket
+    
+    def next_ticket(self) -> Optional[_Ticket]:
+        has_priority = bool(self.lanes[LANE_PRIORITY])
+        has_normal = bool(self.lanes[LANE_NORMAL])
+        if has_priority and (not has_normal or self.priority_streak < PRIORITY_WEIGHT):
+            self.priority_streak += 1
+            return self._pop_from(LANE_PRIORITY)
+        self.priority_streak = 0
+        return self._pop_from(LANE_NORMAL)
+    
+    def ordered_tickets(self) -> list:
+        lanes = {lane: deque(deque(tickets) for tickets in users.values()) for lane, users in self.lanes.items()}
+        ordered = []
+        streak = self.priority_streak
+        while lanes[LANE_PRIORITY] or lanes[LANE_NORMAL]:
+            if lanes[LANE_PRIORITY] and (not lanes[LANE_NORMAL] or streak < PRIORITY_WEIGHT):
+                streak += 1
+                lane = LANE_PRIORITY
+            else:
+                streak = 0
+                lane = LANE_NORMAL
+            tickets = lanes[lane].popleft()
+            ordered.append(tickets.popleft())
+            if tickets:
+                lanes[lane].append(tickets)
+        return ordered
+    
+    def eta(self, position: int) -> int:
+        return int(math.ceil(position / self.concurrency) * self.avg_duration)
+
+class RequestScheduler:
+    
+    def __init__(self, concurrency: int = SERVICE_CONCURRENCY, priority_users: Optional[Set[int]] = None):
+        self.concurrency = concurrency
+        self.priority_users = priority_users if priority_users is not None else PRIORITY_USER_IDS
+        self.services: Dict[str, _ServiceQueue] = {}
+        self._notifications: Set[asyncio.Task] = set()
+    
+    def _queue(self, service: str) -> _ServiceQueue:
+        if service not in self.services:
+            self.services[service] = _ServiceQueue(service, self.concurrency)
+        return self.services[service]
+    
+    def lane_for(self, user_id: int) -> str:
+        return LANE_PRIORITY if user_id in self.priority_users else LANE_NORMAL
+    
+    def _notify_positions(self, queue: _ServiceQueue):
+        for position, ticket in enumerate(queue.ordered_tickets(), start=1):
+            if ticket.on_queue and ticket.last_position != position:
+                ticket.last_position = position
+                task = asyncio.create_task(self._safe_notify(ticket, position, queue.eta(position)))
+                self._notifications.add(task)
+                task.add_done_callback(self._notifications.discard)
+    
+    async def _safe_notify(self, ticket: _Ticket, position: int, eta: int):
+        try:
+            await ticket.on_queue(position, eta)
+        except Exception as e:
+            logger.debug(f"Не вдалося повідомити позицію в черзі користувачу {ticket.user_id}: {e}")
+    
+    def _dispatch(self, queue: _ServiceQueue):
+        while queue.active < queue.concurrency:
+            ticket = queue.next_ticket()
+            if ticket is None:
+                break
+            if ticket.future.done():
+                continue
+            queue.active += 1
+            queue.admitted += 1
+            ticket.future.set_result(None)
+        self._notify_positions(queue)
+    
+    async def acquire(self, service: str, user_id: int, on_queue: Optional[QueueCallback] = None):
+        queue = self._queue(service)
+        if queue.active < queue.concurrency and not queue.lanes[LANE_PRIORITY] and not queue.lanes[LANE_NORMAL]:
+            queue.active += 1
+            queue.admitted += 1
+            return
+        
+        ticket = _Ticket(user_id, self.lane_for(user_id), asyncio.get_running_loop().create_future(), on_queue)
+        queue.enqueue(ticket)
+        queue.queued += 1
+        logger.info(f"Запит користувача {user_id} до {service} поставлено в чергу ({ticket.lane})")
+        self._notify_positions(queue)
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            if ticket.future.done() and not ticket.future.cancelled():
+                self.release(service)
+            else:
+                queue.remove(ticket)
+                self._notify_positions(queue)
+            raise
+    
+    def release(self, service: str, duration: Optional[float] = None):
+        queue = self._queue(service)
+        queue.active = max(0, queue.active - 1)
+        if duration is not None:
+            queue.avg_duration = queue.avg_duration * 0.8 + duration * 0.2
+        self._dispatch(queue)
+    
+    async def run(
+        self,
+        service: str,
+        user_id: int,
+        fn: Callable[[], Awaitable],
+        on_queue: Optional[QueueCallback] = None
+    ):
+        await self.acquire(service, user_id, on_queue)
+        started = time.monotonic()
+        try:
+            return await fn()
+        finally:
+            self.release(service, time.monotonic() - started)
+    
+    async def close(self):
+        tasks = list(self._notifications)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    
+    def get_stats(self) -> Dict:
+        return {
+            name: {
+                'active': queue.active,
+                'concurrency': queue.concurrency,
+                'waiting': queue.waiting(LANE_PRIORITY) + queue.waiting(LANE_NORMAL),
+                'waiting_priority': queue.waiting(LANE_PRIORITY),
+                'admitted': queue.admitted,
+                'queued': queue.queued,
+                'avg_duration': round(queue.avg_duration, 1)
+            }
+            for name, queue in self.services.items()
+        }
+
+request_scheduler = RequestScheduler()
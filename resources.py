@@ -0,0 +1,85 @@
+import logging
+import os
+from typing import Callable, Optional
+
+import aiohttp
+from aiogram import Bot
+from dotenv import load_dotenv
+from openai import AsyncOpenAI
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+HTTP_POOL_LIMIT = int(os.getenv('HTTP_POOL_LIMIT', '100'))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv('HTTP_KEEPALIVE_TIMEOUT', '30'))
+HTTP_REQUEST_TIMEOUT = float(os.getenv('HTTP_REQUEST_TIMEOUT', '30'))
+
+class ResourceManager:
+
+    def __init__(self, token: Optional[str] = TELEGRAM_BOT_TOKEN):
+        self.token = token
+        self._bot: Optional[Bot] = None
+        self._http: Optional[aiohttp.ClientSession] = None
+        self._openai: Optional[AsyncOpenAI] = None
+        self._openai_factory: Optional[Callable[[], AsyncOpenAI]] = None
+        self.http_sessions_created = 0
+
+    @property
+    def bot(self) -> Bot:
+        if self._bot is None:
+            if not self.token:
+                raise ValueError("TELEGRAM_BOT_TOKEN не встановлено в .env файлі")
+            self._bot = Bot(token=self.token)
+        return self._bot
+
+    @property
+    def http(self) -> aiohttp.ClientSession:
+        if self._http is None or self._http.closed:
+            self._http = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=HTTP_POOL_LIMIT, keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT),
+                timeout=aiohttp.ClientTimeout(total=HTTP_REQUEST_TIMEOUT)
+            )
+            self.http_sessions_created += 1
+        return self._http
+
+    def set_openai_factory(self, factory: Callable[[], AsyncOpenAI]):
+        self._openai_factory = factory
+
+    @property
+    def openai(self) -> Optional[AsyncOpenAI]:
+        if self._openai is None and self._openai_factory is not None:
+            self._openai = self._openai_factory()
+        return self._openai
+
+    async def close(self):
+        if self._openai is not None:
+            try:
+                await self._openai.close()
+                logger.info("OpenAI клієнт закрито")
+            except Exception as e:
+                logger.error(f"Помилка закриття OpenAI клієнта: {e}")
+            self._openai = None
+        if self._http is not None:
+            try:
+                await self._http.close()
+            except Exception as e:
+                logger.error(f"Помилка закриття HTTP сесії: {e}")
+            self._http = None
+        if self._bot is not None:
+            try:
+                await self._bot.session.close()
+            except Exception as e:
+                logger.error(f"Помилка закриття сесії бота: {e}")
+            self._bot = None
+
+    def get_stats(self):
+        return {
+            'bot': self._bot is not None,
+            'openai': self._openai is not None,
+            'http_open': self._http is not None and not self._http.closed,
+            'http_sessions_created': self.http_sessions_created
+        }
+
+resources = ResourceManager()
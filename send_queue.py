@@ -0,0 +1,312 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import os
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional, Set
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods.base import TelegramMethod
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', '30'))
+TELEGRAM_CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', '1'))
+TELEGRAM_GROUP_RATE = float(os.getenv('TELEGRAM_GROUP_RATE_PER_MINUTE', '20')) / 60
+TELEGRAM_CHAT_BURST = int(os.getenv('TELEGRAM_CHAT_BURST', '3'))
+SEND_MAX_RETRIES = int(os.getenv('TELEGRAM_SEND_MAX_RETRIES', '5'))
+SEND_SHUTDOWN_TIMEOUT = 10
+CHAT_IDLE_PURGE_INTERVAL = 60
+
+PRIORITY_ANSWER = 0
+PRIORITY_PROGRESS = 1
+PRIORITY_NOTIFY = 2
+PRIORITY_GROUP = 3
+
+PRIORITY_NAMES = {
+    PRIORITY_ANSWER: 'answer',
+    PRIORITY_PROGRESS: 'progress',
+    PRIORITY_NOTIFY: 'notify',
+    PRIORITY_GROUP: 'group'
+}
+
+class _TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: int, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = now
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready_at(self, now: float) -> float:
+        self.refill(now)
+        if self.tokens >= 1:
+            return now
+        return now + (1 - self.tokens) / self.rate
+
+    def consume(self, now: float):
+        self.refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self.refill(now)
+        return self.tokens >= self.capacity
+
+class _SendJob:
+    __slots__ = ('method', 'priority', 'future', 'attempts', 'max_retries', 'enqueued')
+
+    def __init__(self, method: TelegramMethod, priority: int, future: asyncio.Future, max_retries: int):
+        self.method = method
+        self.priority = priority
+        self.future = future
+        self.attempts = 0
+        self.max_retries = max_retries
+        self.enqueued = time.monotonic()
+
+class _ChatQueue:
+    __slots__ = ('chat_id', 'bucket', 'jobs', 'busy', 'scheduled', 'paused_until')
+
+    def __init__(self, chat_id: Any, bucket: _TokenBucket):
+        self.chat_id = chat_id
+        self.bucket = bucket
+        self.jobs: deque = deque()
+        self.busy = False
+        self.scheduled = False
+        self.paused_until = 0.0
+
+_sending = contextvars.ContextVar('send_queue_sending', default=False)
+
+class _QueueMiddleware(BaseRequestMiddleware):
+
+    def __init__(self, queue: 'SendQueue'):
+        self.queue = queue
+
+    async def __call__(self, make_request, bot: Bot, method: TelegramMethod):
+        if _sending.get() or not self.queue.accepts(method):
+            return await make_request(bot, method)
+        return await self.queue.enqueue(method, PRIORITY_ANSWER)
+
+class SendQueue:
+
+    def __init__(
+        self,
+        global_rate: float = TELEGRAM_GLOBAL_RATE,
+        chat_rate: float = TELEGRAM_CHAT_RATE,
+        group_rate: float = TELEGRAM_GROUP_RATE,
+        chat_burst: int = TELEGRAM_CHAT_BURST
+    ):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.bot: Optional[Bot] = None
+        self._global = _TokenBucket(global_rate, max(1, int(global_rate)), time.monotonic())
+        self._chats: Dict[Any, _ChatQueue] = {}
+        self._ready: List[tuple] = []
+        self._timers: List[tuple] = []
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._in_flight: Set[asyncio.Task] = set()
+        self._last_purge = time.monotonic()
+        self.depth = 0
+        self.max_depth = 0
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.wait_total = 0.0
+        self._middleware = _QueueMiddleware(self)
+
+    def start(self, bot: Bot):
+        self.bot = bot
+        if self._middleware not in bot.session.middleware:
+            bot.session.middleware(self._middleware)
+        if self._worker is None or self._worker.done():
+            self._wakeup = asyncio.Event()
+            self._worker = asyncio.create_task(self._run())
+
+    async def close(self, timeout: float = SEND_SHUTDOWN_TIMEOUT):
+        if self._worker is None:
+            return
+        deadline = time.monotonic() + timeout
+        while (self.depth or self._in_flight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self.depth:
+            logger.warning(f"Черга надсилання закрита, не надіслано повідомлень: {self.depth}")
+        self._worker.cancel()
+        for task in list(self._in_flight):
+            task.cancel()
+        await asyncio.gather(self._worker, *self._in_flight, return_exceptions=True)
+        self._worker = None
+
+    def enqueue(
+        self,
+        method: TelegramMethod,
+        priority: int = PRIORITY_NOTIFY,
+        max_retries: int = SEND_MAX_RETRIES
+    ) -> asyncio.Future:
+        if self._worker is None:
+            raise RuntimeError("Черга надсилання Telegram не запущена")
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_consume_result)
+        job = _SendJob(method, priority, future, max_retries)
+        chat = self._chat(getattr(method, 'chat_id', None))
+        chat.jobs.append(job)
+        self.depth += 1
+        self.max_depth = max(self.max_depth, self.depth)
+        self._schedule(chat, time.monotonic())
+        return future
+
+    def accepts(self, method: TelegramMethod) -> bool:
+        return self._worker is not None and getattr(method, 'chat_id', None) is not None
+
+    async def send(
+        self,
+        method: TelegramMethod,
+        priority: int = PRIORITY_ANSWER,
+        max_retries: int = SEND_MAX_RETRIES
+    ):
+        return await self.enqueue(method, priority, max_retries)
+
+    def _chat(self, chat_id: Any) -> _ChatQueue:
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            now = time.monotonic()
+            if chat_id is None:
+                bucket = _TokenBucket(self.global_rate, max(1, int(self.global_rate)), now)
+            elif isinstance(chat_id, str) or chat_id < 0:
+                bucket = _TokenBucket(self.group_rate, self.chat_burst, now)
+            else:
+                bucket = _TokenBucket(self.chat_rate, self.chat_burst, now)
+            chat = _ChatQueue(chat_id, bucket)
+            self._chats[chat_id] = chat
+        return chat
+
+    def _schedule(self, chat: _ChatQueue, now: float):
+        if chat.busy or chat.scheduled or not chat.jobs:
+            return
+        chat.scheduled = True
+        ready_at = max(chat.bucket.ready_at(now), chat.paused_until)
+        if ready_at <= now:
+            heapq.heappush(self._ready, (chat.jobs[0].priority, next(self._seq), chat.chat_id))
+        else:
+            heapq.heappush(self._timers, (ready_at, next(self._seq), chat.chat_id))
+        self._wakeup.set()
+
+    def _purge_idle(self, now: float):
+        self._last_purge = now
+        for chat_id in [
+            chat_id for chat_id, chat in self._chats.items()
+            if not chat.jobs and not chat.busy and not chat.scheduled
+            and chat.paused_until <= now and chat.bucket.is_full(now)
+        ]:
+            del self._chats[chat_id]
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            while self._timers and self._timers[0][0] <= now:
+                _, _, chat_id = heapq.heappop(self._timers)
+                chat = self._chats[chat_id]
+                chat.scheduled = False
+                self._schedule(chat, now)
+
+            if now - self._last_purge > CHAT_IDLE_PURGE_INTERVAL:
+                self._purge_idle(now)
+
+            if not self._ready:
+                timeout = self._timers[0][0] - now if self._timers else None
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            delay = self._global.ready_at(now) - now
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            _, _, chat_id = heapq.heappop(self._ready)
+            chat = self._chats[chat_id]
+            chat.scheduled = False
+            job = chat.jobs.popleft()
+            self.depth -= 1
+            if job.future.done():
+                self._schedule(chat, now)
+                continue
+
+            self._global.consume(now)
+            chat.bucket.consume(now)
+            chat.busy = True
+            task = asyncio.create_task(self._execute(chat, job))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _execute(self, chat: _ChatQueue, job: _SendJob):
+        _sending.set(True)
+        job.attempts += 1
+        try:
+            result = await self.bot(job.method)
+        except TelegramRetryAfter as e:
+            self.retried += 1
+            chat.paused_until = max(chat.paused_until, time.monotonic() + e.retry_after)
+            if job.attempts > job.max_retries:
+                self._fail(chat, job, e)
+            else:
+                logger.warning(
+                    f"Telegram обмежив надсилання в чат {chat.chat_id}, повтор через {e.retry_after} с"
+                )
+                chat.jobs.appendleft(job)
+                self.depth += 1
+        except Exception as e:
+            self._fail(chat, job, e)
+        else:
+            self.sent += 1
+            self.wait_total += time.monotonic() - job.enqueued
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            chat.busy = False
+            self._schedule(chat, time.monotonic())
+
+    def _fail(self, chat: _ChatQueue, job: _SendJob, error: Exception):
+        self.failed += 1
+        logger.error(f"Не вдалося надіслати {job.method.__api_method__} в чат {chat.chat_id}: {error}")
+        if not job.future.done():
+            job.future.set_exception(error)
+
+    def get_stats(self) -> Dict:
+        queued = {name: 0 for name in PRIORITY_NAMES.values()}
+        for chat in self._chats.values():
+            for job in chat.jobs:
+                name = PRIORITY_NAMES.get(job.priority, str(job.priority))
+                queued[name] = queued.get(name, 0) + 1
+        return {
+            'queued': self.depth,
+            'queued_by_priority': queued,
+            'max_depth': self.max_depth,
+            'in_flight': len(self._in_flight),
+            'chats': len(self._chats),
+            'sent': self.sent,
+            'retried': self.retried,
+            'failed': self.failed,
+            'avg_wait': round(self.wait_total / self.sent, 2) if self.sent else 0.0
+        }
+
+def _consume_result(future: asyncio.Future):
+    if not future.cancelled():
+        future.exception()
+
+send_queue = SendQueue()
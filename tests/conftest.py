@@ -0,0 +1,27 @@
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import async_db
+import db
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='test-db')
+    db.close_connection()
+    monkeypatch.setattr(db, 'DB_PATH', str(tmp_path / 'users.db'))
+    monkeypatch.setattr(async_db, '_executor', executor)
+    executor.submit(db.init_db).result()
+    yield db
+    executor.submit(db.close_connection).result()
+    executor.shutdown(wait=True)
+    db.close_connection()
+
+@pytest.fixture
+def user():
+    return SimpleNamespace(id=1234567, username='payer_one', first_name='Test', last_name=None)
@@ -0,0 +1,23 @@
+import asyncio
+from types import SimpleNamespace
+
+from async_db import UserActivityBuffer
+
+def _user(telegram_id):
+    return SimpleNamespace(id=telegram_id, username=f'user_{telegram_id}', first_name='Test', last_name=None)
+
+def test_known_users_are_bounded(database):
+    async def scenario():
+        buffer = UserActivityBuffer(max_known=2)
+        for telegram_id in (1111111, 2222222, 1111111, 3333333):
+            await buffer.resolve(_user(telegram_id))
+        known = list(buffer.known_users)
+        row, is_new = await buffer.resolve(_user(2222222))
+        return buffer, known, row, is_new
+
+    buffer, known, row, is_new = asyncio.run(scenario())
+    assert known == [1111111, 3333333]
+    assert row['telegram_id'] == 2222222 and not is_new
+    assert list(buffer.known_users) == [3333333, 2222222]
+    assert buffer.inserts == 3
+    assert set(buffer.pending) == {1111111}
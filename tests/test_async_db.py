@@ -0,0 +1,29 @@
+import asyncio
+
+import async_db
+
+SLOW_QUERY = 'WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM n WHERE x < ?) SELECT COUNT(*) FROM n'
+ROWS = 500_000
+
+def test_slow_query_does_not_stall_the_event_loop(database):
+    def slow_count():
+        return database.get_connection().execute(SLOW_QUERY, (ROWS,)).fetchone()[0]
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        lag = 0.0
+        ticks = 0
+        query = asyncio.ensure_future(async_db.run_db(slow_count))
+        started = loop.time()
+        while not query.done():
+            before = loop.time()
+            await asyncio.sleep(0)
+            lag = max(lag, loop.time() - before)
+            ticks += 1
+        return await query, loop.time() - started, lag, ticks
+
+    count, elapsed, lag, ticks = asyncio.run(scenario())
+    assert count == ROWS
+    assert elapsed > 0.1
+    assert lag < 0.02
+    assert ticks > 100
@@ -0,0 +1,69 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import additional_improvements
+
+def _holds(database):
+    return database.get_connection().execute('SELECT COUNT(*) FROM balance_holds').fetchone()[0]
+
+def test_concurrent_reserves_do_not_overdraw(database, user):
+    database.upsert_user(user)
+    database.set_balance(user.id, 1)
+    barrier = threading.Barrier(2)
+
+    def reserve():
+        barrier.wait()
+        try:
+            return database.reserve_balance(user.id, 1, 60)
+        finally:
+            database.close_connection()
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        results = list(pool.map(lambda _: reserve(), range(2)))
+
+    assert results.count(None) == 1
+    assert [result[1] for result in results if result is not None] == [0]
+    assert database.get_balance(user.id) == 0
+    assert _holds(database) == 1
+
+def test_commit_and_release_are_exclusive(database, user):
+    database.upsert_user(user)
+    opening = database.get_balance(user.id)
+
+    committed, _ = database.reserve_balance(user.id, 1, 60)
+    assert database.commit_hold(committed) is True
+    assert database.release_hold(committed) is None
+    assert database.get_balance(user.id) == opening - 1
+
+    released, _ = database.reserve_balance(user.id, 1, 60)
+    assert database.release_hold(released) == opening - 1
+    assert database.commit_hold(released) is False
+    assert database.release_hold(released) is None
+    assert database.get_balance(user.id) == opening - 1
+    assert _holds(database) == 0
+
+def test_expired_holds_are_refunded(database, user, monkeypatch):
+    database.upsert_user(user)
+    opening = database.get_balance(user.id)
+    database.reserve_balance(user.id, 1, 60)
+    expired, _ = database.reserve_balance(user.id, 1, -1)
+
+    assert database.release_expired_holds() == 1
+    assert database.get_balance(user.id) == opening - 1
+    assert database.commit_hold(expired) is False
+
+    database.reserve_balance(user.id, 1, -1)
+
+    async def recover():
+        task = asyncio.create_task(additional_improvements.recover_expired_holds(interval=3600))
+        deadline = time.monotonic() + 5
+        while _holds(database) > 1 and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(recover())
+    assert _holds(database) == 1
+    assert database.get_balance(user.id) == opening - 1
@@ -0,0 +1,78 @@
+import sqlite3
+
+import pytest
+
+import db
+
+def _ledger_matches_balances(database):
+    return database.get_connection().execute('''
+        SELECT u.telegram_id, u.balance, COALESCE(SUM(l.delta), 0)
+        FROM users u LEFT JOIN balance_ledger l ON l.telegram_id = u.telegram_id
+        GROUP BY u.telegram_id
+        HAVING u.balance <> COALESCE(SUM(l.delta), 0)
+    ''').fetchall() == []
+
+def test_ledger_is_append_only(database, user):
+    database.upsert_user(user)
+    conn = database.get_connection()
+
+    with pytest.raises(sqlite3.IntegrityError, match='append-only'):
+        conn.execute('UPDATE balance_ledger SET delta = delta + 100')
+    conn.rollback()
+    with pytest.raises(sqlite3.IntegrityError, match='append-only'):
+        conn.execute('DELETE FROM balance_ledger')
+    conn.rollback()
+    assert conn.execute('SELECT COUNT(*) FROM balance_ledger').fetchone()[0] == 1
+
+def test_ledger_sums_to_balance(database, user):
+    database.upsert_user(user)
+    kinds = [row[3] for row in database.get_balance_history(user.id)[0]]
+    assert kinds == [database.LEDGER_BONUS]
+    assert _ledger_matches_balances(database)
+
+    database.add_balance(user.id, 20)
+    database.record_payments([('txn-1', '0', 1, 5000, user.id, 50)], [])
+    assert _ledger_matches_balances(database)
+
+    hold_id, _ = database.reserve_balance(user.id, 1, 60)
+    database.commit_hold(hold_id)
+    refunded, _ = database.reserve_balance(user.id, 1, 60)
+    database.release_hold(refunded)
+    assert _ledger_matches_balances(database)
+
+    database.set_balance(user.id, 7, reference='operator')
+    database.subtract_balance(user.id, 2)
+    assert _ledger_matches_balances(database)
+    assert database.get_balance(user.id) == 5
+
+    history, _ = database.get_balance_history(user.id, limit=20)
+    assert [row[2] for row in history][0] == 5
+    assert [row[3] for row in reversed(history)] == [
+        database.LEDGER_BONUS, database.LEDGER_TOPUP, database.LEDGER_TOPUP,
+        database.LEDGER_DEBIT, database.LEDGER_DEBIT, database.LEDGER_REFUND,
+        database.LEDGER_ADJUST, database.LEDGER_ADJUST
+    ]
+
+def test_opening_rows_cover_existing_balances(tmp_path, monkeypatch):
+    db.close_connection()
+    monkeypatch.setattr(db, 'DB_PATH', str(tmp_path / 'legacy.db'))
+    conn = db.get_connection()
+    conn.execute('''
+        CREATE TABLE users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id BIGINT UNIQUE NOT NULL,
+            username TEXT, first_name TEXT, last_name TEXT, join_date TEXT,
+            balance INTEGER DEFAULT 0, last_payment_date TEXT,
+            total_payments INTEGER DEFAULT 0, last_active TEXT, is_blocked INTEGER DEFAULT 0
+        )
+    ''')
+    conn.executemany('INSERT INTO users (telegram_id, balance) VALUES (?, ?)', [(1111111, 12), (2222222, 0)])
+    conn.commit()
+    try:
+        db.init_db()
+        db.init_db()
+        assert _ledger_matches_balances(db)
+        kinds = conn.execute('SELECT telegram_id, kind FROM balance_ledger').fetchall()
+        assert [tuple(row) for row in kinds] == [(1111111, db.LEDGER_OPENING)]
+    finally:
+        db.close_connection()
@@ -0,0 +1,46 @@
+import sqlite3
+import threading
+
+class _SlowSnapshot:
+
+    def __init__(self, conn, during_read):
+        self.conn = conn
+        self.during_read = during_read
+
+    def cursor(self):
+        during_read = self.during_read
+
+        class Cursor(sqlite3.Cursor):
+            def execute(self, sql, *args):
+                result = super().execute(sql, *args)
+                if 'is_blocked=1' in sql:
+                    during_read()
+                return result
+
+        return self.conn.cursor(Cursor)
+
+def test_reconcile_does_not_revert_concurrent_block(database, user, monkeypatch):
+    database.upsert_user(user)
+    database.load_blocked_ids()
+    get_connection = database.get_connection
+    main = threading.current_thread()
+    blocker = threading.Thread(target=lambda: (database.block_user(user.id), database.close_connection()))
+
+    def during_read():
+        blocker.start()
+        blocker.join(timeout=0.2)
+
+    def connection():
+        if threading.current_thread() is main:
+            return _SlowSnapshot(get_connection(), during_read)
+        return get_connection()
+
+    monkeypatch.setattr(database, 'get_connection', connection)
+    database.load_blocked_ids()
+    blocker.join()
+    assert database.is_blocked_id(user.id)
+
+    monkeypatch.setattr(database, 'get_connection', get_connection)
+    database.unblock_user(user.id)
+    assert database.load_blocked_ids() == 0
+    assert not database.is_blocked_id(user.id)
@@ -0,0 +1,18 @@
+import pytest
+
+from openai_service import format_markdown
+
+ANSWER = (
+    '**Норми видачі**【4:0†source】\n'
+    '① Пальне для генератора: __20 л__ на добу[1].\n'
+    '- дизель: 15 л\n'
+    '- бензин:   5 л\n'
+    '2. Подати рапорт командиру.\n\n\n'
+    'Відповідно до наказу норма визначається за пробігом і типом двигуна【4:1†source】.\n'
+)
+
+@pytest.mark.parametrize('size', [1024, 4096, 32768], ids=['1KB', '4KB', '32KB'])
+def test_format_markdown_speed(benchmark, size):
+    text = (ANSWER * (size // len(ANSWER) + 1))[:size]
+    result = benchmark(format_markdown, text)
+    assert '【' not in result and '**' not in result
@@ -0,0 +1,94 @@
+import pytest
+
+from openai_service import MAX_MESSAGE_LENGTH, format_markdown, validate_message
+
+# Outputs recorded from the implementation that preceded the precompiled
+# patterns; any change here is a user-visible change in answer rendering.
+GOLDEN = [
+    ('empty', '',
+     ''),
+    ('plain', 'Звичайний текст без розмітки.',
+     'Звичайний текст без розмітки.'),
+    ('circled', '① Перший ② Другий ⑩ Десятий',
+     '1. Перший 2. Другий 10. Десятий'),
+    ('citation_source', 'Норма 20 л[1:2†source].',
+     'Норма 20 л.'),
+    ('citation_ua', 'Норма[3†джерело.] встановлена',
+     'Норма встановлена'),
+    ('citation_short', 'Див. наказ [12] та [7:1]',
+     'Див. наказ та'),
+    ('citation_bracket', 'Текст【4:0†file.pdf】 далі【x】',
+     'Текст далі'),
+    ('non_citation_brackets', 'Масив [a] і [1a] лишаються',
+     'Масив [a] і [1a] лишаються'),
+    ('only_citations', '[1][2]【3】',
+     ''),
+    ('bold', 'Це **важливо** і **дуже**',
+     'Це *важливо* і *дуже*'),
+    ('bold_unclosed', 'Це **не закрито',
+     'Це **не закрито'),
+    ('underline', 'Слово __підкреслене__ тут',
+     'Слово _підкреслене_ тут'),
+    ('bullets', 'Список:\n- перший\n  -   другий\n-третій',
+     'Список:\n\n• перший\n\n• другий\n\n• третій'),
+    ('hyphen_inline', 'Слово - тире всередині рядка',
+     'Слово - тире всередині рядка'),
+    ('numbered', 'Кроки:\n1. Подати\n2.Отримати\n  10.   Десятий',
+     'Кроки:\n\n1. Подати\n\n2. Отримати\n 10. Десятий'),
+    ('decimal_inline', 'Ціна 2.5 грн',
+     'Ціна 2.5 грн'),
+    ('list_break', 'Вступ\n• пункт\n3 одиниці',
+     'Вступ\n\n• пункт\n\n3 одиниці'),
+    ('spaces', 'Багато    пробілів   тут',
+     'Багато пробілів тут'),
+    ('blank_lines', 'Абзац\n\n\n\n\nІнший',
+     'Абзац\n\nІнший'),
+    ('strip', '   \n Текст \n  ',
+     'Текст'),
+    ('crlf', 'Рядок\r\n- пункт\r\n1. номер',
+     'Рядок\r\n\n• пункт\r\n\n1. номер'),
+    ('mixed', '**Норми**[1]\n① Пальне: __20 л__【2:1†a】\n- дизель\n2. бензин\n\n\n\nКінець  .',
+     '*Норми*\n\n1. Пальне: _20 л_\n\n• дизель\n\n2. бензин\n\nКінець .'),
+    ('leading_bullet', '- перший\n- другий',
+     '• перший\n\n• другий'),
+    ('bullet_chain', '-\n- пункт',
+     '• • пункт'),
+    ('bullet_dash_inline', '\n-5 градусів',
+     '• 5 градусів'),
+    ('numbered_chain', '1.\n2. пункт',
+     '1.\n 2. пункт'),
+    ('line_decimal', '2.5 літра\nабо\n3.5',
+     '2. 5 літра\nабо\n\n3. 5'),
+    ('blank_before_bullet', 'Вступ\n\n  \n  - пункт',
+     'Вступ\n\n• пункт'),
+    ('tabs', 'Рядок\t\n\t-\tпункт',
+     'Рядок\t\n\n• пункт'),
+    ('citation_in_bold', '**Норма [1] пального**【2:0†a】',
+     '*Норма пального*'),
+    ('circled_citation', 'Див. [①] і ③ крок',
+     'Див. і 3. крок'),
+    ('bold_crossing_underline', '**snake__case** і __x__',
+     '*snake_case* і _x__'),
+    ('spaces_after_citation', 'Текст [1] [2] далі',
+     'Текст далі'),
+    ('trailing_marker', 'Кінець\n-',
+     'Кінець\n\n•'),
+]
+
+@pytest.mark.parametrize('text, expected', [case[1:] for case in GOLDEN], ids=[case[0] for case in GOLDEN])
+def test_format_markdown_golden(text, expected):
+    assert format_markdown(text) == expected
+
+@pytest.mark.parametrize('message, valid', [
+    ('Яка норма пального?', True),
+    ('Час 10:30, x = 5', True),
+    ('', False),
+    ('   ', False),
+    ('a' * (MAX_MESSAGE_LENGTH + 1), False),
+    ('<SCRIPT>alert(1)</script>', False),
+    ('посилання JavaScript:void(0)', False),
+    ('<img onerror=x>', False),
+    ('<body ONLOAD=x>', False),
+])
+def test_validate_message(message, valid):
+    assert validate_message(message)[0] is valid
@@ -0,0 +1,72 @@
+import asyncio
+import importlib
+
+import pytest
+
+from resources import resources
+
+class FakeMessage:
+
+    def __init__(self, text, from_user):
+        self.text = text
+        self.from_user = from_user
+        self.answers = []
+
+    async def answer(self, text, **kwargs):
+        self.answers.append(text)
+        return self
+
+    async def edit_text(self, text, **kwargs):
+        return self
+
+    async def delete(self):
+        return True
+
+class FakeState:
+
+    async def get_data(self):
+        return {'service': '⛽️ ПММ'}
+
+    async def update_data(self, **kwargs):
+        pass
+
+class FakeSendQueue:
+
+    async def send(self, request, **kwargs):
+        return await request
+
+    def enqueue(self, request, **kwargs):
+        pass
+
+@pytest.fixture
+def bot_module(database, user, monkeypatch):
+    monkeypatch.setenv('TELEGRAM_BOT_TOKEN', '42:TEST')
+    monkeypatch.setattr(resources, 'token', '42:TEST')
+    module = importlib.import_module('bot')
+    monkeypatch.setattr(module, 'send_queue', FakeSendQueue())
+    module.service_rate_limiter.reset(user.id)
+    database.upsert_user(user)
+    return module
+
+def _holds(database):
+    return database.get_connection().execute('SELECT COUNT(*) FROM balance_holds').fetchone()[0]
+
+@pytest.mark.parametrize('outcome, charged', [
+    ('відповідь', 1),
+    ('❌ Помилка при обробці запиту.', 0),
+    (RuntimeError('boom'), 0)
+])
+def test_hold_is_committed_only_for_answers(bot_module, database, user, monkeypatch, outcome, charged):
+    opening = database.get_balance(user.id)
+
+    async def fake_response(*args, **kwargs):
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    monkeypatch.setattr(bot_module, 'get_service_response', fake_response)
+    message = FakeMessage('яка норма видачі пального для вантажівки', user)
+    asyncio.run(bot_module.handle_question(message, FakeState(), None))
+
+    assert database.get_balance(user.id) == opening - charged
+    assert _holds(database) == 0
@@ -0,0 +1,150 @@
+import asyncio
+import time
+
+import pytest
+from aiogram import Bot
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import monobank_payments
+from async_db import get_balance, run_db
+from resources import resources
+from send_queue import send_queue
+from test_send_queue import RecordingSession
+
+SECRET = 'hook-secret'
+
+class FakeMonobank:
+
+    def __init__(self):
+        self.statement = []
+        self.statement_requests = 0
+        self.registered = []
+
+    def app(self):
+        async def statement(request):
+            self.statement_requests += 1
+            return web.json_response(self.statement)
+
+        async def webhook(request):
+            self.registered.append((await request.json())['webHookUrl'])
+            return web.json_response({})
+
+        app = web.Application()
+        app.router.add_get('/personal/statement/{account}/{from_time}/{to_time}', statement)
+        app.router.add_post('/personal/webhook', webhook)
+        return app
+
+def statement_item(txn_id, amount, comment):
+    return {'id': txn_id, 'time': int(time.time()) - 5, 'amount': amount, 'comment': comment, 'description': 'Test'}
+
+def push(item):
+    return {'type': 'StatementItem', 'data': {'account': '0', 'statementItem': item}}
+
+@pytest.fixture
+def monobank(database, user, monkeypatch):
+    bank = FakeMonobank()
+    monkeypatch.setattr(monobank_payments, 'MONOBANK_API_TOKEN', 'test-token')
+    monkeypatch.setattr(monobank_payments, 'MONOBANK_WEBHOOK_SECRET', SECRET)
+    monkeypatch.setattr(monobank_payments, 'STATEMENT_MIN_INTERVAL', 0)
+    monkeypatch.setattr(monobank_payments, '_statement_hint', asyncio.Event())
+    asyncio.run(run_db(database.upsert_user, user))
+    return bank
+
+async def _balance(user_id):
+    return await get_balance(user_id)
+
+async def run_with_bank(bank, monkeypatch, scenario):
+    server = TestServer(bank.app())
+    await server.start_server()
+    monkeypatch.setattr(monobank_payments, 'MONOBANK_API_URL', str(server.make_url('')).rstrip('/'))
+    session = RecordingSession()
+    send_queue.start(Bot('42:TEST', session=session))
+    try:
+        await scenario()
+        await asyncio.sleep(0.05)
+    finally:
+        await send_queue.close()
+        await resources.close()
+        await server.close()
+    return session
+
+async def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        await asyncio.sleep(0.01)
+
+def test_forged_push_is_not_credited(monobank, user, monkeypatch):
+    opening = asyncio.run(_balance(user.id))
+
+    async def scenario():
+        checker = asyncio.create_task(monobank_payments.check_payments(interval=3600))
+        await wait_for(lambda: monobank.statement_requests == 1)
+        async with TestClient(TestServer(monobank_payments.create_monobank_app())) as client:
+            response = await client.post(f'/monobank/webhook/{SECRET}', json=push(statement_item('forged', 30000000, user.username)))
+            assert response.status == 200
+            await wait_for(lambda: monobank.statement_requests == 2)
+        checker.cancel()
+        await asyncio.gather(checker, return_exceptions=True)
+
+    session = asyncio.run(run_with_bank(monobank, monkeypatch, scenario))
+    assert asyncio.run(_balance(user.id)) == opening
+    assert not [call for call in session.calls if call.chat_id == user.id]
+
+def test_verified_push_is_credited_once(monobank, user, monkeypatch):
+    opening = asyncio.run(_balance(user.id))
+    item = statement_item('real-1', 5000, user.username)
+
+    async def scenario():
+        checker = asyncio.create_task(monobank_payments.check_payments(interval=3600))
+        await wait_for(lambda: monobank.statement_requests == 1)
+        monobank.statement = [item]
+        async with TestClient(TestServer(monobank_payments.create_monobank_app())) as client:
+            for _ in range(2):
+                await client.post(f'/monobank/webhook/{SECRET}', json=push(item))
+            await wait_for(lambda: monobank.statement_requests >= 2)
+            await client.post(f'/monobank/webhook/{SECRET}', json=push(item))
+            await wait_for(lambda: monobank.statement_requests >= 3)
+        checker.cancel()
+        await asyncio.gather(checker, return_exceptions=True)
+
+    session = asyncio.run(run_with_bank(monobank, monkeypatch, scenario))
+    assert asyncio.run(_balance(user.id)) == opening + 50
+    assert len([call for call in session.calls if call.chat_id == user.id]) == 1
+
+def test_unsigned_push_is_rejected(monobank, user, monkeypatch):
+    async def scenario():
+        async with TestClient(TestServer(monobank_payments.create_monobank_app())) as client:
+            for path in ('/monobank/webhook', '/monobank/webhook/wrong'):
+                response = await client.post(path, json=push(statement_item('forged', 30000000, user.username)))
+                assert response.status == 404
+        assert not monobank_payments._statement_hint.is_set()
+
+    asyncio.run(scenario())
+
+def test_non_object_push_is_rejected(monobank, monkeypatch):
+    async def scenario():
+        async with TestClient(TestServer(monobank_payments.create_monobank_app())) as client:
+            for body in ([push({'id': 'x', 'amount': 100})], 'StatementItem', None):
+                response = await client.post(f'/monobank/webhook/{SECRET}', json=body)
+                assert response.status == 400
+        assert not monobank_payments._statement_hint.is_set()
+
+    asyncio.run(scenario())
+
+def test_webhook_mode_requires_secret(monobank, monkeypatch):
+    intervals = []
+
+    async def check_payments(interval=monobank_payments.CHECK_INTERVAL):
+        intervals.append(interval)
+
+    monkeypatch.setattr(monobank_payments, 'MONOBANK_WEBHOOK_SECRET', '')
+    monkeypatch.setattr(monobank_payments, 'MONOBANK_WEBHOOK_URL', 'https://bot.example.com')
+    monkeypatch.setattr(monobank_payments, 'check_payments', check_payments)
+    with pytest.raises(ValueError):
+        monobank_payments.create_monobank_app()
+
+    asyncio.run(run_with_bank(monobank, monkeypatch, monobank_payments.start_payment_checker))
+    assert intervals == [monobank_payments.CHECK_INTERVAL]
+    assert monobank.registered == []
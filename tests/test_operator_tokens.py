@@ -0,0 +1,114 @@
+import asyncio
+import re
+
+import operator_menu
+from operator_menu import LIST_TOKEN_PATTERN, parse_list_token
+
+TELEGRAM_ID = 2 ** 52 - 1
+ROW_ID = 999_999_999
+LEDGER_ID = 9_999_999_999
+PAGE = 9999
+
+ROUTES = [
+    rf'op_users_({LIST_TOKEN_PATTERN})',
+    rf'op_profile_\d+_({LIST_TOKEN_PATTERN})',
+    rf'op_add_\d+_({LIST_TOKEN_PATTERN})',
+    rf'op_sub_\d+_({LIST_TOKEN_PATTERN})',
+    rf'op_block_\d+_({LIST_TOKEN_PATTERN})',
+    rf'op_hist_\d+_\d+_({LIST_TOKEN_PATTERN})',
+    r'op_menu()'
+]
+
+def _callback_data(keyboard):
+    return [button.callback_data for row in keyboard.inline_keyboard for button in row]
+
+def _route_token(data):
+    for route in ROUTES:
+        match = re.fullmatch(route, data)
+        if match:
+            return match.group(1)
+    raise AssertionError(f'no handler for {data}')
+
+def test_list_tokens_round_trip_within_callback_limit():
+    users = [(TELEGRAM_ID, 'u' * 32, 'Ім', None, ROW_ID - 1), (TELEGRAM_ID, None, 'Ім', None, ROW_ID)]
+    keyboards = []
+    for sort in operator_menu.SORT_LABELS:
+        keyboards.append(operator_menu.get_users_list_keyboard(sort, PAGE, users, True, True))
+        token = f'{sort}{PAGE}@{ROW_ID}'
+        keyboards.append(operator_menu.get_profile_keyboard(TELEGRAM_ID, token, False))
+        assert parse_list_token(token) == (sort, PAGE, '@', ROW_ID)
+
+    data = [item for keyboard in keyboards for item in _callback_data(keyboard)]
+    data.append(f'op_hist_{TELEGRAM_ID}_{LEDGER_ID}_b{PAGE}@{ROW_ID}')
+    for item in data:
+        assert 1 <= len(item.encode('utf-8')) <= 64, item
+        token = _route_token(item)
+        if token:
+            sort, page, direction, anchor = parse_list_token(token)
+            assert f'{sort}{page}{direction}{anchor}' == token
+
+    list_data = _callback_data(operator_menu.get_users_list_keyboard('b', PAGE, users, True, True))
+    assert f'op_users_b{PAGE - 1}<{ROW_ID - 1}' in list_data
+    assert f'op_users_b{PAGE + 1}>{ROW_ID}' in list_data
+    assert f'op_profile_{TELEGRAM_ID}_b{PAGE}@{ROW_ID - 1}' in list_data
+
+def test_malformed_token_falls_back_to_first_page():
+    assert parse_list_token('x1@0') == ('j', 1, '@', 0)
+    assert parse_list_token(operator_menu.DEFAULT_LIST_TOKEN) == ('j', 1, '@', 0)
+
+class FakeState:
+
+    def __init__(self, data):
+        self.data = data
+
+    async def get_data(self):
+        return dict(self.data)
+
+    async def update_data(self, **kwargs):
+        self.data.update(kwargs)
+
+class FakeCallback:
+
+    def __init__(self, data):
+        self.data = data
+        self.edits = []
+        self.alerts = []
+        self.message = self
+
+    async def edit_text(self, text, reply_markup=None):
+        self.edits.append((text, _callback_data(reply_markup)))
+
+    async def answer(self, text=None, show_alert=False):
+        if text:
+            self.alerts.append(text)
+
+def test_search_pages_walk_with_stored_cursors(database, monkeypatch):
+    monkeypatch.setattr(database, 'SEARCH_MAX_CANDIDATES', 15)
+    conn = database.get_connection()
+    conn.executemany(
+        'INSERT INTO users (telegram_id, username, first_name, last_active) VALUES (?, ?, ?, ?)',
+        [(1000000 + i, f'user_{i}', 'Петренко', '') for i in range(25)]
+    )
+    conn.commit()
+    monkeypatch.setattr(operator_menu, 'SEARCH_MAX_CANDIDATES', 15)
+    users, _, _ = database.search_users('петренко', operator_menu.SEARCH_PAGE_SIZE)
+    state = FakeState({'search_query': 'петренко', 'search_cursors': [None, operator_menu.search_cursor(users)]})
+
+    async def open_page(page):
+        callback = FakeCallback(f'op_search_page_{page}')
+        await operator_menu.operator_user_search_page(callback, state)
+        return callback
+
+    second = asyncio.run(open_page(2))
+    text, buttons = second.edits[0]
+    assert 'сторінка 2' in text and '⚠️' in text
+    assert 'op_search_page_1' in buttons and 'op_search_page_3' not in buttons
+    shown = [data for data in buttons if data.startswith('op_profile_')]
+    assert len(shown) == 5
+    assert not set(shown) & {f'op_profile_{user[0]}_{operator_menu.DEFAULT_LIST_TOKEN}' for user in users}
+
+    first = asyncio.run(open_page(1))
+    assert [data for data in first.edits[0][1] if data.startswith('op_profile_')] == [
+        f'op_profile_{user[0]}_{operator_menu.DEFAULT_LIST_TOKEN}' for user in users
+    ]
+    assert asyncio.run(open_page(5)).alerts == ['Пошук застарів. Почніть новий пошук.']
@@ -0,0 +1,47 @@
+from types import SimpleNamespace
+
+import pytest
+
+import rate_limiter
+from rate_limiter import RateLimiter
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = SimpleNamespace(value=1000.0)
+    monkeypatch.setattr(rate_limiter, 'time', SimpleNamespace(monotonic=lambda: now.value))
+    return now
+
+def test_burst_then_steady_rate(clock):
+    limiter = RateLimiter(max_requests=5, window_seconds=60, sweep_interval=3600)
+
+    assert [limiter.is_allowed(1)[0] for _ in range(5)] == [True] * 5
+    assert limiter.is_allowed(1) == (False, 13)
+    assert limiter.get_stats(1)['requests_count'] == 5
+    assert limiter.is_allowed(2) == (True, 0)
+
+    clock.value += 11.5
+    assert limiter.is_allowed(1) == (False, 1)
+    clock.value += 0.5
+    assert limiter.is_allowed(1) == (True, 0)
+    assert limiter.is_allowed(1)[0] is False
+
+    clock.value += 60
+    assert limiter.get_stats(1)['requests_count'] == 0
+    assert [limiter.is_allowed(1)[0] for _ in range(6)] == [True] * 5 + [False]
+
+def test_idle_users_are_evicted(clock):
+    limiter = RateLimiter(max_requests=10, window_seconds=60, sweep_interval=30)
+    for user_id in range(100):
+        limiter.is_allowed(user_id)
+    assert len(limiter.users) == 100
+
+    clock.value += 7
+    limiter.is_allowed(1000)
+    limiter.is_allowed(1000)
+    clock.value += 30
+    limiter.is_allowed(1000)
+    assert list(limiter.users) == [1000]
+
+    limiter.reset(1000)
+    assert limiter.users == {}
+    assert limiter.get_stats(1000) == {'requests_count': 0, 'max_requests': 10, 'window_seconds': 60}
@@ -0,0 +1,60 @@
+def test_missing_user_does_not_roll_back_batch(database, user):
+    database.upsert_user(user)
+    opening = database.get_balance(user.id)
+
+    credited, recorded = database.record_payments(
+        [
+            ('txn-ok', '0', 1, 5000, user.id, 50),
+            ('txn-gone', '0', 2, 7000, 7654321, 70)
+        ],
+        [('txn-unknown', '0', 3, 100)]
+    )
+
+    assert credited == [('txn-ok', user.id, opening + 50)]
+    assert sorted(recorded) == ['txn-gone', 'txn-unknown']
+    assert database.get_balance(user.id) == opening + 50
+    assert database.get_processed_txn_ids(['txn-ok', 'txn-gone', 'txn-unknown']) == {'txn-ok', 'txn-gone', 'txn-unknown'}
+    status = database.get_connection().execute(
+        'SELECT status FROM processed_transactions WHERE txn_id=?', ('txn-gone',)
+    ).fetchone()[0]
+    assert status == database.PAYMENT_UNMATCHED
+
+    assert database.record_payments([('txn-gone', '0', 2, 7000, user.id, 70)], []) == ([], [])
+
+def test_case_colliding_usernames_resolve_like_single_lookup(database):
+    conn = database.get_connection()
+    conn.executemany(
+        'INSERT INTO users (telegram_id, username, last_active) VALUES (?, ?, ?)',
+        [(1111111, 'Payer_One', '2024-05-01T10:00:00'), (2222222, 'payer_one', '2024-01-01T10:00:00')]
+    )
+    conn.commit()
+
+    by_username, by_id = database.find_users_by_identifiers(['PAYER_ONE'], [2222222])
+    assert database.find_user_by_username('payer_one')[0] == 1111111
+    assert by_username['payer_one'][0] == 1111111
+    assert by_id[2222222][0] == 2222222
+
+    conn.execute("UPDATE users SET last_active='2024-06-01T10:00:00' WHERE telegram_id=2222222")
+    conn.commit()
+    by_username, _ = database.find_users_by_identifiers(['payer_one'], [])
+    assert by_username['payer_one'][0] == database.find_user_by_username('payer_one')[0] == 2222222
+
+def test_username_lookups_are_served_by_the_nocase_index(database):
+    conn = database.get_connection()
+    batch = [row[3] for row in conn.execute('''
+        EXPLAIN QUERY PLAN
+        SELECT telegram_id, username, last_active FROM users
+        WHERE username COLLATE NOCASE IN (?, ?)
+        ORDER BY last_active DESC
+    ''', ('payer_one', 'payer_two'))]
+    single = [row[3] for row in conn.execute('''
+        EXPLAIN QUERY PLAN
+        SELECT telegram_id, username, first_name, last_name FROM users
+        WHERE username=? COLLATE NOCASE
+        ORDER BY last_active DESC
+        LIMIT 1
+    ''', ('payer_one',))]
+
+    assert any('USING COVERING INDEX idx_users_username_active' in step for step in batch)
+    assert any('USING INDEX idx_users_username_active' in step for step in single)
+    assert not any('TEMP B-TREE' in step for step in single)
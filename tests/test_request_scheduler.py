@@ -0,0 +1,69 @@
+import asyncio
+
+import request_scheduler
+from request_scheduler import RequestScheduler
+
+def test_queue_positions_interleave_users_and_lanes(monkeypatch):
+    monkeypatch.setattr(request_scheduler, 'PRIORITY_WEIGHT', 2)
+    scheduler = RequestScheduler(concurrency=1, priority_users={100})
+    positions = {}
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def hold():
+            await release.wait()
+
+        def notify(key):
+            async def on_queue(position, eta):
+                positions.setdefault(key, position)
+            return on_queue
+
+        running = asyncio.create_task(scheduler.run('svc', 0, hold))
+        await asyncio.sleep(0)
+        waiters = [
+            asyncio.create_task(scheduler.run('svc', user_id, hold, notify((user_id, n))))
+            for user_id, n in [(1, 0), (1, 1), (2, 0), (100, 0), (100, 1), (100, 2), (3, 0)]
+        ]
+        await asyncio.sleep(0.01)
+        order = [(ticket.user_id, ticket.lane) for ticket in scheduler.services['svc'].ordered_tickets()]
+        release.set()
+        await asyncio.gather(running, *waiters)
+        await scheduler.close()
+        return order
+
+    order = asyncio.run(scenario())
+    assert order == [
+        (100, 'priority'), (100, 'priority'), (1, 'normal'), (100, 'priority'),
+        (2, 'normal'), (3, 'normal'), (1, 'normal')
+    ]
+    assert positions[(100, 0)] == 1 and positions[(3, 0)] == 6
+
+def test_close_cancels_pending_notifications():
+    scheduler = RequestScheduler(concurrency=1)
+    started = []
+
+    async def slow_notify(position, eta):
+        started.append(position)
+        await asyncio.sleep(3600)
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def hold():
+            await release.wait()
+
+        running = asyncio.create_task(scheduler.run('svc', 1, hold))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(scheduler.run('svc', 2, hold, slow_notify))
+        await asyncio.sleep(0.01)
+        notifications = set(scheduler._notifications)
+        await scheduler.close()
+        release.set()
+        await asyncio.gather(running, waiter)
+        return notifications
+
+    notifications = asyncio.run(scenario())
+    assert started == [1]
+    assert len(notifications) == 1 and all(task.cancelled() for task in notifications)
+    assert scheduler._notifications == set()
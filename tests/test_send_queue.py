@@ -0,0 +1,66 @@
+import asyncio
+import time
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import AnswerCallbackQuery, SendMessage
+
+from send_queue import SendQueue
+
+class RecordingSession(BaseSession):
+
+    def __init__(self, retry_after: int = 0):
+        super().__init__()
+        self.retry_after = retry_after
+        self.calls = []
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls.append(method)
+        if self.retry_after:
+            raise TelegramRetryAfter(method=method, message='Too Many Requests', retry_after=self.retry_after)
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b''
+
+    async def close(self):
+        pass
+
+def test_direct_calls_are_routed_through_queue():
+    async def scenario():
+        session = RecordingSession()
+        bot = Bot('42:TEST', session=session)
+        queue = SendQueue(chat_rate=1000, chat_burst=10)
+        queue.start(bot)
+        queue.start(bot)
+        try:
+            await bot(SendMessage(chat_id=1, text='hi'))
+            await queue.send(SendMessage(chat_id=1, text='queued'))
+            await bot(AnswerCallbackQuery(callback_query_id='1'))
+        finally:
+            await queue.close()
+        return session, queue
+
+    session, queue = asyncio.run(scenario())
+    assert len(session.middleware) == 1
+    assert [type(call).__name__ for call in session.calls] == ['SendMessage', 'SendMessage', 'AnswerCallbackQuery']
+    assert queue.sent == 2
+
+def test_exhausted_retry_after_still_pauses_chat():
+    async def scenario():
+        session = RecordingSession(retry_after=30)
+        bot = Bot('42:TEST', session=session)
+        queue = SendQueue()
+        queue.start(bot)
+        try:
+            await queue.send(SendMessage(chat_id=7, text='hi'), max_retries=0)
+        except TelegramRetryAfter:
+            pass
+        paused_until = queue._chats[7].paused_until
+        await queue.close()
+        return queue, paused_until
+
+    queue, paused_until = asyncio.run(scenario())
+    assert queue.failed == 1
+    assert paused_until > time.monotonic() + 25
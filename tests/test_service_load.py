@@ -0,0 +1,90 @@
+import asyncio
+from types import SimpleNamespace
+
+import openai_service
+from additional_improvements import ThreadStore
+from request_scheduler import RequestScheduler
+from resources import resources
+
+USERS = 8
+LATENCY = 0.02
+RUN_TIME = 0.3
+
+class SlowAssistant:
+
+    def __init__(self):
+        self.active = 0
+        self.max_active = 0
+        self.finish_at = {}
+        self.threads = 0
+        runs = SimpleNamespace(create=self.create_run, retrieve=self.retrieve)
+        messages = SimpleNamespace(create=self.create_message, list=self.list_messages)
+        self.beta = SimpleNamespace(threads=SimpleNamespace(create=self.create_thread, runs=runs, messages=messages))
+
+    async def create_thread(self):
+        await asyncio.sleep(LATENCY)
+        self.threads += 1
+        return SimpleNamespace(id=f'thread-{self.threads}')
+
+    async def create_message(self, thread_id, role, content):
+        await asyncio.sleep(LATENCY)
+
+    async def create_run(self, thread_id, assistant_id):
+        await asyncio.sleep(LATENCY)
+        self.finish_at[thread_id] = asyncio.get_running_loop().time() + RUN_TIME
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        return SimpleNamespace(id=f'run-{thread_id}')
+
+    async def retrieve(self, thread_id, run_id):
+        await asyncio.sleep(LATENCY)
+        if asyncio.get_running_loop().time() < self.finish_at[thread_id]:
+            return SimpleNamespace(status='in_progress')
+        self.active -= 1
+        return SimpleNamespace(status='completed')
+
+    async def list_messages(self, thread_id, order, limit):
+        await asyncio.sleep(LATENCY)
+        text = SimpleNamespace(value=f'відповідь для {thread_id}')
+        return SimpleNamespace(data=[SimpleNamespace(role='assistant', content=[SimpleNamespace(text=text)])])
+
+def test_concurrent_questions_overlap_without_blocking_the_loop(database, monkeypatch):
+    assistant = SlowAssistant()
+    monkeypatch.setattr(resources, '_openai', assistant)
+    monkeypatch.setattr(openai_service, 'thread_store', ThreadStore())
+    monkeypatch.setattr(openai_service, 'ANSWER_CACHE_ENABLED', False)
+    monkeypatch.setattr(openai_service, 'request_scheduler', RequestScheduler(concurrency=USERS))
+    monkeypatch.setattr(openai_service, 'run_multiplexer', openai_service.RunMultiplexer(max_poll_rate=1000, min_interval=0.05))
+    service = next(iter(openai_service.SERVICE_ASSISTANTS))
+    monkeypatch.setitem(openai_service.SERVICE_ASSISTANTS, service, 'asst-test')
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        lag = 0.0
+        done = asyncio.Event()
+
+        async def probe():
+            nonlocal lag
+            while not done.is_set():
+                before = loop.time()
+                await asyncio.sleep(0)
+                lag = max(lag, loop.time() - before)
+                await asyncio.sleep(0.005)
+
+        probing = asyncio.create_task(probe())
+        started = loop.time()
+        answers = await asyncio.gather(*(
+            openai_service.get_service_response(service, f'питання номер {user_id} про норми видачі', user_id)
+            for user_id in range(1, USERS + 1)
+        ))
+        elapsed = loop.time() - started
+        done.set()
+        await probing
+        await openai_service.run_multiplexer.close()
+        return answers, elapsed, lag
+
+    answers, elapsed, lag = asyncio.run(scenario())
+    assert len(set(answers)) == USERS and not any(answer.startswith('❌') for answer in answers)
+    assert assistant.max_active == USERS
+    assert elapsed < RUN_TIME * 3
+    assert lag < 0.05
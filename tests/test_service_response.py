@@ -0,0 +1,166 @@
+import asyncio
+from types import SimpleNamespace
+
+import openai_service
+from additional_improvements import AnswerCache, ThreadStore
+from resources import resources
+
+FIRST = 'яка норма видачі пального для вантажівки'
+SECOND = 'скільки пального видається на генератор'
+
+class RecordingOpenAI:
+
+    def __init__(self):
+        self.messages = []
+        self.beta = SimpleNamespace(threads=SimpleNamespace(messages=SimpleNamespace(create=self.create)))
+
+    async def create(self, thread_id, role, content):
+        self.messages.append((thread_id, role, content))
+
+def test_cached_answers_stay_cached_for_the_same_user(database, monkeypatch):
+    client = RecordingOpenAI()
+    store = ThreadStore()
+    monkeypatch.setattr(resources, '_openai', client)
+    monkeypatch.setattr(openai_service, 'thread_store', store)
+    monkeypatch.setattr(openai_service, 'answer_cache', AnswerCache())
+    monkeypatch.setattr(openai_service, 'ANSWER_CACHE_ENABLED', True)
+    monkeypatch.setattr(openai_service, '_pending_exchanges', openai_service.OrderedDict())
+
+    async def not_cached(*args, **kwargs):
+        raise AssertionError('cached question reached the assistant')
+
+    monkeypatch.setattr(openai_service, '_run_scheduled', not_cached)
+    service = next(iter(openai_service.SERVICE_ASSISTANTS))
+    monkeypatch.setitem(openai_service.SERVICE_ASSISTANTS, service, 'asst-test')
+
+    async def scenario():
+        await openai_service.answer_cache.put(service, FIRST, 'перша')
+        await openai_service.answer_cache.put(service, SECOND, 'друга')
+        first = await openai_service.get_service_response(service, FIRST, 1)
+        second = await openai_service.get_service_response(service, SECOND, 1)
+        thread_id = await store.get(1, service)
+        await openai_service._seed_exchanges('thread-1', service, 1)
+        return first, second, thread_id
+
+    first, second, thread_id = asyncio.run(scenario())
+    assert (first, second) == ('перша', 'друга')
+    assert thread_id is None
+    assert client.messages == [
+        ('thread-1', 'user', FIRST), ('thread-1', 'assistant', 'перша'),
+        ('thread-1', 'user', SECOND), ('thread-1', 'assistant', 'друга')
+    ]
+    assert not openai_service._pending_exchanges
+
+def test_user_with_thread_gets_cache_hit_and_follow_ups_skip_cache(database, monkeypatch):
+    client = RecordingOpenAI()
+    store = ThreadStore()
+    monkeypatch.setattr(resources, '_openai', client)
+    monkeypatch.setattr(openai_service, 'thread_store', store)
+    monkeypatch.setattr(openai_service, 'answer_cache', AnswerCache())
+    monkeypatch.setattr(openai_service, 'ANSWER_CACHE_ENABLED', True)
+    monkeypatch.setattr(openai_service, '_pending_exchanges', openai_service.OrderedDict())
+    scheduled = []
+
+    async def run_scheduled(service_name, assistant_id, user_message, *args):
+        scheduled.append(user_message)
+        return 'з треду'
+
+    monkeypatch.setattr(openai_service, '_run_scheduled', run_scheduled)
+    service = next(iter(openai_service.SERVICE_ASSISTANTS))
+    monkeypatch.setitem(openai_service.SERVICE_ASSISTANTS, service, 'asst-test')
+    follow_up = 'а скільки для нього на тиждень'
+
+    async def scenario():
+        await store.set(1, service, 'thread-1')
+        await openai_service.answer_cache.put(service, FIRST, 'перша')
+        await openai_service.answer_cache.put(service, follow_up, 'не для кешу')
+        cached = await openai_service.get_service_response(service, FIRST, 1)
+        answered = await openai_service.get_service_response(service, follow_up, 1)
+        await openai_service._seed_exchanges(await store.get(1, service), service, 1)
+        return cached, answered
+
+    assert asyncio.run(scenario()) == ('перша', 'з треду')
+    assert scheduled == [follow_up]
+    assert client.messages == [('thread-1', 'user', FIRST), ('thread-1', 'assistant', 'перша')]
+
+def test_broadcast_does_not_wait_on_listeners_in_turn():
+    async def scenario():
+        flight = openai_service._Flight(asyncio.get_running_loop().create_future())
+        received = []
+
+        async def slow(text):
+            await asyncio.sleep(0.2)
+            received.append(('slow', text))
+
+        async def failing(text):
+            raise RuntimeError('flood control')
+
+        async def fast(text):
+            received.append(('fast', text))
+
+        flight.listeners.extend([slow, failing, slow, fast])
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        await flight.broadcast('a')
+        return received, loop.time() - started
+
+    received, elapsed = asyncio.run(scenario())
+    assert received == [('fast', 'a'), ('slow', 'a'), ('slow', 'a')]
+    assert elapsed < 0.35
+
+def test_multiplexer_tracks_and_cancels_poll_tasks(monkeypatch):
+    retrieving = []
+
+    async def retrieve(thread_id, run_id):
+        retrieving.append(run_id)
+        await asyncio.sleep(3600)
+
+    runs = SimpleNamespace(retrieve=retrieve)
+    monkeypatch.setattr(resources, '_openai', SimpleNamespace(beta=SimpleNamespace(threads=SimpleNamespace(runs=runs))))
+
+    async def scenario():
+        multiplexer = openai_service.RunMultiplexer(max_poll_rate=100, min_interval=0.01)
+        waiter = asyncio.create_task(multiplexer.wait('thread-1', 'run-1', timeout=3600))
+        while not retrieving:
+            await asyncio.sleep(0.01)
+        polls = set(multiplexer._polls)
+        await multiplexer.close()
+        results = await asyncio.gather(waiter, return_exceptions=True)
+        return polls, multiplexer._polls, results
+
+    polls, remaining, results = asyncio.run(scenario())
+    assert len(polls) == 1 and all(task.cancelled() for task in polls)
+    assert remaining == set()
+    assert isinstance(results[0], asyncio.CancelledError)
+
+def test_timed_out_run_is_cancelled_and_released(monkeypatch):
+    cancelled = []
+
+    async def create(thread_id, assistant_id):
+        return SimpleNamespace(id='run-1')
+
+    async def retrieve(thread_id, run_id):
+        return SimpleNamespace(status='in_progress')
+
+    async def cancel(run_id, thread_id):
+        cancelled.append(run_id)
+
+    runs = SimpleNamespace(create=create, retrieve=retrieve, cancel=cancel)
+    monkeypatch.setattr(resources, '_openai', SimpleNamespace(beta=SimpleNamespace(threads=SimpleNamespace(runs=runs))))
+    multiplexer = openai_service.RunMultiplexer(max_poll_rate=100, min_interval=0.01)
+    wait = multiplexer.wait
+
+    async def short_wait(thread_id, run_id):
+        return await wait(thread_id, run_id, timeout=0.05)
+
+    monkeypatch.setattr(multiplexer, 'wait', short_wait)
+    monkeypatch.setattr(openai_service, 'run_multiplexer', multiplexer)
+
+    async def scenario():
+        response = await openai_service._wait_run_polling('thread-1', 'asst-test', 1)
+        await multiplexer.close()
+        return response
+
+    assert asyncio.run(scenario()).startswith('❌')
+    assert cancelled == ['run-1']
+    assert multiplexer.pending == {} and multiplexer._polls == set()
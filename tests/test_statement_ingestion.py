@@ -0,0 +1,98 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import monobank_payments
+
+NOW = 1_700_000_000
+DAY = 24 * 3600
+
+class FakeStatement:
+
+    def __init__(self, pages=None):
+        self.pages = list(pages or [])
+        self.requests = []
+
+    async def __call__(self, from_time, to_time):
+        self.requests.append((from_time, to_time))
+        return self.pages.pop(0) if self.pages else []
+
+class FakeSendQueue:
+
+    def __init__(self):
+        self.sent = []
+
+    def enqueue(self, request, **kwargs):
+        self.sent.append(request)
+
+@pytest.fixture
+def statement(database, user, monkeypatch):
+    fake = FakeStatement()
+    monkeypatch.setattr(monobank_payments, 'get_monobank_transactions', fake)
+    monkeypatch.setattr(monobank_payments, 'send_queue', FakeSendQueue())
+    monkeypatch.setattr(monobank_payments, 'time', SimpleNamespace(time=lambda: NOW, monotonic=time.monotonic))
+    monkeypatch.setattr(monobank_payments, 'MONOBANK_ACCOUNT', '0')
+    database.upsert_user(user)
+    return fake
+
+def payment(txn_id, txn_time, comment, amount=5000):
+    return {'id': txn_id, 'time': txn_time, 'amount': amount, 'comment': comment, 'description': 'Test'}
+
+def test_long_gap_is_split_into_windows(statement, database):
+    database.set_payment_cursor('0', NOW - 70 * DAY)
+
+    assert asyncio.run(monobank_payments.sync_statement()) is True
+    windows = statement.requests
+    assert windows[0][0] == NOW - 70 * DAY - monobank_payments.STATEMENT_OVERLAP
+    assert windows[-1][1] == NOW
+    assert len(windows) == 3
+    for (from_time, to_time), (next_from, _) in zip(windows, windows[1:]):
+        assert to_time - from_time <= monobank_payments.STATEMENT_MAX_WINDOW
+        assert next_from == to_time
+    assert database.get_payment_cursor('0') == NOW
+
+def test_full_page_requests_the_older_remainder(statement, database, user):
+    database.set_payment_cursor('0', NOW - 600)
+    from_time = NOW - 600 - monobank_payments.STATEMENT_OVERLAP
+    page = [
+        {'id': f'out-{i}', 'time': NOW - i, 'amount': -100}
+        for i in range(monobank_payments.STATEMENT_PAGE_SIZE)
+    ]
+    statement.pages = [page, [payment('older', from_time + 1, user.username)]]
+
+    opening = database.get_balance(user.id)
+    asyncio.run(monobank_payments.sync_statement())
+    assert statement.requests == [(from_time, NOW), (from_time, page[-1]['time'])]
+    assert database.get_balance(user.id) == opening + 50
+
+def test_cursor_advances_only_after_payments_commit(statement, database, user, monkeypatch):
+    record_payments = monobank_payments.record_payments
+
+    async def failing(*args):
+        raise RuntimeError('database is locked')
+
+    statement.pages = [[payment('txn-1', NOW - 10, user.username)]]
+    monkeypatch.setattr(monobank_payments, 'record_payments', failing)
+    with pytest.raises(RuntimeError):
+        asyncio.run(monobank_payments.sync_statement())
+    assert database.get_payment_cursor('0') is None
+
+    statement.pages = [[payment('txn-1', NOW - 10, user.username)]]
+    monkeypatch.setattr(monobank_payments, 'record_payments', record_payments)
+    assert asyncio.run(monobank_payments.sync_statement()) is True
+    assert database.get_payment_cursor('0') == NOW
+    assert database.get_processed_txn_ids(['txn-1']) == {'txn-1'}
+
+def test_repeated_transaction_is_credited_once(statement, database, user):
+    opening = database.get_balance(user.id)
+    item = payment('txn-1', NOW - 10, user.username)
+    statement.pages = [[item, dict(item)], [dict(item)]]
+
+    asyncio.run(monobank_payments.sync_statement())
+    asyncio.run(monobank_payments.sync_statement())
+
+    assert len(statement.requests) == 2
+    assert database.get_balance(user.id) == opening + 50
+    assert len(monobank_payments.send_queue.sent) == 1
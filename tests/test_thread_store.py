@@ -0,0 +1,43 @@
+import asyncio
+
+import additional_improvements
+from additional_improvements import AnswerCache, ThreadStore
+
+def test_thread_store_skips_unchanged_writes(database, monkeypatch):
+    writes = []
+    save = additional_improvements.save_user_thread
+    monkeypatch.setattr(additional_improvements, 'save_user_thread', lambda *args: writes.append(args) or save(*args))
+
+    async def scenario():
+        store = ThreadStore(touch_interval=3600)
+        await store.set(1, 'svc', 'thread-a')
+        await store.set(1, 'svc', 'thread-a')
+        await store.set(1, 'svc', 'thread-b')
+        cached = await store.get(1, 'svc')
+        reloaded = await ThreadStore().get(1, 'svc')
+        removed = await store.clear(1)
+        return cached, reloaded, removed, await ThreadStore().get(1, 'svc')
+
+    cached, reloaded, removed, after_clear = asyncio.run(scenario())
+    assert [args[2] for args in writes] == ['thread-a', 'thread-b']
+    assert cached == reloaded == 'thread-b'
+    assert removed == ['thread-b']
+    assert after_clear is None
+
+def test_answer_cache_persists_and_evicts(database):
+    question = 'яка норма видачі пального для вантажівки'
+
+    async def scenario():
+        cache = AnswerCache(max_entries=1)
+        await cache.put('svc', question, 'відповідь')
+        hit = await cache.get('svc', question.upper() + '?')
+        await cache.put('svc', 'скільки пального видається на генератор', 'інша')
+        evicted = await cache.get('svc', question)
+        reloaded = AnswerCache(max_entries=10)
+        return hit, evicted, await reloaded.get('svc', 'скільки пального видається на генератор'), len(reloaded.entries)
+
+    hit, evicted, reloaded_hit, reloaded_entries = asyncio.run(scenario())
+    assert hit == 'відповідь'
+    assert evicted is None
+    assert reloaded_hit == 'інша'
+    assert reloaded_entries == 1
@@ -0,0 +1,61 @@
+import pytest
+
+PER_PAGE = 4
+
+@pytest.fixture
+def users(database):
+    conn = database.get_connection()
+    conn.executemany(
+        'INSERT INTO users (telegram_id, username, balance, used_requests, last_active) VALUES (?, ?, ?, ?, ?)',
+        [
+            (1000000 + i, f'user_{i}', i % 3, i % 2, f'2024-01-0{1 + i % 4}T10:00:00')
+            for i in range(15)
+        ]
+    )
+    conn.commit()
+    return database
+
+def _ids(page):
+    return [row[4] for row in page]
+
+def _expected(database, sort):
+    key, order = database.USER_SORTS[sort]
+    order_by = f'id {order}' if key == 'id' else f'{key} {order}, id {order}'
+    return [row[0] for row in database.get_connection().execute(f'SELECT id FROM users ORDER BY {order_by}')]
+
+@pytest.mark.parametrize('sort', ['j', 'a', 'b', 'u'])
+def test_keyset_pages_walk_both_ways_across_ties(users, sort):
+    forward = []
+    page, has_next = users.get_users_keyset_page(sort, '@', 0, PER_PAGE)
+    forward.append(_ids(page))
+    while has_next:
+        page, has_next = users.get_users_keyset_page(sort, '>', forward[-1][-1], PER_PAGE)
+        forward.append(_ids(page))
+    assert [user_id for ids in forward for user_id in ids] == _expected(users, sort)
+    assert all(len(ids) == PER_PAGE for ids in forward[:-1])
+
+    backward = [forward[-1]]
+    has_prev = True
+    while has_prev:
+        page, has_prev = users.get_users_keyset_page(sort, '<', backward[-1][0], PER_PAGE)
+        backward.append(_ids(page))
+    assert backward[::-1] == forward
+
+    for ids in forward:
+        page, _ = users.get_users_keyset_page(sort, '@', ids[0], PER_PAGE)
+        assert _ids(page) == ids
+
+def test_balance_history_pages_by_ledger_id(users):
+    telegram_id = 1000000
+    for amount in range(1, 13):
+        users.add_balance(telegram_id, amount)
+
+    pages = []
+    before_id = 0
+    while True:
+        entries, has_more = users.get_balance_history(telegram_id, before_id, 5)
+        pages.append([entry[1] for entry in entries])
+        if not has_more:
+            break
+        before_id = entries[-1][0]
+    assert pages == [[12, 11, 10, 9, 8], [7, 6, 5, 4, 3], [2, 1]]
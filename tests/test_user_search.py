@@ -0,0 +1,42 @@
+import pytest
+
+@pytest.fixture
+def crowded(database, monkeypatch):
+    monkeypatch.setattr(database, 'SEARCH_MAX_CANDIDATES', 50)
+    conn = database.get_connection()
+    conn.executemany(
+        'INSERT INTO users (telegram_id, username, first_name, last_name, last_active) VALUES (?, ?, ?, ?, ?)',
+        [(1000000 + i, f'user_{i}', 'Ivan', 'Петренко' if i % 2 else 'Коваль', '') for i in range(120)]
+    )
+    conn.execute(
+        'INSERT INTO users (telegram_id, username, first_name, last_active) VALUES (?, ?, ?, ?)',
+        (9999999, 'ivan', 'Petro', '')
+    )
+    conn.commit()
+    return database
+
+def test_short_words_are_not_prefix_matched(crowded):
+    assert crowded.build_search_query('Iv петр') == '"Iv" "петр"*'
+    assert crowded.search_users('iv') == ([], False, False)
+    users, _, truncated = crowded.search_users('ivan petro')
+    assert [user[0] for user in users] == [9999999]
+    assert not truncated
+
+def test_broad_query_is_capped_and_reported(crowded):
+    users, has_more, truncated = crowded.search_users('ivan', limit=5)
+    assert len(users) == 5 and has_more
+    assert truncated
+
+def test_keyset_pages_follow_rank_order(crowded):
+    pages = []
+    after = None
+    while True:
+        users, has_more, truncated = crowded.search_users('петренко', limit=7, after=after)
+        pages.append(users)
+        if not has_more:
+            break
+        after = (users[-1][5], users[-1][4])
+    ranked = [(user[5], user[4]) for page in pages for user in page]
+    assert ranked == sorted(ranked)
+    assert len(ranked) == len(set(ranked)) == 50
+    assert truncated
@@ -0,0 +1,129 @@
+import asyncio
+
+import pytest
+from aiogram import Bot
+from aiogram.types import Update
+from aiohttp.test_utils import TestClient, TestServer
+
+import webhook_server
+from webhook_server import UpdatePipeline, create_webhook_app
+
+SECRET = 'test-secret'
+UPDATE = {
+    'update_id': 1,
+    'message': {
+        'message_id': 1,
+        'date': 0,
+        'chat': {'id': 10, 'type': 'private'},
+        'from': {'id': 10, 'is_bot': False, 'first_name': 'Test'},
+        'text': 'hi'
+    }
+}
+
+class RecordingPipeline:
+
+    def __init__(self):
+        self.bot = Bot('42:TEST')
+        self.updates = []
+
+    async def submit(self, update):
+        self.updates.append(update)
+        return True
+
+async def post_update(headers):
+    pipeline = RecordingPipeline()
+    async with TestClient(TestServer(create_webhook_app(pipeline, SECRET))) as client:
+        response = await client.post('/telegram/webhook', json=UPDATE, headers=headers)
+        status = response.status
+    await pipeline.bot.session.close()
+    return status, pipeline.updates
+
+def test_webhook_requires_secret():
+    with pytest.raises(ValueError):
+        create_webhook_app(RecordingPipeline(), '')
+
+@pytest.mark.parametrize('headers', [{}, {'X-Telegram-Bot-Api-Secret-Token': 'wrong'}])
+def test_webhook_rejects_missing_or_wrong_secret(headers):
+    status, updates = asyncio.run(post_update(headers))
+    assert status == 401
+    assert updates == []
+
+def test_webhook_accepts_valid_secret():
+    status, updates = asyncio.run(post_update({'X-Telegram-Bot-Api-Secret-Token': SECRET}))
+    assert status == 200
+    assert [update.update_id for update in updates] == [1]
+
+class SlowDispatcher:
+
+    def __init__(self, slow_users):
+        self.slow_users = slow_users
+        self.handled = []
+        self.release = asyncio.Event()
+
+    async def feed_update(self, bot, update):
+        if update.message.from_user.id in self.slow_users:
+            await self.release.wait()
+        self.handled.append((update.message.from_user.id, update.update_id))
+
+def make_update(update_id, user_id):
+    data = dict(UPDATE, update_id=update_id)
+    data['message'] = dict(UPDATE['message'], chat={'id': user_id, 'type': 'private'},
+                           **{'from': {'id': user_id, 'is_bot': False, 'first_name': 'Test'}})
+    return Update.model_validate(data)
+
+def test_slow_users_do_not_block_others_and_order_is_kept():
+    async def scenario():
+        dp = SlowDispatcher(slow_users=set(range(100, 140)))
+        pipeline = UpdatePipeline(dp, bot=None, capacity=100)
+        pipeline.start()
+        update_id = 0
+        for user_id in range(100, 140):
+            update_id += 1
+            await pipeline.submit(make_update(update_id, user_id))
+        for _ in range(3):
+            update_id += 1
+            await pipeline.submit(make_update(update_id, 1))
+        for _ in range(50):
+            await asyncio.sleep(0)
+        fast_done = list(dp.handled)
+        update_id += 1
+        await pipeline.submit(make_update(update_id, 100))
+        dp.release.set()
+        await pipeline.close(timeout=1)
+        return fast_done, dp.handled, pipeline
+
+    fast_done, handled, pipeline = asyncio.run(scenario())
+    assert fast_done == [(1, 41), (1, 42), (1, 43)]
+    assert [update_id for user_id, update_id in handled if user_id == 100] == [1, 44]
+    assert pipeline.processed == 44
+    assert pipeline.depth == 0
+    assert pipeline.get_stats()['active_users'] == 0
+
+class RecordingBot:
+
+    def __init__(self):
+        self.calls = []
+
+    async def set_webhook(self, **kwargs):
+        self.calls.append('set_webhook')
+
+    async def delete_webhook(self):
+        self.calls.append('delete_webhook')
+
+def test_webhook_is_deleted_on_shutdown(monkeypatch):
+    monkeypatch.setattr(webhook_server, 'WEBHOOK_URL', 'https://example.test')
+    monkeypatch.setattr(webhook_server, 'WEBHOOK_HOST', '127.0.0.1')
+    monkeypatch.setattr(webhook_server, 'WEBHOOK_PORT', 0)
+    bot = RecordingBot()
+
+    async def scenario():
+        dp = SlowDispatcher(slow_users=set())
+        dp.resolve_used_update_types = lambda: ['message']
+        task = asyncio.create_task(webhook_server.run_webhook(dp, bot))
+        while not bot.calls and not task.done():
+            await asyncio.sleep(0.01)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(scenario())
+    assert bot.calls == ['set_webhook', 'delete_webhook']
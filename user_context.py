@@ -0,0 +1,116 @@
+import asyncio
+import logging
+import os
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, Update
+
+import db
+from async_db import activity_buffer, run_db
+
+logger = logging.getLogger(__name__)
+
+BLOCKED_TEXT = "🚫 Ваш акаунт заблоковано оператором. Зверніться до оператора для розблокування."
+BLOCKED_RECONCILE_INTERVAL = int(os.getenv('BLOCKED_RECONCILE_INTERVAL', '300'))
+
+@dataclass(frozen=True)
+class UserContext:
+    telegram_id: int
+    username: Optional[str]
+    first_name: Optional[str]
+    last_name: Optional[str]
+    join_date: Optional[str]
+    balance: int
+    last_payment_date: Optional[str]
+    total_payments: int
+    last_active: Optional[str]
+    is_blocked: bool
+    used_requests: int
+    is_new: bool = False
+    
+    @classmethod
+    def from_row(cls, row, is_new: bool = False) -> 'UserContext':
+        return cls(
+            telegram_id=row['telegram_id'],
+            username=row['username'],
+            first_name=row['first_name'],
+            last_name=row['last_name'],
+            join_date=row['join_date'],
+            balance=row['balance'] or 0,
+            last_payment_date=row['last_payment_date'],
+            total_payments=row['total_payments'] or 0,
+            last_active=row['last_active'],
+            is_blocked=bool(row['is_blocked']),
+            used_requests=row['used_requests'] or 0,
+            is_new=is_new
+        )
+
+async def reply_to_update(update: Update, text: str):
+    try:
+        if update.message:
+            await update.message.answer(text)
+        elif update.callback_query:
+            await update.callback_query.answer(text, show_alert=True)
+    except Exception as e:
+        logger.debug(f"Не вдалося відповісти користувачу: {e}")
+
+class BlockedUserMiddleware(BaseMiddleware):
+    
+    def __init__(self, operator_id: int):
+        self.operator_id = operator_id
+        self.rejected = 0
+    
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any]
+    ) -> Any:
+        tg_user = data.get('event_from_user')
+        if tg_user is not None and tg_user.id != self.operator_id and db.is_blocked_id(tg_user.id):
+            self.rejected += 1
+            await reply_to_update(event, BLOCKED_TEXT)
+            return None
+        return await handler(event, data)
+
+async def reconcile_blocked_ids(interval: int = BLOCKED_RECONCILE_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            changed = await run_db(db.load_blocked_ids)
+            if changed:
+                logger.warning(f"Список заблокованих користувачів розійшовся з БД, виправлено записів: {changed}")
+        except Exception as e:
+            logger.error(f"Помилка звірки заблокованих користувачів: {e}")
+
+class UserContextMiddleware(BaseMiddleware):
+    
+    def __init__(self, operator_id: int):
+        self.operator_id = operator_id
+    
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any]
+    ) -> Any:
+        tg_user = data.get('event_from_user')
+        if tg_user is None or tg_user.is_bot:
+            return await handler(event, data)
+        
+        try:
+            row, is_new = await activity_buffer.resolve(tg_user)
+        except Exception as e:
+            logger.error(f"Не вдалося завантажити користувача {tg_user.id}: {e}", exc_info=True)
+            await reply_to_update(event, "❌ Помилка при обробці запиту. Спробуйте пізніше.")
+            return None
+        
+        user_ctx = UserContext.from_row(row, is_new)
+        if user_ctx.is_blocked and tg_user.id != self.operator_id:
+            await reply_to_update(event, BLOCKED_TEXT)
+            return None
+        
+        data['user_ctx'] = user_ctx
+        return await handler(event, data)
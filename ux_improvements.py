@@ -1,9 +1,16 @@
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
+from aiogram.exceptions import TelegramRetryAfter
 from datetime import datetime
+from openai_service import format_markdown
+from send_queue import send_queue, PRIORITY_PROGRESS
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
+STREAM_EDIT_INTERVAL = 1.5
+STREAM_PREVIEW_LENGTH = 3900
+
 def get_cancel_keyboard():
     return InlineKeyboardMarkup(inline_keyboard=[[
         InlineKeyboardButton(text="❌ Скасувати", callback_data="cancel_action")
@@ -60,10 +67,10 @@ def format_user_stats(user_info) -> str:
     if not user_info:
         return "❌ Інформація не знайдена"
     
-    join_date = user_info[5] if user_info[5] else "Невідомо"
-    balance = user_info[6]
-    used = user_info[11] if len(user_info) > 11 else 0
-    total_payments = user_info[8] if len(user_info) > 8 else 0
+    join_date = user_info.join_date or "Невідомо"
+    balance = user_info.balance
+    used = user_info.used_requests
+    total_payments = user_info.total_payments
     
     total_available = balance + used
     if total_available > 0:
@@ -113,6 +120,15 @@ def format_payment_instructions(card_number: str, identifier: str, has_username:
         f"ℹ️ <i>Автоматичне зарахування працює тільки для Monobank</i>"
     )
 
+def format_queue_position(service_name: str, position: int, eta_seconds: int) -> str:
+    return (
+        f"⏳ <b>Ваш запит у черзі</b>\n\n"
+        f"📋 Служба: {service_name}\n"
+        f"📍 Позиція в черзі: <b>{position}</b>\n"
+        f"⏱ Орієнтовний час очікування: ~{eta_seconds} с\n"
+        f"💡 Будь ласка, зачекайте..."
+    )
+
 def get_processing_stages() -> list:
     return [
         "⏳ Аналізую ваше питання...",
@@ -121,4 +137,55 @@ def get_processing_stages() -> list:
         "✅ Майже готово..."
     ]
 
+class ProgressiveMessage:
+    
+    def __init__(self, message, header: str = "", min_interval: float = STREAM_EDIT_INTERVAL):
+        self.message = message
+        self.header = header
+        self.min_interval = min_interval
+        self.last_edit = 0.0
+        self.last_text = ""
+        self.edits = 0
+        self._formatted_prefix = ""
+        self._consumed = 0
+    
+    def _format_incremental(self, raw_text: str) -> str:
+        boundary = raw_text.rfind("\n\n")
+        if boundary > self._consumed:
+            block = format_markdown(raw_text[self._consumed:boundary])
+            if block:
+                self._formatted_prefix = (
+                    f"{self._formatted_prefix}\n\n{block}" if self._formatted_prefix else block
+                )
+            self._consumed = boundary
+        
+        tail = format_markdown(raw_text[self._consumed:])
+        if self._formatted_prefix and tail:
+            return f"{self._formatted_prefix}\n\n{tail}"
+        return self._formatted_prefix or tail
+    
+    async def update(self, raw_text: str):
+        now = time.monotonic()
+        if now - self.last_edit < self.min_interval:
+            return
+        
+        preview = self._format_incremental(raw_text)
+        if not preview:
+            return
+        if len(preview) > STREAM_PREVIEW_LENGTH:
+            preview = "…" + preview[-STREAM_PREVIEW_LENGTH:]
+        text = f"{self.header}{preview} ▌"
+        if text == self.last_text:
+            return
+        
+        self.last_edit = now
+        try:
+            await send_queue.send(self.message.edit_text(text), priority=PRIORITY_PROGRESS, max_retries=0)
+            self.last_text = text
+            self.edits += 1
+        except TelegramRetryAfter as e:
+            self.last_edit = now + e.retry_after
+            logger.warning(f"Telegram обмежив редагування, пауза {e.retry_after} с")
+        except Exception as e:
+            logger.debug(f"Не вдалося оновити повідомлення: {e}")
 
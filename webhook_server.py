@@ -0,0 +1,186 @@
+import asyncio
+import hmac
+import logging
+import os
+import secrets
+import time
+from collections import deque
+from typing import Any, Dict, Optional, Set
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+logger = logging.getLogger(__name__)
+
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram/webhook')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000'))
+WEBHOOK_ENQUEUE_TIMEOUT = float(os.getenv('WEBHOOK_ENQUEUE_TIMEOUT', '5'))
+LATENCY_SAMPLES = 1000
+
+def update_key(update: Update) -> Any:
+    event = update.event
+    user = getattr(event, 'from_user', None)
+    if user is not None:
+        return user.id
+    chat = getattr(event, 'chat', None)
+    if chat is not None:
+        return chat.id
+    return ('update', update.update_id)
+
+class UpdatePipeline:
+
+    def __init__(
+        self,
+        dp: Dispatcher,
+        bot: Bot,
+        capacity: int = WEBHOOK_QUEUE_SIZE,
+        enqueue_timeout: float = WEBHOOK_ENQUEUE_TIMEOUT
+    ):
+        self.dp = dp
+        self.bot = bot
+        self.capacity = capacity
+        self.enqueue_timeout = enqueue_timeout
+        self._lanes: Dict[Any, deque] = {}
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._tasks: Set[asyncio.Task] = set()
+        self.depth = 0
+        self.max_depth = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        self.latencies: deque = deque(maxlen=LATENCY_SAMPLES)
+
+    def start(self):
+        self._slots = asyncio.Semaphore(self.capacity)
+
+    async def close(self, timeout: float = 10):
+        deadline = time.monotonic() + timeout
+        while self.depth and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def submit(self, update: Update) -> bool:
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.enqueue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            logger.warning(f"Черга оновлень переповнена, оновлення {update.update_id} відхилено")
+            return False
+
+        key = update_key(update)
+        lane = self._lanes.get(key)
+        if lane is None:
+            self._lanes[key] = deque([(update, time.monotonic())])
+            task = asyncio.create_task(self._drain(key))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        else:
+            lane.append((update, time.monotonic()))
+        self.accepted += 1
+        self.depth += 1
+        self.max_depth = max(self.max_depth, self.depth)
+        return True
+
+    async def _drain(self, key: Any):
+        lane = self._lanes[key]
+        try:
+            while lane:
+                update, received = lane[0]
+                try:
+                    await self.dp.feed_update(self.bot, update)
+                    self.processed += 1
+                except Exception as e:
+                    self.failed += 1
+                    logger.error(f"Помилка обробки оновлення {update.update_id}: {e}", exc_info=True)
+                finally:
+                    lane.popleft()
+                    self.latencies.append(time.monotonic() - received)
+                    self.depth -= 1
+                    self._slots.release()
+        finally:
+            del self._lanes[key]
+
+    def get_stats(self) -> Dict:
+        latencies = sorted(self.latencies)
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else None
+        return {
+            'queued': self.depth,
+            'max_depth': self.max_depth,
+            'capacity': self.capacity,
+            'active_users': len(self._lanes),
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'processed': self.processed,
+            'failed': self.failed,
+            'p95_latency': round(p95, 3) if p95 is not None else None
+        }
+
+update_pipeline: Optional[UpdatePipeline] = None
+
+def create_webhook_app(pipeline: UpdatePipeline, secret: str, path: str = WEBHOOK_PATH) -> web.Application:
+    if not secret:
+        raise ValueError("Секрет вебхука Telegram не може бути порожнім")
+
+    async def handle_update(request: web.Request) -> web.Response:
+        token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(token.encode(), secret.encode()):
+            return web.Response(status=401, text='Unauthorized')
+        try:
+            data = await request.json()
+            update = Update.model_validate(data, context={'bot': pipeline.bot})
+        except Exception as e:
+            logger.warning(f"Некоректне оновлення від Telegram: {e}")
+            return web.Response(status=400, text='Bad Request')
+        if not await pipeline.submit(update):
+            return web.Response(status=503, text='Busy')
+        return web.Response(text='OK')
+
+    app = web.Application()
+    app.router.add_post(path, handle_update)
+    return app
+
+async def run_webhook(dp: Dispatcher, bot: Bot):
+    global update_pipeline
+    if not WEBHOOK_URL:
+        raise ValueError("WEBHOOK_URL не встановлено в .env файлі")
+
+    secret = WEBHOOK_SECRET
+    if not secret:
+        secret = secrets.token_urlsafe(32)
+        logger.info("WEBHOOK_SECRET не встановлено, згенеровано випадковий секрет на час роботи")
+
+    update_pipeline = UpdatePipeline(dp, bot)
+    update_pipeline.start()
+    runner = web.AppRunner(create_webhook_app(update_pipeline, secret))
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+
+    await bot.set_webhook(
+        url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+        secret_token=secret,
+        allowed_updates=dp.resolve_used_update_types(),
+        max_connections=min(100, max(1, WEBHOOK_MAX_CONNECTIONS))
+    )
+    logger.info(f"Вебхук запущено на {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}, черга: {WEBHOOK_QUEUE_SIZE}")
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        try:
+            await bot.delete_webhook()
+        except Exception as e:
+            logger.error(f"Не вдалося видалити вебхук: {e}")
+        await runner.cleanup()
+        await update_pipeline.close()